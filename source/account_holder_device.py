@@ -2,40 +2,71 @@
 
 import math
 import json
+import struct
 from collections import deque, defaultdict
-from Crypto.PublicKey import ECC
-
-from promissory_note import PromissoryNoteDraft, sign_DSS, verify_DSS, string_to_bytes, uint32_to_bytes, uint64_to_bytes
+from Crypto.Hash import SHA3_256
+
+from cache import LRUCache
+from revocation import RevocationList
+from signature_suites import get_suite, suite_for_key
+from promissory_note import PromissoryNoteDraft, Signer, Verifier, ByteReader, as_signer, as_verifier, \
+    import_key_point, import_public_key, key_fingerprint, key_point, bytestring_to_bytes, \
+    short_bytestring_to_bytes, string_to_bytes, uint32_to_bytes, uint64_to_bytes
 from datetime import date, datetime, timedelta
 
+# When set, running totals, both those of account holder devices and those
+# the bank keeps for each device, are compared to totals that are recomputed
+# from scratch every time they are read. Meant for debugging only.
+DEBUG_TOTALS = False
+
+CERTIFICATE_CACHE_CAPACITY = 4096
+CERTIFICATE_MAGIC = b'ECB\xc1'
+# A certificate's bank id and the first day (as a day number) on which it
+# is no longer valid.
+CERTIFICATE_FIELDS = struct.Struct('<II')
+
+# Certificates that have been validated, keyed by the certificate's digest
+# and the fingerprint of the bank key that validated it. An entry is only
+# used while the certificate has not expired.
+certificate_cache = LRUCache(CERTIFICATE_CACHE_CAPACITY)
+
 
 class AccountHolderDevice(object):
     """The data store used by account holder devices."""
 
-    def __init__(self, private_key=None):
+    def __init__(self, private_key=None, signature_suite=None):
         """Creates an empty account holder device from a private key.
-           Generates a private key automatically if none is specified."""
+           Generates a private key for a particular signature suite (ECDSA
+           over P-256 by default) if none is specified."""
         if private_key is None:
-            # Generate an ECC private key.
-            private_key = ECC.generate(curve='P-256')
+            private_key = get_suite(signature_suite).generate_key()
 
+        self.signature_suite = suite_for_key(private_key)
         self.private_key = private_key
         self.public_key = private_key.public_key()
+        self.signer = Signer(private_key)
         self.internet_connection = True
         self.promissory_note_counter = 0
         self.unspent_checks = defaultdict(deque)
+        self._total_check_value = 0
         self.bank_keys = {}
+        self.bank_verifiers = {}
+        self.revocation_lists = {}
         self.max_overcharge = 0.1
         self.check_punishment = 0.5
 
     @property
     def total_check_value(self):
         """Gets the total value of all checks in this account holder device."""
-        return sum([
-            check.value
-            for value_queue in self.unspent_checks.values()
-            for check in value_queue
-        ])
+        if DEBUG_TOTALS:
+            self.check_totals()
+        return self._total_check_value
+
+    def check_totals(self):
+        """Recomputes the total check value from scratch and raises an
+           AssertionError if the running total has drifted."""
+        assert self._total_check_value == sum(check.value for check in self.all_unspent_checks()), \
+            'Running check total has drifted.'
 
     def get_cert(self):
         return self.cert
@@ -54,13 +85,21 @@ class AccountHolderDevice(object):
         """Adds an unspent check to this account holder device."""
         assert check.owner_public_key == self.public_key
         self.unspent_checks[check.value].append(check)
+        self._total_check_value += check.value
+
+    def __take_unspent_check(self, value):
+        """Removes the oldest unspent check with a particular value and returns it."""
+        check = self.unspent_checks[value].popleft()
+        self._total_check_value -= check.value
+        return check
 
     def remove_expired_checks(self):
         """Removes all checks that can no longer be used in promissory notes from the unspent checks."""
         for check_deque in self.unspent_checks.values():
-            expired_checks = filter(lambda b: b.expired, check_deque)
+            expired_checks = [check for check in check_deque if check.expired]
             for expired_check in expired_checks:
                 check_deque.remove(expired_check)
+                self._total_check_value -= expired_check.value
 
     def register_name(self, name):
         self.name = name
@@ -68,6 +107,8 @@ class AccountHolderDevice(object):
     def register_bank(self, bank_id, bank_public_key):
         """Registers a bank by mapping its unique identifier to its public key."""
         self.bank_keys[bank_id] = bank_public_key
+        self.bank_verifiers[bank_id] = Verifier(bank_public_key)
+        self.revocation_lists[bank_id] = RevocationList(bank_id)
 
         # future_date = datetime.now()
         # try:
@@ -86,6 +127,21 @@ class AccountHolderDevice(object):
         """Gets the public key for the bank with a particular identifier."""
         return self.bank_keys[bank_id]
 
+    def get_bank_verifier(self, bank_id):
+        """Gets a verifier for the signatures of the bank with a particular identifier."""
+        return self.bank_verifiers[bank_id]
+
+    def get_revocation_list(self, bank_id):
+        """Gets this device's copy of the revocation list of the bank with a
+           particular identifier."""
+        return self.revocation_lists[bank_id]
+
+    def apply_revocation_delta(self, delta):
+        """Brings this device's copy of a bank's revocation list up to date
+           with a delta obtained from the bank. Raises a ValueError if the
+           delta does not carry the bank's signature."""
+        self.revocation_lists[delta.bank_id].apply(delta, self.get_bank_verifier(delta.bank_id))
+
     def draft_promissory_note(self, amount):
         """Creates a draft promissory note for a particular amount of money.
            This account holder serves as the "seller" party, that is, the
@@ -174,7 +230,7 @@ class AccountHolderDevice(object):
                 x * biggest_unit for x in min(m, key=lambda x: x[0])[1][0]
             ]
             for value in optimum:
-                unused_check = self.unspent_checks[value].popleft()
+                unused_check = self.__take_unspent_check(value)
                 amount = min(remaining_value, unused_check.value)
                 draft.append_check(unused_check, amount)
                 remaining_value -= amount
@@ -202,7 +258,7 @@ class AccountHolderDevice(object):
             while (remaining_value > 0) and (value is not None):
                 if (self.unspent_checks[value]) and (
                         value <= pseudo_remaining_value):
-                    unused_check = self.unspent_checks[value].popleft()
+                    unused_check = self.__take_unspent_check(value)
                     amount = min(unused_check.value, remaining_value)
                     checks.append((unused_check, amount))
                     remaining_value -= amount
@@ -214,7 +270,7 @@ class AccountHolderDevice(object):
                     x for x in self.unspent_checks.keys()
                     if (self.unspent_checks[x]) and (x >= remaining_value)
                 ])
-                unused_check = self.unspent_checks[value].popleft()
+                unused_check = self.__take_unspent_check(value)
                 checks.append([unused_check, remaining_value])
 
             # check if some checks can be omitted if so do so
@@ -251,7 +307,11 @@ class AccountHolderDevice(object):
 
 
 class DeviceCertificate:
-    """A certificate that authenticates an account holder device."""
+    """A certificate that authenticates an account holder device. It is
+       signed with the bank's private key or a signer for it, and validated
+       with the bank's public key or a verifier for it. The certificate is
+       encoded compactly: the device's key as a compact point and its expiry
+       as a day number."""
 
     def __init__(self, message, AHD_public_key, bank_private_key, valid_until,
                  bankID):
@@ -261,20 +321,66 @@ class DeviceCertificate:
             raise ValueError("invalid end time")
 
         self.AHD_public_key = AHD_public_key
+        self.device_public_key = import_public_key(AHD_public_key)
         self.bankID = bankID
         self.message = message
-        self.valid_until = valid_until.strftime('%d%m%Y')
-        self.signature = sign_DSS(self.__get_unsigned_bytes(),
-                                  bank_private_key)
+        self.expiry_day = valid_until.toordinal()
+        self.signature = as_signer(bank_private_key).sign(self.__get_unsigned_bytes())
+
+    @property
+    def valid_until(self):
+        """Gets the date on which this certificate expires, as a string."""
+        return date.fromordinal(self.expiry_day).strftime('%d%m%Y')
 
     def __get_unsigned_bytes(self):
-        return string_to_bytes(self.AHD_public_key) + \
-            string_to_bytes(self.message) + \
-            string_to_bytes(self.valid_until)
+        return CERTIFICATE_MAGIC + \
+            short_bytestring_to_bytes(key_point(self.device_public_key)) + \
+            CERTIFICATE_FIELDS.pack(self.bankID, self.expiry_day) + \
+            string_to_bytes(self.message)
+
+    def to_bytes(self):
+        """Produces a byte string that represents this certificate."""
+        return self.__get_unsigned_bytes() + bytestring_to_bytes(self.signature)
+
+    @staticmethod
+    def from_bytes(certificate_bytes):
+        """Reads a certificate from a byte string or a memoryview."""
+        reader = ByteReader(certificate_bytes)
+        if reader.read_fixed_view(len(CERTIFICATE_MAGIC)) != CERTIFICATE_MAGIC:
+            raise ValueError('Not a device certificate.')
+        certificate = DeviceCertificate.__new__(DeviceCertificate)
+        certificate.device_public_key = import_key_point(reader.read_short_view())
+        certificate.AHD_public_key = certificate.device_public_key.export_key(format='PEM')
+        certificate.bankID, certificate.expiry_day = reader.read_struct(CERTIFICATE_FIELDS)
+        certificate.message = reader.read_string()
+        certificate.signature = reader.read_bytestring()
+        return certificate
+
+    def validate(self, AHD_public_key, bank_public_key, revocations=None):
+        """Tests if this certificate is valid for a device key (a key or its
+           PEM encoding) and has been signed by a bank key (a key or a
+           verifier). A valid certificate is remembered per bank key, so
+           validating it again until it expires skips the signature check.
+           If the bank's revocation list is given, certificates of revoked
+           devices are rejected, even if they were validated before."""
+        if date.today().toordinal() >= self.expiry_day:
+            return False
+        if revocations is not None and revocations.is_revoked(self.device_public_key):
+            return False
+        if isinstance(AHD_public_key, str):
+            if AHD_public_key != self.AHD_public_key:
+                return False
+        elif key_fingerprint(AHD_public_key) != key_fingerprint(self.device_public_key):
+            return False
 
-    def validate(self, AHD_public_key, bank_public_key):
-        if datetime.strptime(self.valid_until, '%d%m%Y') < datetime.now():
+        verifier = as_verifier(bank_public_key)
+        # The digest covers the certificate's current fields, so a certificate
+        # that was changed after it was validated misses the cache.
+        unsigned_bytes = self.__get_unsigned_bytes()
+        cache_key = SHA3_256.new(unsigned_bytes + bytestring_to_bytes(self.signature)).digest() + verifier.fingerprint
+        if certificate_cache.get(cache_key) is not None:
+            return True
+        if not verifier.verify(unsigned_bytes, self.signature):
             return False
-        if AHD_public_key != self.AHD_public_key: return False
-        return verify_DSS(self.__get_unsigned_bytes(), self.signature,
-                          bank_public_key)
+        certificate_cache.put(cache_key, self.expiry_day)
+        return True
@@ -1,52 +1,148 @@
 """Implements the data store used by the bank."""
 
 import json
-
-from Crypto.PublicKey import ECC
-from promissory_note import Check
-from signing_protocol import known_banks
+import threading
+from collections import defaultdict
+from functools import wraps
+
+from promissory_note import Check, Signer, Verifier, key_fingerprint, CHECK_EXPIRATION, DAYS_VALID, RESERVED_BANK_ID
+from signature_suites import get_suite, suite_for_key
+from check_ledger import CheckLedger
+from clock import SystemClock
+from expiry_index import ExpiryIndex
+from settlement import SettlementLedger, SettlementBatch, RemittanceLedger
+from signing_protocol import bank_directory, verify_promissory_notes, NOTE_ERRORS
+import account_holder_device
 from account_holder_device import DeviceCertificate
+from revocation import RevocationList
 from datetime import date, datetime, timedelta
 
 CERT_EXPIRATION = 365
 
+# The outcomes of redeeming a promissory note as part of a batch.
+REDEEMED = 'redeemed'
+EXPIRED = 'expired'
+FRAUD = 'fraud'
+INVALID = 'invalid'
+
 
 class FraudException(Exception):
     pass
 
 
+def synchronized(method):
+    """Makes a bank method hold the bank's lock while it runs, so request
+       handling and background housekeeping do not interleave. If the bank
+       has a storage backend, the outermost synchronized call commits the
+       changes it made as a single unit."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            self.call_depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.call_depth -= 1
+                if self.call_depth == 0 and self.storage is not None:
+                    self.storage.commit()
+    return wrapper
+
+
+class SpendingMonth(object):
+    """Counts the month rollovers of a bank. The counter is shared by the bank
+       and all of its devices, so a rollover only needs to advance it."""
+
+    def __init__(self, epoch=0):
+        self.epoch = epoch
+
+    def advance(self):
+        """Starts a new month."""
+        self.epoch += 1
+
+
 class AccountDeviceData(object):
     """The bank's view of a device belonging to a particular account."""
 
-    def __init__(self, public_key, cap=0, monthly_cap=2000):
+    def __init__(self, public_key, cap=0, monthly_cap=2000, month=None):
         """Creates device data from a device's public key and a cap on
            the amount of money that can be issued in checks over the
-           course of a month/week/other timespan ."""
+           course of a month/week/other timespan. The device's cap is
+           restored to its monthly cap the first time it is used after
+           `month` has advanced."""
         self.public_key = public_key
         self.check_counter = 0
+        self.storage = None
+        self.month = SpendingMonth() if month is None else month
         self.cap = cap
         self.monthly_cap = monthly_cap
-        self.unspent_checks = set()
+        self.unspent_checks = CheckLedger()
         self.awaiting_claim = set()
+        self._unclaimed_note_value = 0
 
     @property
     def total_unspent_check_value(self):
         """Gets the total value of all unspent checks for this device."""
-        return sum(check.value for check in self.unspent_checks)
+        if account_holder_device.DEBUG_TOTALS:
+            self.check_totals()
+        return self.unspent_checks.total_value()
 
     @property
     def total_unclaimed_note_value(self):
         """Gets the total value of all notes that have not been claimed by sellers yet."""
-        return sum(note.total_check_value for note in self.awaiting_claim)
+        if account_holder_device.DEBUG_TOTALS:
+            self.check_totals()
+        return self._unclaimed_note_value
+
+    @property
+    def cap(self):
+        """Gets the amount of money that can still be issued in checks this month."""
+        if self.cap_epoch != self.month.epoch:
+            self._cap = self.monthly_cap
+            self.cap_epoch = self.month.epoch
+        return self._cap
+
+    @cap.setter
+    def cap(self, value):
+        """Sets the amount of money that can still be issued in checks this month."""
+        self._cap = value
+        self.cap_epoch = self.month.epoch
+        if self.storage is not None:
+            self.storage.cap_changed(self)
+
+    def check_totals(self):
+        """Recomputes the running totals for this device from scratch and
+           raises an AssertionError if they have drifted."""
+        assert self.unspent_checks.total_value() == self.unspent_checks.recompute_total_value(), \
+            'Running unspent check total has drifted.'
+        assert self._unclaimed_note_value == sum(note.total_check_value for note in self.awaiting_claim), \
+            'Running unclaimed note total has drifted.'
+
+    def add_awaiting_claim(self, note):
+        """Adds a note draft to the set of notes that have yet to be claimed by the seller."""
+        if note not in self.awaiting_claim:
+            self.awaiting_claim.add(note)
+            self._unclaimed_note_value += note.total_check_value
+            if self.storage is not None:
+                self.storage.note_added(self, note)
+
+    def discard_awaiting_claim(self, note):
+        """Removes a note draft from the set of notes that have yet to be claimed, if it is in there."""
+        if note in self.awaiting_claim:
+            self.awaiting_claim.remove(note)
+            self._unclaimed_note_value -= note.total_check_value
+            if self.storage is not None:
+                self.storage.note_removed(self, note)
 
     def is_unspent(self, check):
         """Checks if a check has not yet been spent."""
-        return check in self.unspent_checks
+        return self.unspent_checks.is_unspent(check.identifier, check.value, check.expiration_date)
 
     def spend_check(self, check, amount=0):
         """Spends a check. This action removes the check from the set of
            unspent checks."""
-        self.unspent_checks.remove(check)
+        self.unspent_checks.spend(check.identifier)
+        if self.storage is not None:
+            self.storage.check_spent(self, check.identifier)
         self.cap -= amount
 
     def reset_monthly_spending_cap(self):
@@ -55,38 +151,76 @@ class AccountDeviceData(object):
            each month)"""
         self.cap = self.monthly_cap
 
-    def remove_expired_notes(self):
-        """Removes all the unclaimed notes that can no longer be claimed."""
-        to_remove = set(filter(lambda b: not b.is_claimable, self.awaiting_claim))
-        # restore the note's value to the cap if it expires during the month the original transaction was performed.
+    def remove_expired_notes(self, today=None):
+        """Removes all the unclaimed notes that can no longer be claimed (as of
+           a particular date, today by default)."""
+        if today is None:
+            today = date.today()
+        to_remove = set(filter(lambda b: not b.is_claimable_on(today), self.awaiting_claim))
         for note in to_remove:
-            if note.affects_monthly_cap:
+            self.expire_note(note, today)
+
+    def expire_note(self, note, today=None):
+        """Removes a note that can no longer be claimed (as of a particular
+           date, today by default) from the unclaimed notes, if it is still in
+           there."""
+        if today is None:
+            today = date.today()
+        if note in self.awaiting_claim:
+            # restore the note's value to the cap if it expires during the month the original transaction was performed.
+            if note.affects_monthly_cap_on(today):
                 self.cap += note.value
-            self.awaiting_claim.remove(note)
-
-    def remove_expired_checks(self):
-        """Removes all checks that can no longer be claimed from the unspent checks set."""
-        self.unspent_checks = set(filter(lambda b: not b.unredeemable, self.unspent_checks))
+            self.discard_awaiting_claim(note)
+
+    def remove_expired_checks(self, today=None):
+        """Removes all checks that can no longer be claimed (as of a particular
+           date, today by default) from the unspent checks set."""
+        for identifier in self.unspent_checks.remove_unredeemable(today):
+            if self.storage is not None:
+                self.storage.check_spent(self, identifier)
+
+    def expire_check(self, identifier):
+        """Removes a check that can no longer be claimed from the unspent checks,
+           if it has not been spent yet."""
+        if identifier in self.unspent_checks:
+            self.unspent_checks.spend(identifier)
+            if self.storage is not None:
+                self.storage.check_spent(self, identifier)
 
     def generate_check(self, value, bank):
         """Generates a check that has a particular max value. The check is
            signed immediately by the bank."""
-        assert value <= self.cap
+        return self.generate_checks([value], bank)[0]
 
-        if self.total_unspent_check_value + value > self.cap:
+    def generate_checks(self, values, bank, workers=1, checkbook=False):
+        """Generates a batch of checks with particular max values. The checks
+           receive consecutive identifiers and are signed immediately by the
+           bank, either one by one using `workers` processes or, if
+           `checkbook` is set, with a single signature for the whole batch."""
+        total_value = sum(values)
+        assert total_value <= self.cap
+
+        if self.total_unspent_check_value + total_value > self.cap:
             raise ValueError(
-                'Cannot issue a check worth %d because doing so would exceed '
-                'the cap for the device.' % value)
+                'Cannot issue checks worth %d because doing so would exceed '
+                'the cap for the device.' % total_value)
 
-        # Generate a check.
-        check = Check(bank.identifier, self.public_key, value,
-                      self.check_counter)
+        # Generate the checks. They expire a fixed number of days after the bank's date.
+        expiration_date = bank.clock.today() + timedelta(CHECK_EXPIRATION)
+        checks = [Check(bank.identifier, self.public_key, value, identifier, expiration_date=expiration_date)
+                  for identifier, value in enumerate(values, self.check_counter)]
         # Increment the check counter.
-        self.check_counter += 1
-        # Sign the check.
-        check.sign(bank.private_key)
-        self.unspent_checks.add(check)
-        return check
+        self.check_counter += len(checks)
+        # Sign the checks.
+        if checkbook and checks:
+            Check.sign_checkbook(checks, bank.signer)
+        else:
+            Check.sign_many(checks, bank.signer, workers)
+        for check in checks:
+            self.unspent_checks.add(check.identifier, check.value, check.expiration_date)
+        if self.storage is not None:
+            self.storage.checks_issued(self, checks)
+        return checks
 
     def to_json(self):
         return {
@@ -94,7 +228,7 @@ class AccountDeviceData(object):
             'Check Counter': str(self.check_counter),
             'cap': str(self.cap),
             'monthly_cap': str(self.monthly_cap),
-            'Unspent Checks': [check.to_json() for check in self.unspent_checks],
+            'Unspent Checks': self.unspent_checks.to_json(),
             'Awaiting Claim': [draft.to_json() for draft in self.awaiting_claim]
         }
 
@@ -106,7 +240,10 @@ class Account(object):
     """Describes an account at a bank."""
 
     def __init__(self, owner, max_credit=0):
-        """Creates a new account from the account owner's personal information."""
+        """Creates a new account from the account owner's personal information.
+           The account receives an identifier once it is added to a bank."""
+        self.identifier = None
+        self.bank = None
         self.owner = owner
         self.max_credit = max_credit
         self.balance = 0
@@ -126,22 +263,34 @@ class Account(object):
         return sum(device.total_unclaimed_note_value
                    for device in self.devices.values())
 
-    def remove_expired_notes(self):
+    def check_totals(self):
+        """Recomputes the running totals of all devices associated with this
+           account from scratch and raises an AssertionError if they have drifted."""
+        for device in self.devices.values():
+            device.check_totals()
+
+    def remove_expired_notes(self, today=None):
         """Removes all the unclaimed notes that can no longer be claimed from all
         devices associated with this account."""
         for device in self.devices.values():
-            device.remove_expired_notes()
+            device.remove_expired_notes(today)
 
-    def remove_expired_checks(self):
+    def remove_expired_checks(self, today=None):
         """Removes all the expired checks that can no longer be claimed, from all
         devices associated with this account."""
         for device in self.devices.values():
-            device.remove_expired_checks()
+            device.remove_expired_checks(today)
+
+    def __change_balance(self, delta):
+        if self.bank is None:
+            self.balance += delta
+        else:
+            self.bank.credit(self, delta)
 
     def deposit(self, amount):
         """Deposits a certain amount of cash into this account."""
         assert amount >= 0
-        self.balance += amount
+        self.__change_balance(amount)
 
     def withdraw(self, amount):
         """Withdraws a certain amount of cash from this account."""
@@ -153,14 +302,14 @@ class Account(object):
         #      checks such that their total value exceeds `balance + max_credit`.
         #
         # assert amount <= self.balance
-        self.balance -= amount
+        self.__change_balance(-amount)
 
     def get_device(self, public_key):
         """Gets the device with a particular public key."""
-        return self.devices[public_key.export_key(format='PEM')]
+        return self.devices[key_fingerprint(public_key)]
 
     def add_device(self, ahd):
-        self.devices[ahd.public_key.export_key(format='PEM')] = ahd
+        self.devices[key_fingerprint(ahd.public_key)] = ahd
 
     def to_json(self):
         return {'Owner': self.owner, 'Max credit': self.max_credit, 'Balance': self.balance, 'AHDs': list(self.devices.values())}
@@ -172,24 +321,74 @@ class Account(object):
 class Bank(object):
     """The data store used by banks."""
 
-    def __init__(self, identifier, private_key=None, default_cap=0):
+    def __init__(self, identifier, private_key=None, default_cap=0, net_settlement=False, signature_suite=None):
         """Creates an empty bank data store from a unique identifier
-           and a private key. Generates a private key automatically if
-           none is specified."""
+           and a private key. Generates a private key for a particular
+           signature suite (ECDSA over P-256 by default) if none is
+           specified. If `net_settlement` is set, payments to the account
+           holders of other banks are accumulated and settled in periodic
+           batches instead of being deposited check by check."""
+        if identifier == RESERVED_BANK_ID:
+            raise ValueError('Bank id %d is reserved.' % identifier)
         if private_key is None:
-            # Generate an ECC private key.
-            private_key = ECC.generate(curve='P-256')
+            private_key = get_suite(signature_suite).generate_key()
 
         self.identifier = identifier
+        self.signature_suite = suite_for_key(private_key)
         self.private_key = private_key
         self.public_key = private_key.public_key()
+        # Every check and certificate this bank issues is signed by the same signer.
+        self.signer = Signer(private_key)
+        self.verifier = Verifier(self.public_key)
         self.default_cap = default_cap
         self.ahd_to_account = {}
         self.accounts = []
+        # Unspent checks and unclaimed notes, keyed by the day on which they expire.
+        self.check_expiry = ExpiryIndex()
+        self.note_expiry = ExpiryIndex()
+        self.month = SpendingMonth()
+        # Tells if issuing checks sweeps expired items first. Turned off when
+        # a scheduler takes care of housekeeping.
+        self.inline_housekeeping = True
+        # Tells the bank what day it is when it issues checks and decides if
+        # checks and notes have expired. A scheduler replaces it by its clock.
+        self.clock = SystemClock()
+        self.lock = threading.RLock()
+        self.net_settlement = net_settlement
+        self.settlement = SettlementLedger()
+        # The net amount this bank has received from (or, if negative, paid
+        # to) each counterparty bank in past settlement cycles.
+        self.interbank_position = defaultdict(int)
+        # The credits this bank has sent to the sellers of other banks and not
+        # had acknowledged yet, and the credits it has received.
+        self.remittances = RemittanceLedger()
+        # The devices whose certificates this bank has revoked.
+        self.revocations = RevocationList(identifier)
+        # The storage backend to which state changes are written, if any, and
+        # the nesting depth of synchronized calls.
+        self.storage = None
+        self.call_depth = 0
+
+    @synchronized
+    def attach_storage(self, storage):
+        """Makes this bank write all of its state changes to a storage backend,
+           such as a journal. The backend should already hold the bank's
+           current state, e.g., because the bank was just loaded from it."""
+        self.storage = storage
+        for account in self.accounts:
+            for device in account.devices.values():
+                device.storage = storage
 
+    @synchronized
     def add_account(self, account):
+        """Adds an account to this bank and assigns it an identifier."""
+        account.identifier = len(self.accounts)
+        account.bank = self
         self.accounts.append(account)
+        if self.storage is not None:
+            self.storage.account_added(account)
 
+    @synchronized
     def add_device(self, account, device_public_key, cap=None, monthly_cap=None):
         """Associates a new device with an account. The device to add is
            identified by a public key. Returns the data for the device."""
@@ -197,74 +396,305 @@ class Bank(object):
             cap = self.default_cap
         if monthly_cap is None:
             monthly_cap = cap
+        if account.identifier is None:
+            self.add_account(account)
 
-        exported_key = device_public_key.export_key(format='PEM')
-        self.ahd_to_account[exported_key] = account
-
-        device_data = AccountDeviceData(device_public_key, cap, monthly_cap)
-        account.devices[exported_key] = device_data
+        device_data = AccountDeviceData(device_public_key, cap, monthly_cap, self.month)
+        self.register_device(account, device_data)
 
+        exported_key = device_public_key.export_key(format='PEM')
         future_date = datetime.now() + timedelta(days =CERT_EXPIRATION)
-        cert = DeviceCertificate(account.owner.name, exported_key, self.private_key, future_date, self.identifier)
+        cert = DeviceCertificate(account.owner.name, exported_key, self.signer, future_date, self.identifier)
 
         return device_data, cert
 
+    @synchronized
+    def register_device(self, account, device_data):
+        """Associates existing device data with an account of this bank,
+           without issuing a certificate."""
+        self.ahd_to_account[key_fingerprint(device_data.public_key)] = account
+        if bank_directory.is_registered(self):
+            bank_directory.add_account_holder(self, device_data.public_key)
+        account.add_device(device_data)
+        device_data.storage = self.storage
+        if self.storage is not None:
+            self.storage.device_added(account, device_data)
+
     def has_account(self, public_key):
         """Verifies whether a particular public key has been
         registered with this bank."""
-        return public_key.export_key(format='PEM') in self.ahd_to_account
+        return key_fingerprint(public_key) in self.ahd_to_account
 
     def get_account(self, public_key):
         """Gets the account that owns a particular public key."""
-        return self.ahd_to_account[public_key.export_key(format='PEM')]
+        return self.ahd_to_account[key_fingerprint(public_key)]
 
     def get_device(self, public_key):
         """Gets the data for the device with a particular public key."""
         return self.get_account(public_key).get_device(public_key)
 
+    @synchronized
+    def credit(self, account, amount):
+        """Changes the balance of one of this bank's accounts by an amount,
+           which is negative for a debit. Deposits and withdrawals go through
+           here, so they are written to storage and committed like any other
+           bank operation, even if the caller is not one."""
+        account.balance += amount
+        if self.storage is not None:
+            self.storage.balance_changed(account, amount)
+
+    @synchronized
+    def revoke_devices(self, public_keys):
+        """Revokes the certificates of the devices with particular public
+           keys. The devices can no longer obtain checks, and account holder
+           devices that apply the resulting revocation list delta reject their
+           certificates. Returns the new version of the revocation list."""
+        fingerprints = [key_fingerprint(public_key) for public_key in public_keys]
+        version = self.revocations.revoke(fingerprints)
+        if self.storage is not None:
+            self.storage.devices_revoked(fingerprints)
+        return version
+
+    def revoke_device(self, public_key):
+        """Revokes the certificate of the device with a particular public key."""
+        return self.revoke_devices([public_key])
+
+    @synchronized
+    def revocation_delta(self, since_version=0):
+        """Gets the revocation list delta that brings a copy of this bank's
+           revocation list at a particular version up to date, signed by
+           this bank."""
+        return self.revocations.delta_since(since_version).sign(self.signer)
+
+    @synchronized
     def reset_monthly_spending_caps(self):
-        """Resets the spending caps for this month."""
-        for account in self.ahd_to_account.values():
-            for device in account.devices.values():
-                device.reset_monthly_spending_cap()
+        """Resets the spending caps for this month. Devices restore their caps
+           lazily, the first time they are used in the new month."""
+        self.month.advance()
+        if self.storage is not None:
+            self.storage.month_advanced(self.month.epoch)
+
+    @synchronized
+    def sweep_expired(self, today=None):
+        """Removes the unspent checks and unclaimed notes that have expired by
+           a particular date (by default, the date of the bank's clock). Only
+           the items that have actually expired are touched."""
+        if today is None:
+            today = self.clock.today()
+        for device, identifier in self.check_expiry.pop_expired(today):
+            if identifier is None:
+                # The index holds a sweep of the device's whole ledger instead
+                # of a single check, e.g., after the bank was restored from a snapshot.
+                device.remove_expired_checks(today)
+            else:
+                device.expire_check(identifier)
+        for device, note in self.note_expiry.pop_expired(today):
+            device.expire_note(note, today)
 
     def issue_check(self, public_key, value):
         """Issues a check of a particular value for the device associated
            with the given public key."""
+        return self.issue_checks(public_key, [value])[0]
+
+    @synchronized
+    def issue_checks(self, public_key, values, workers=1, checkbook=False):
+        """Issues a batch of checks with particular values for the device
+           associated with the given public key. The account's credit is
+           evaluated once for the whole batch. The checks are signed one by
+           one, serially unless `workers` asks for a process pool, or, in
+           checkbook mode, with a single signature over a Merkle tree of the
+           batch. The pool is created while the bank's lock is held, so
+           prefer checkbook mode over workers for large batches."""
+        if self.revocations.is_revoked(public_key):
+            raise ValueError('Checks cannot be issued because the device\'s certificate was revoked.')
         account = self.get_account(public_key)
         data = account.get_device(public_key)
 
-        # Make sure that issuing a new check will not exceed the balance + credit - 'unclaimed note value'
+        # Make sure that issuing the new checks will not exceed the balance + credit - 'unclaimed note value'
         # for the account.
-        account.remove_expired_notes()
-        account.remove_expired_checks()
-        if account.balance - account.total_unclaimed_note_value + account.max_credit < account.total_unspent_check_value + value:
+        if self.inline_housekeeping:
+            self.sweep_expired()
+        if account.balance - account.total_unclaimed_note_value + account.max_credit < account.total_unspent_check_value + sum(values):
             raise ValueError(
-                'Check cannot be issued because doing so would exceed '
+                'Checks cannot be issued because doing so would exceed '
                 'the account\'s credit.')
 
-        # Actually generate the check.
-        return data.generate_check(value, self)
+        # Actually generate the checks.
+        checks = data.generate_checks(values, self, workers, checkbook)
+        # A check becomes unredeemable the day after its grace period ends.
+        if data.unspent_checks.in_memory:
+            for check in checks:
+                self.check_expiry.add(check.expiration_date + timedelta(DAYS_VALID + 1), (data, check.identifier))
+        elif checks:
+            # The checks of a batch share their expiration date, so one sweep of the ledger covers them.
+            self.check_expiry.add(checks[0].expiration_date + timedelta(DAYS_VALID + 1), (data, None))
+        return checks
 
     def redeem_promissory_note(self, note):
         """Actually does the transfer of payments for the relevant checks
            contained within a given promissory note."""
+        self.__deliver(self.__redeem_promissory_note(note))
+
+    @synchronized
+    def __redeem_promissory_note(self, note):
         assert note.is_buyer_signature_authentic
         assert note.is_seller_signature_authentic
 
-        relevant_checks = list(filter(lambda c: c[0].bank_id == self.identifier, note.draft.checks))
-
+        transfers = defaultdict(int)
+        self.__redeem_checks(note, transfers)
+        self.__apply_transfers(transfers)
+        return self.__remit_to_other_banks()
+
+    def redeem_promissory_notes(self, notes, workers=1):
+        """Redeems a batch of promissory notes. The notes are verified together,
+           including the bank signatures on their checks, serially unless
+           `workers` asks for a process pool. Balance changes are accumulated
+           per account and applied once at the end. A note that fails does
+           not affect the others. Returns the outcome for every note, in
+           order: REDEEMED, EXPIRED (the note can no longer be claimed, so no
+           money moves), FRAUD or INVALID."""
+        outcomes, remittances = self.__redeem_promissory_notes(notes, workers)
+        self.__deliver(remittances)
+        return outcomes
+
+    @synchronized
+    def __redeem_promissory_notes(self, notes, workers):
+        bank_keys = {bank.identifier: bank.public_key for bank in bank_directory.banks}
+        bank_keys[self.identifier] = self.public_key
+        outcomes = []
+        transfers = defaultdict(int)
+        for note, error in zip(notes, verify_promissory_notes(notes, workers, bank_keys)):
+            if error is not None:
+                outcomes.append(INVALID)
+                continue
+            try:
+                outcomes.append(self.__redeem_checks(note, transfers))
+            except FraudException:
+                outcomes.append(FRAUD)
+            except (KeyError,) + NOTE_ERRORS:
+                outcomes.append(INVALID)
+        self.__apply_transfers(transfers)
+        return outcomes, self.__remit_to_other_banks()
+
+    @staticmethod
+    def __apply_transfers(transfers):
+        for account, amount in transfers.items():
+            if amount > 0:
+                account.deposit(amount)
+            elif amount < 0:
+                account.withdraw(-amount)
+
+    def __remit_to_other_banks(self):
+        """Unless this bank nets its interbank payments, turns what it owes the
+           sellers of other banks into remittances, as part of the operation
+           that created the obligations. The remittances are delivered once
+           the operation has been committed."""
+        if self.net_settlement:
+            return []
+        return [self.__remit(counterparty_id) for counterparty_id in self.settlement.counterparties()]
+
+    @synchronized
+    def __remit(self, recipient_id, settles=False):
+        """Takes what this bank owes the sellers of a recipient bank off its
+           books and records it as a remittance to that bank. A remittance
+           that settles obligations moves the interbank positions. Returns
+           the remittance, or None if nothing is owed."""
+        credits = self.settlement.take(recipient_id)
+        if not credits:
+            return None
+        remittance = self.remittances.create(self.identifier, recipient_id, credits, settles)
+        if settles:
+            self.interbank_position[recipient_id] -= remittance.total
+        if self.storage is not None:
+            self.storage.obligations_settled(recipient_id)
+            if settles:
+                self.storage.interbank_position_changed(recipient_id, -remittance.total)
+            self.storage.remittance_sent(remittance)
+        return remittance
+
+    def __deliver(self, remittances):
+        """Delivers remittances to their recipients and forgets the ones that
+           were applied. Runs outside of this bank's lock, so no two banks'
+           locks are ever held together. A remittance whose recipient is not
+           known stays pending."""
+        for remittance in remittances:
+            if remittance is None:
+                continue
+            recipient = bank_directory.get_by_identifier(remittance.recipient_id)
+            if recipient is not None:
+                recipient.__receive_remittance(remittance)
+                self.__acknowledge_remittance(remittance)
+
+    def deliver_pending_remittances(self):
+        """Delivers the remittances this bank has sent but that were not
+           acknowledged yet, e.g., because the bank was restored after a
+           crash. Recipients skip remittances they have already applied."""
+        with self.lock:
+            pending = self.remittances.pending_remittances()
+        self.__deliver(pending)
+
+    @synchronized
+    def __receive_remittance(self, remittance):
+        """Credits this bank's sellers from another bank's remittance, unless
+           the remittance was applied before."""
+        sender_id = remittance.sender_id
+        if self.remittances.is_received(sender_id, remittance.identifier):
+            return
+        for fingerprint, amount in remittance.credits.items():
+            self.ahd_to_account[fingerprint].deposit(amount)
+        if remittance.settles:
+            self.interbank_position[sender_id] += remittance.total
+        received_through = self.remittances.receive(sender_id, remittance.identifier)
+        if self.storage is not None:
+            if remittance.settles:
+                self.storage.interbank_position_changed(sender_id, remittance.total)
+            self.storage.remittance_received(sender_id, remittance.identifier, received_through)
+
+    @synchronized
+    def __acknowledge_remittance(self, remittance):
+        if self.remittances.acknowledge(remittance.recipient_id, remittance.identifier) and self.storage is not None:
+            self.storage.remittance_acknowledged(remittance.recipient_id, remittance.identifier)
+
+    def __vet_checks(self, note):
+        """Gets the checks in a note that were issued by this bank, along with
+           their amounts. The ledger only records which identifiers are
+           unspent, so a check must carry this bank's authentic signature and
+           belong to the buyer who signed the note, that is, the owner of the
+           note's first check. Raises a FraudException otherwise."""
+        checks = note.draft.checks
+        if not checks:
+            return []
+        buyer_fingerprint = key_fingerprint(checks[0][0].owner_public_key)
+        relevant_checks = []
+        for check, amount in checks:
+            if key_fingerprint(check.owner_public_key) != buyer_fingerprint:
+                raise FraudException('Check %d does not belong to the buyer who signed the note.' % check.identifier)
+            if check.bank_id == self.identifier:
+                if not check.is_signature_authentic(self.verifier):
+                    raise FraudException('Check %d was not signed by this bank.' % check.identifier)
+                relevant_checks.append((check, amount))
+        return relevant_checks
+
+    def __redeem_checks(self, note, transfers):
+        """Spends the checks in a note that were issued by this bank and records
+           the resulting balance changes in `transfers`. Every check is vetted
+           before anything is changed, so a fraudulent note leaves no trace."""
+        relevant_checks = self.__vet_checks(note)
+
+        today = self.clock.today()
         # Checks if the note's transaction date falls in the current month, and thus affects this month's running spending cap
-        affects_cap = note.draft.affects_monthly_cap
+        affects_cap = note.draft.affects_monthly_cap_on(today)
         # Check if the note is still valid and thus if money should be transferred
-        is_claimable = note.draft.is_claimable
+        is_claimable = note.draft.is_claimable_on(today)
+        seller_bank = bank_directory.get_home_bank(note.draft.seller_public_key)
+        if seller_bank is None:
+            raise ValueError('The seller is not served by any known bank.')
+        seller_account = seller_bank.get_account(note.draft.seller_public_key)
+
+        actions = []
+        seen_checks = set()
         for check, amount in relevant_checks:
             buyer_account = self.get_account(check.owner_public_key)
-            seller_bank = list(
-                filter(lambda b: b.has_account(note.draft.seller_public_key),
-                       known_banks()))[0]
-            seller_account = seller_bank.get_account(
-                note.draft.seller_public_key)
 
             assert buyer_account
             assert seller_account
@@ -272,51 +702,91 @@ class Bank(object):
             buyer_device_data = buyer_account.get_device(
                 check.owner_public_key)
 
-            if buyer_device_data.is_unspent(check):
+            check_key = (key_fingerprint(check.owner_public_key), check.identifier)
+            if check_key not in seen_checks and buyer_device_data.is_unspent(check):
                 # This case can only occur if the buyer didn't already hand the note to their bank before.
-                if affects_cap and is_claimable:
-                    buyer_device_data.spend_check(check, amount)
-                else:
-                    buyer_device_data.spend_check(check)
+                action = 'spend'
             elif note.draft in buyer_device_data.awaiting_claim:
                 # This case occurs when the note was handed in before by the buyer, and the unspent checks have already been cleared.
                 # If the note expired and the transaction date falls in the current month, restore the note's value to the spending
                 # cap for this month.
-                if not is_claimable and affects_cap:
-                    buyer_device_data.cap += amount
+                action = 'restore' if not is_claimable and affects_cap else None
             elif not is_claimable:
                 # This case occurs when the note was handed in before by the buyer and the unspent checks have already been cleared,
                 # but has already been removed from the 'awaiting claim' set again by the bank itself because it expired.
-                pass
-            elif check.unredeemable:
+                action = None
+            elif check.is_unredeemable_on(today):
                 # This case occurs when the note is still claimable but somehow contains an unredeemable check
                 raise FraudException(
                     'Oh lawd %s used expired checks for the transaction!' % buyer_account.owner)
             else:
                 raise FraudException(
                     'Oh lawd %s is double-spending or %s is double-redeeming!' % (buyer_account.owner, seller_account.owner))
+            seen_checks.add(check_key)
+            actions.append((check, amount, buyer_account, buyer_device_data, action))
+
+        for check, amount, buyer_account, buyer_device_data, action in actions:
+            if action == 'spend':
+                if affects_cap and is_claimable:
+                    buyer_device_data.spend_check(check, amount)
+                else:
+                    buyer_device_data.spend_check(check)
+            elif action == 'restore':
+                buyer_device_data.cap += amount
 
             if is_claimable:
-                buyer_account.withdraw(amount)
-                seller_account.deposit(amount)
+                transfers[buyer_account] -= amount
+                if seller_bank is not self:
+                    # Sellers at other banks are paid through remittances.
+                    seller_fingerprint = key_fingerprint(note.draft.seller_public_key)
+                    self.settlement.record(seller_bank.identifier, seller_fingerprint, amount)
+                    if self.storage is not None:
+                        self.storage.obligation_recorded(seller_bank.identifier, seller_fingerprint, amount)
+                else:
+                    transfers[seller_account] += amount
         # Remove the note from the list of unclaimed notes so it can't be claimed twice. It is assumed that a note only
         # contains checks from 1 device and bank.
-        some_check_pk = relevant_checks[0][0].owner_public_key
-        self.get_account(some_check_pk).get_device(some_check_pk).awaiting_claim.discard(note.draft)
-
+        if relevant_checks:
+            some_check_pk = relevant_checks[0][0].owner_public_key
+            self.get_account(some_check_pk).get_device(some_check_pk).discard_awaiting_claim(note.draft)
+        return REDEEMED if is_claimable else EXPIRED
+
+    def settle_with(self, counterparty):
+        """Settles the obligations between this bank and a counterparty bank
+           in both directions: each bank records what it owes the other's
+           sellers as a remittance before anyone is credited, and then
+           delivers it, so a settlement that is interrupted by a crash is
+           completed by delivering the pending remittances rather than paid
+           twice. The banks' interbank positions change by the net amount.
+           Returns the settlement batch."""
+        outgoing = self.__remit(counterparty.identifier, settles=True)
+        incoming = counterparty.__remit(self.identifier, settles=True)
+        self.__deliver([outgoing])
+        counterparty.__deliver([incoming])
+        return SettlementBatch(self, counterparty,
+                               {} if outgoing is None else outgoing.credits,
+                               {} if incoming is None else incoming.credits)
+
+    def settle(self):
+        """Runs a settlement cycle: settles with every bank towards which this
+           bank has unsettled obligations. Returns the settlement batches."""
+        return [self.settle_with(bank_directory.get_by_identifier(counterparty_id))
+                for counterparty_id in self.settlement.counterparties()]
+
+    @synchronized
     def hand_in_promissory_note(self, note):
         """This action gives a buyer's note copy to the bank to update which checks have been spent.
         This action does not perform any transfers since it is the seller's responsibility to claim the note."""
         assert note.is_buyer_signature_authentic
         assert note.is_seller_signature_authentic
 
-        relevant_checks = list(filter(lambda c: c[0].bank_id == self.identifier,
-                                 note.draft.checks))
+        relevant_checks = self.__vet_checks(note)
 
+        today = self.clock.today()
         # Checks if the note's transaction date falls in the current month, and thus affects this month's running spending cap
-        affects_cap = note.draft.affects_monthly_cap
+        affects_cap = note.draft.affects_monthly_cap_on(today)
         # Check if the note is still valid and thus if money should be transferred
-        is_claimable = note.draft.is_claimable
+        is_claimable = note.draft.is_claimable_on(today)
         for check, amount in relevant_checks:
             buyer_account = self.get_account(check.owner_public_key)
 
@@ -333,9 +803,12 @@ class Bank(object):
                     buyer_device_data.spend_check(check)
 
         # Add the note to the set of notes that have yet to be claimed, if the note is still claimable
-        if is_claimable:
+        if is_claimable and relevant_checks:
             some_check_pk = relevant_checks[0][0].owner_public_key
-            self.get_account(some_check_pk).get_device(some_check_pk).awaiting_claim.add(note.draft)
+            device_data = self.get_account(some_check_pk).get_device(some_check_pk)
+            device_data.add_awaiting_claim(note.draft)
+            # A note can no longer be claimed once it is more than DAYS_VALID days old.
+            self.note_expiry.add(note.draft.transaction_date + timedelta(DAYS_VALID + 1), (device_data, note.draft))
 
     def to_json(self):
         return {
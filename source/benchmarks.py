@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for performance-sensitive parts of the electronic checkbook."""
+
+import os
+import time
+import timeit
+from datetime import datetime
+from Crypto.PublicKey import ECC
+
+from account_holder_device import AccountHolderDevice
+from bank import Bank, Account
+from promissory_note import Check, PromissoryNoteDraft, uint32_from_bytes, uint64_from_bytes, \
+    bytestring_from_bytes, string_from_bytes, configure_verification_cache, sign_DSS, verify_DSS, \
+    WIRE_VERSION_1, WIRE_VERSION_2, Verifier
+from signing_protocol import create_promissory_note, verify_promissory_notes
+from signature_suites import SUITES
+from revocation import RevocationList
+
+
+def legacy_check_from_bytes(check_bytes):
+    """Decodes a check using the slicing `*_from_bytes` helpers."""
+    bank_id, check_bytes = uint32_from_bytes(check_bytes)
+    owner_public_key, check_bytes = string_from_bytes(check_bytes)
+    value, check_bytes = uint32_from_bytes(check_bytes)
+    identifier, check_bytes = uint64_from_bytes(check_bytes)
+    expiration_date, check_bytes = string_from_bytes(check_bytes)
+    signature, check_bytes = bytestring_from_bytes(check_bytes)
+    return Check(bank_id,
+                 ECC.import_key(owner_public_key), value, identifier,
+                 signature, datetime.strptime(expiration_date, '%d%m%Y').date())
+
+
+def legacy_draft_from_bytes(draft_bytes):
+    """Decodes a promissory note draft using the slicing `*_from_bytes` helpers."""
+    seller_public_key, draft_bytes = string_from_bytes(draft_bytes)
+    identifier, draft_bytes = uint64_from_bytes(draft_bytes)
+    value, draft_bytes = uint32_from_bytes(draft_bytes)
+    transaction_date, draft_bytes = string_from_bytes(draft_bytes)
+    draft = PromissoryNoteDraft(ECC.import_key(seller_public_key), identifier, value,
+                                datetime.strptime(transaction_date, '%d%m%Y').date())
+    while draft_bytes:
+        check, draft_bytes = bytestring_from_bytes(draft_bytes)
+        amount, draft_bytes = uint32_from_bytes(draft_bytes)
+        draft.checks.append((legacy_check_from_bytes(check), amount))
+    return draft
+
+
+def make_draft_bytes(check_count, version=WIRE_VERSION_1):
+    """Creates a promissory note draft that contains a particular number of
+       (unsigned) checks and encodes it in a particular version of the wire
+       format."""
+    buyer = AccountHolderDevice()
+    seller = AccountHolderDevice()
+    draft = seller.draft_promissory_note(check_count)
+    draft.version = version
+    for identifier in range(check_count):
+        draft.append_check(Check(42, buyer.public_key, 1, identifier, b'\0' * 64, version=version), 1)
+    return draft.to_bytes()
+
+
+def benchmark_decode(check_counts=(1, 10, 100, 1000), repeat=3):
+    """Compares the time it takes to decode promissory note drafts with the
+       cursor-based decoder and with the slicing helpers."""
+    print('Decoding promissory note drafts (best of %d, seconds per decode)' % repeat)
+    print('%8s %12s %12s %8s' % ('checks', 'slicing', 'cursor', 'speedup'))
+    for check_count in check_counts:
+        draft_bytes = make_draft_bytes(check_count)
+        number = max(1, 1000 // check_count)
+        legacy = min(timeit.repeat(lambda: legacy_draft_from_bytes(draft_bytes),
+                                   number=number, repeat=repeat)) / number
+        cursor = min(timeit.repeat(lambda: PromissoryNoteDraft.from_bytes(draft_bytes),
+                                   number=number, repeat=repeat)) / number
+        print('%8d %12.6f %12.6f %7.2fx' % (check_count, legacy, cursor, legacy / cursor))
+
+
+def benchmark_wire_format(check_counts=(1, 10, 100), repeat=3):
+    """Compares the size of promissory note drafts and the time it takes to
+       decode them in version 1 and version 2 of the wire format."""
+    print('Wire format versions (bytes per draft; best of %d, seconds per decode)' % repeat)
+    print('%8s %10s %10s %8s %12s %12s' % ('checks', 'v1 bytes', 'v2 bytes', 'ratio', 'v1 decode', 'v2 decode'))
+    for check_count in check_counts:
+        v1_bytes = make_draft_bytes(check_count, WIRE_VERSION_1)
+        v2_bytes = make_draft_bytes(check_count, WIRE_VERSION_2)
+        number = max(1, 1000 // check_count)
+        v1_decode = min(timeit.repeat(lambda: PromissoryNoteDraft.from_bytes(v1_bytes),
+                                      number=number, repeat=repeat)) / number
+        v2_decode = min(timeit.repeat(lambda: PromissoryNoteDraft.from_bytes(v2_bytes),
+                                      number=number, repeat=repeat)) / number
+        print('%8d %10d %10d %7.2fx %12.6f %12.6f' % (check_count, len(v1_bytes), len(v2_bytes),
+                                                     len(v1_bytes) / len(v2_bytes), v1_decode, v2_decode))
+
+
+class Owner(object):
+    """A minimal account owner for benchmarks."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def make_notes(note_count):
+    """Creates a number of fully-signed promissory notes that each spend one check.
+       Returns the notes and the bank that issued their checks."""
+    bank = Bank(42)
+    buyer = AccountHolderDevice()
+    seller = AccountHolderDevice()
+    account = Account(Owner('buyer'))
+    account.deposit(note_count)
+    bank.add_device(account, buyer.public_key, note_count, note_count)
+    notes = []
+    for _ in range(note_count):
+        buyer.add_unspent_check(bank.issue_check(buyer.public_key, 1))
+        notes.append(create_promissory_note(buyer, seller, 1))
+    return notes, bank
+
+
+def benchmark_batch_verification(note_count=1000, worker_counts=None):
+    """Measures the throughput of batch promissory note verification for
+       different numbers of worker processes."""
+    if worker_counts is None:
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    notes, bank = make_notes(note_count)
+    bank_keys = {bank.identifier: bank.public_key}
+    # Make sure that every verification is actually performed.
+    configure_verification_cache(0)
+    print('Verifying %d promissory notes (notes per second)' % note_count)
+    print('%8s %12s %8s' % ('workers', 'throughput', 'speedup'))
+    baseline = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        verify_promissory_notes(notes, workers=workers, bank_keys=bank_keys)
+        throughput = note_count / (time.perf_counter() - start)
+        baseline = baseline or throughput
+        print('%8d %12.1f %7.2fx' % (workers, throughput, throughput / baseline))
+    configure_verification_cache()
+
+
+def benchmark_checkbook(check_counts=(10, 100, 1000)):
+    """Compares issuing and verifying checks one signature at a time with
+       issuing and verifying them as a single Merkle-rooted checkbook."""
+    print('Issuing and verifying checks (seconds per batch)')
+    print('%8s %12s %12s %8s' % ('checks', 'per-check', 'checkbook', 'speedup'))
+    for check_count in check_counts:
+        timings = []
+        for checkbook in (False, True):
+            bank = Bank(42)
+            device = AccountHolderDevice()
+            account = Account(Owner('holder'))
+            account.deposit(check_count)
+            bank.add_device(account, device.public_key, check_count, check_count)
+            configure_verification_cache()
+            start = time.perf_counter()
+            checks = bank.issue_checks(device.public_key, [1] * check_count, workers=1, checkbook=checkbook)
+            assert all(check.is_signature_authentic(bank.public_key) for check in checks)
+            timings.append(time.perf_counter() - start)
+        print('%8d %12.4f %12.4f %7.2fx' % (check_count, timings[0], timings[1], timings[0] / timings[1]))
+
+
+def benchmark_signature_suites(check_count=200, repeat=3):
+    """Compares the signature suites head to head: signing and verifying
+       single messages, and issuing and verifying checks one by one."""
+    message = b'\0' * 256
+    print('Signature suites (best of %d, seconds per operation)' % repeat)
+    print('%16s %12s %12s %12s' % ('suite', 'sign', 'verify', 'issue check'))
+    for name, suite in sorted(SUITES.items()):
+        key = suite.generate_key()
+        signature = sign_DSS(message, key)
+        public_key = key.public_key()
+        sign = min(timeit.repeat(lambda: sign_DSS(message, key), number=100, repeat=repeat)) / 100
+        configure_verification_cache(0)
+        verify = min(timeit.repeat(lambda: verify_DSS(message, signature, public_key),
+                                   number=100, repeat=repeat)) / 100
+
+        bank = Bank(42, signature_suite=suite)
+        device = AccountHolderDevice(signature_suite=suite)
+        account = Account(Owner('holder'))
+        account.deposit(check_count)
+        bank.add_device(account, device.public_key, check_count, check_count)
+        start = time.perf_counter()
+        checks = bank.issue_checks(device.public_key, [1] * check_count, workers=1)
+        assert all(check.is_signature_authentic(bank.public_key) for check in checks)
+        issue = (time.perf_counter() - start) / check_count
+        configure_verification_cache()
+        print('%16s %12.6f %12.6f %12.6f' % (name, sign, verify, issue))
+
+
+def benchmark_revocation_lookup(revoked_counts=(0, 1000, 1000000), repeat=3):
+    """Measures the time it takes to validate a device certificate, with its
+       signature check cached, against revocation lists of different sizes."""
+    bank = Bank(42)
+    device = AccountHolderDevice()
+    _, cert = bank.add_device(Account(Owner('holder')), device.public_key)
+    verifier = Verifier(bank.public_key)
+    print('Validating a certificate against a revocation list (best of %d, seconds per validation)' % repeat)
+    print('%10s %12s' % ('revoked', 'validate'))
+    for revoked_count in revoked_counts:
+        revocations = RevocationList(bank.identifier)
+        revocations.revoke([os.urandom(32) for _ in range(revoked_count)])
+        assert cert.validate(device.public_key, verifier, revocations)
+        validate = min(timeit.repeat(lambda: cert.validate(device.public_key, verifier, revocations),
+                                     number=1000, repeat=repeat)) / 1000
+        print('%10d %12.8f' % (revoked_count, validate))
+
+
+if __name__ == '__main__':
+    benchmark_decode()
+    benchmark_wire_format()
+    benchmark_batch_verification()
+    benchmark_checkbook()
+    benchmark_signature_suites()
+    benchmark_revocation_lookup()
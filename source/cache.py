@@ -0,0 +1,102 @@
+"""Bounded in-memory caches with hit/miss accounting."""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A cache that holds at most a fixed number of entries and evicts
+       the least recently used entry when it is full."""
+
+    # Tells if looking up an entry moves it to the back of the eviction queue.
+    refresh_on_access = True
+    policy = 'lru'
+
+    def __init__(self, capacity):
+        """Creates an empty cache that holds at most `capacity` entries."""
+        if capacity < 0:
+            raise ValueError('Cache capacity must be non-negative.')
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Gets the value for a key and marks it as recently used. Returns
+           `default` if the key is not in the cache."""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.refresh_on_access:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Adds an entry to the cache, evicting the least recently used
+           entry if the cache is full."""
+        if self.capacity == 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        """Gets the value for a key. If the key is not in the cache, then
+           `create(key)` is called and its result is cached and returned."""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = create(key)
+            self.put(key, value)
+            return value
+        self.hits += 1
+        if self.refresh_on_access:
+            self.entries.move_to_end(key)
+        return value
+
+    def clear(self):
+        """Removes all entries from the cache and resets its counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Gets a dictionary that describes the cache's size and hit rate."""
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class FIFOCache(LRUCache):
+    """A cache that holds at most a fixed number of entries and evicts
+       the oldest entry when it is full, regardless of how often that
+       entry was used."""
+
+    refresh_on_access = False
+    policy = 'fifo'
+
+
+EVICTION_POLICIES = {cls.policy: cls for cls in (LRUCache, FIFOCache)}
+
+
+def new_cache(capacity, policy='lru'):
+    """Creates an empty cache with a particular capacity and eviction policy.
+       Supported policies are 'lru' and 'fifo'."""
+    try:
+        return EVICTION_POLICIES[policy](capacity)
+    except KeyError:
+        raise ValueError('Unknown eviction policy %r.' % policy)
@@ -0,0 +1,193 @@
+"""A compact record of the checks that a bank has issued to a device."""
+
+import struct
+import sys
+from array import array
+from datetime import date, timedelta
+
+from promissory_note import DAYS_VALID
+
+# The first identifier in the ledger's window, the number of identifiers in
+# the window, the length of the bitmap, the number of unspent checks and
+# their total value.
+LEDGER_HEADER = struct.Struct('<QIIIQ')
+
+
+class CheckLedger(object):
+    """Tracks which of a device's checks are still unspent. Check identifiers
+       are handed out by a counter, so the ledger stores one bit per
+       identifier that tells if the check is unspent, plus side tables that
+       hold each check's value and expiration date (as a day number).
+
+       The tables only cover a window of identifiers. Once the checks at the
+       front of the window have all been spent or have expired, the window
+       moves past them, so the size of the ledger follows the checks that
+       are outstanding rather than every check that was ever issued."""
+
+    # Checks in this ledger are cheap to expire one by one. Ledgers that live
+    # in a database are swept with a single query instead.
+    in_memory = True
+
+    def __init__(self):
+        """Creates an empty check ledger."""
+        # The first identifier in the window, always a multiple of eight, and
+        # the first byte of the bitmap that may have a bit set.
+        self.base = 0
+        self.first_byte = 0
+        self.bitmap = bytearray()
+        self.values = array('I')
+        self.expiration_days = array('I')
+        self.unspent_count = 0
+        self.unspent_value = 0
+
+    def __len__(self):
+        """Gets the number of unspent checks."""
+        return self.unspent_count
+
+    def __contains__(self, identifier):
+        """Tests if the check with a particular identifier is unspent."""
+        index = identifier - self.base
+        return 0 <= index < len(self.values) and bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def __iter__(self):
+        """Iterates over the identifiers of all unspent checks."""
+        bitmap = self.bitmap
+        for byte_index in range(self.first_byte, len(bitmap)):
+            byte = bitmap[byte_index]
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield self.base + ((byte_index << 3) | bit)
+
+    def __move_window(self):
+        """Skips the empty bytes at the front of the bitmap and, once they
+           make up half of it, drops them along with their side table entries.
+           Bytes that identifiers may still be issued into are kept."""
+        bitmap = self.bitmap
+        limit = len(self.values) >> 3
+        first_byte = self.first_byte
+        while first_byte < limit and not bitmap[first_byte]:
+            first_byte += 1
+        self.first_byte = first_byte
+        if first_byte and 2 * first_byte >= len(bitmap):
+            del bitmap[:first_byte]
+            del self.values[:first_byte << 3]
+            del self.expiration_days[:first_byte << 3]
+            self.base += first_byte << 3
+            self.first_byte = 0
+
+    def add(self, identifier, value, expiration_date):
+        """Records a newly issued, unspent check."""
+        index = identifier - self.base
+        assert index >= 0, 'Check identifiers must not precede the ledger\'s window.'
+        if index < len(self.values):
+            assert identifier not in self
+        else:
+            padding = index + 1 - len(self.values)
+            self.values.extend([0] * padding)
+            self.expiration_days.extend([0] * padding)
+            self.bitmap.extend(bytes((index >> 3) + 1 - len(self.bitmap)))
+        self.values[index] = value
+        self.expiration_days[index] = expiration_date.toordinal()
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.unspent_count += 1
+        self.unspent_value += value
+        if not self.bitmap[self.first_byte]:
+            # Checks were added past a gap, e.g., while loading a ledger.
+            self.__move_window()
+
+    def is_unspent(self, identifier, value, expiration_date):
+        """Tests if a check is unspent and matches the value and expiration
+           date with which it was issued."""
+        return identifier in self and \
+            self.values[identifier - self.base] == value and \
+            self.expiration_days[identifier - self.base] == expiration_date.toordinal()
+
+    def spend(self, identifier):
+        """Marks an unspent check as spent. Raises a KeyError if the check
+           is not unspent."""
+        if identifier not in self:
+            raise KeyError(identifier)
+        index = identifier - self.base
+        self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+        self.unspent_count -= 1
+        self.unspent_value -= self.values[index]
+        if index >> 3 == self.first_byte and not self.bitmap[self.first_byte]:
+            self.__move_window()
+
+    def value(self, identifier):
+        """Gets the value of the check with a particular identifier."""
+        return self.values[identifier - self.base]
+
+    def expiration_date(self, identifier):
+        """Gets the expiration date of the check with a particular identifier."""
+        return date.fromordinal(self.expiration_days[identifier - self.base])
+
+    def unspent_expiration_days(self):
+        """Gets the set of expiration dates (as day numbers) of the unspent checks."""
+        return {self.expiration_days[identifier - self.base] for identifier in self}
+
+    def total_value(self):
+        """Gets the total value of all unspent checks. The total is kept up
+           to date as checks are added and spent."""
+        return self.unspent_value
+
+    def recompute_total_value(self):
+        """Computes the total value of all unspent checks from scratch."""
+        return sum(self.values[identifier - self.base] for identifier in self)
+
+    def remove_unredeemable(self, today=None):
+        """Drops all unspent checks that can no longer be redeemed by sellers.
+           Returns the identifiers of the dropped checks."""
+        if today is None:
+            today = date.today()
+        last_redeemable_day = (today - timedelta(DAYS_VALID)).toordinal()
+        removed = [identifier for identifier in self
+                   if self.expiration_days[identifier - self.base] < last_redeemable_day]
+        for identifier in removed:
+            self.spend(identifier)
+        return removed
+
+    def to_bytes(self):
+        """Encodes this ledger as its window and running totals followed by
+           its raw tables: the bitmap, the values and the expiration days."""
+        values, expiration_days = self.values, self.expiration_days
+        if sys.byteorder != 'little':
+            values, expiration_days = array('I', values), array('I', expiration_days)
+            values.byteswap()
+            expiration_days.byteswap()
+        return LEDGER_HEADER.pack(self.base, len(self.values), len(self.bitmap), self.unspent_count,
+                                  self.unspent_value) + \
+            bytes(self.bitmap) + \
+            values.tobytes() + expiration_days.tobytes()
+
+    @staticmethod
+    def from_buffer(buffer, offset=0):
+        """Decodes a ledger that starts at a particular offset in a buffer,
+           such as a memory-mapped file. The tables are copied in bulk, without
+           decoding individual checks. Returns the ledger and the offset just
+           past it."""
+        ledger = CheckLedger()
+        ledger.base, length, bitmap_length, unspent_count, unspent_value = LEDGER_HEADER.unpack_from(buffer, offset)
+        offset += LEDGER_HEADER.size
+        ledger.unspent_count = unspent_count
+        ledger.unspent_value = unspent_value
+        ledger.bitmap = bytearray(buffer[offset:offset + bitmap_length])
+        offset += bitmap_length
+        ledger.values.frombytes(buffer[offset:offset + 4 * length])
+        offset += 4 * length
+        ledger.expiration_days.frombytes(buffer[offset:offset + 4 * length])
+        offset += 4 * length
+        if sys.byteorder != 'little':
+            ledger.values.byteswap()
+            ledger.expiration_days.byteswap()
+        if ledger.bitmap:
+            ledger.__move_window()
+        return ledger, offset
+
+    def to_json(self):
+        return [{
+            'Identifier': identifier,
+            'Value': self.value(identifier),
+            'Expiration date': self.expiration_date(identifier).strftime('%d%m%Y')
+        } for identifier in self]
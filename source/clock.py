@@ -0,0 +1,28 @@
+"""Clocks that tell a bank what day it is."""
+
+from datetime import date, timedelta
+
+
+class SystemClock(object):
+    """A clock that reports the actual date."""
+
+    def today(self):
+        """Gets the current date."""
+        return date.today()
+
+
+class ManualClock(object):
+    """A clock whose date only changes when told to. Useful for tests and
+       simulations."""
+
+    def __init__(self, today=None):
+        """Creates a clock that starts at a particular date (today by default)."""
+        self.current_date = date.today() if today is None else today
+
+    def today(self):
+        """Gets the clock's current date."""
+        return self.current_date
+
+    def advance(self, days=1):
+        """Moves the clock a number of days forward."""
+        self.current_date += timedelta(days)
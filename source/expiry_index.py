@@ -0,0 +1,46 @@
+"""An index that hands out items in the order in which they expire."""
+
+import heapq
+from datetime import date
+
+
+class ExpiryIndex(object):
+    """Groups items by the first day on which they count as expired. The
+       distinct days are kept in a min-heap, so collecting the items that
+       have expired by a particular day only touches those items."""
+
+    def __init__(self):
+        """Creates an empty expiry index."""
+        self.days = []
+        self.buckets = {}
+        self.item_count = 0
+
+    def __len__(self):
+        """Gets the number of items in this index."""
+        return self.item_count
+
+    def add(self, expiry_date, item):
+        """Adds an item that counts as expired from a particular date onward."""
+        day = expiry_date.toordinal()
+        bucket = self.buckets.get(day)
+        if bucket is None:
+            bucket = self.buckets[day] = []
+            heapq.heappush(self.days, day)
+        bucket.append(item)
+        self.item_count += 1
+
+    def next_expiry_date(self):
+        """Gets the earliest date on which an item in this index expires, or
+           None if the index is empty."""
+        return date.fromordinal(self.days[0]) if self.days else None
+
+    def pop_expired(self, today):
+        """Removes all items that have expired by a particular date from
+           this index and returns them, earliest first."""
+        expired = []
+        last_day = today.toordinal()
+        while self.days and self.days[0] <= last_day:
+            bucket = self.buckets.pop(heapq.heappop(self.days))
+            self.item_count -= len(bucket)
+            expired.extend(bucket)
+        return expired
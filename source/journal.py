@@ -0,0 +1,305 @@
+"""An append-only journal of the state changes of a bank, which lets a bank
+   survive restarts by replaying the journal."""
+
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+
+from promissory_note import PromissoryNoteDraft, import_public_key, key_fingerprint, DAYS_VALID
+from settlement import Remittance
+from storage import BankStorage, AccountOwner
+
+# Record types.
+ACCOUNT_ADDED = 1
+DEVICE_ADDED = 2
+CHECKS_ISSUED = 3
+CHECK_SPENT = 4
+CAP_CHANGED = 5
+BALANCE_CHANGED = 6
+NOTE_ADDED = 7
+NOTE_REMOVED = 8
+MONTH_ADVANCED = 9
+OBLIGATION_RECORDED = 10
+OBLIGATIONS_SETTLED = 11
+INTERBANK_POSITION_CHANGED = 12
+# Marks the end of a group of records that belong to a single bank operation.
+COMMIT = 13
+DEVICES_REVOKED = 14
+REMITTANCE_SENT = 15
+REMITTANCE_ACKNOWLEDGED = 16
+REMITTANCE_RECEIVED = 17
+
+# Sync policies.
+SYNC_ALWAYS = 'always'
+SYNC_BATCH = 'batch'
+SYNC_NEVER = 'never'
+
+RECORD_HEADER = struct.Struct('<BI')
+RECORD_CHECKSUM = struct.Struct('<I')
+
+
+class Journal(BankStorage):
+    """An append-only binary journal. Every record is framed by its type, its
+       length and a CRC-32 checksum. The records produced by one bank
+       operation form a group that ends in a COMMIT record; replay only
+       applies complete groups, so a torn write at the end of the journal
+       loses at most the operations that were not committed yet.
+
+       The sync policy decides when committed groups reach the disk:
+         * SYNC_ALWAYS writes and fsyncs every group as it is committed,
+         * SYNC_BATCH holds committed groups back until `group_size` of
+           them are pending or the oldest one has waited `group_delay`
+           seconds, and then writes and fsyncs them together; a timer
+           flushes the pending groups if no further commit comes along,
+         * SYNC_NEVER writes every group as it is committed, but leaves
+           flushing to disk to the operating system."""
+
+    def __init__(self, path, sync_policy=SYNC_ALWAYS, group_size=64, group_delay=0.01):
+        """Opens (or creates) the journal at a particular path for appending."""
+        if sync_policy not in (SYNC_ALWAYS, SYNC_BATCH, SYNC_NEVER):
+            raise ValueError('Unknown sync policy %r.' % sync_policy)
+        self.path = path
+        self.sync_policy = sync_policy
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.file = open(path, 'ab')
+        self.uncommitted = []
+        self.committed = []
+        self.committed_groups = 0
+        self.oldest_commit_time = None
+        # Guards the committed groups, which the flush timer writes from its own thread.
+        self.lock = threading.RLock()
+        self.flush_timer = None
+
+    @property
+    def position(self):
+        """Gets the offset just past the last record that has been written."""
+        return self.file.tell()
+
+    def append(self, record_type, payload=b''):
+        """Adds a record to the group of the current operation."""
+        header = RECORD_HEADER.pack(record_type, len(payload))
+        checksum = RECORD_CHECKSUM.pack(zlib.crc32(payload, zlib.crc32(header)))
+        self.uncommitted.append(header + payload + checksum)
+
+    def commit(self):
+        """Ends the group of the current operation and, depending on the sync
+           policy, writes it to disk."""
+        if not self.uncommitted:
+            return
+        self.append(COMMIT)
+        with self.lock:
+            self.committed.extend(self.uncommitted)
+            self.uncommitted = []
+            self.committed_groups += 1
+            if self.oldest_commit_time is None:
+                self.oldest_commit_time = time.monotonic()
+
+            if self.sync_policy != SYNC_BATCH or \
+                    self.committed_groups >= self.group_size or \
+                    time.monotonic() - self.oldest_commit_time >= self.group_delay:
+                self.flush()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.group_delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """Writes all committed groups to the journal file and, unless the
+           sync policy is SYNC_NEVER, forces them to disk."""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.committed and not self.file.closed:
+                self.file.write(b''.join(self.committed))
+                self.committed = []
+                self.committed_groups = 0
+                self.oldest_commit_time = None
+                self.file.flush()
+                if self.sync_policy != SYNC_NEVER:
+                    os.fsync(self.file.fileno())
+
+    def close(self):
+        """Commits and flushes all pending records and closes the journal."""
+        self.commit()
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+    def read_groups(self, offset=0):
+        """Reads the complete groups of records that start at a particular
+           offset. Returns a list of groups, each of which is a list of
+           (record type, payload) pairs, and the offset just past the last
+           complete group."""
+        with open(self.path, 'rb') as journal_file:
+            journal_file.seek(offset)
+            data = memoryview(journal_file.read())
+
+        groups = []
+        group = []
+        position = 0
+        end = 0
+        while position + RECORD_HEADER.size <= len(data):
+            record_type, length = RECORD_HEADER.unpack_from(data, position)
+            payload_end = position + RECORD_HEADER.size + length
+            if payload_end + RECORD_CHECKSUM.size > len(data):
+                break
+            checksum, = RECORD_CHECKSUM.unpack_from(data, payload_end)
+            if checksum != zlib.crc32(data[position:payload_end]):
+                break
+            position = payload_end + RECORD_CHECKSUM.size
+            if record_type == COMMIT:
+                groups.append(group)
+                group = []
+                end = position
+            else:
+                group.append((record_type, data[payload_end - length:payload_end]))
+        return groups, offset + end
+
+    def replay(self, bank, offset=0):
+        """Applies the complete groups of records that start at a particular
+           offset to a bank, drops a torn tail, if any, and attaches this
+           journal to the bank. The bank should be freshly created (or
+           freshly restored from a snapshot that was taken at `offset`)."""
+        groups, end = self.read_groups(offset)
+        replayer = JournalReplayer(bank)
+        for group in groups:
+            for record_type, payload in group:
+                replayer.apply(record_type, payload)
+        if end < os.path.getsize(self.path):
+            self.file.flush()
+            os.ftruncate(self.file.fileno(), end)
+            # Truncating does not move the file position, which `position` reports.
+            self.file.seek(end)
+        bank.attach_storage(self)
+        return len(groups)
+
+    # The methods below encode a bank's state changes as records.
+
+    def account_added(self, account):
+        self.append(ACCOUNT_ADDED, struct.pack('<Iqq', account.identifier, account.max_credit, account.balance) +
+                    account.owner.name.encode('utf8'))
+
+    def device_added(self, account, device):
+        self.append(DEVICE_ADDED, struct.pack('<Iqq', account.identifier, device.cap, device.monthly_cap) +
+                    device.public_key.export_key(format='DER'))
+
+    def checks_issued(self, device, checks):
+        self.append(CHECKS_ISSUED, key_fingerprint(device.public_key) +
+                    b''.join(struct.pack('<QII', check.identifier, check.value, check.expiration_date.toordinal())
+                             for check in checks))
+
+    def check_spent(self, device, identifier):
+        self.append(CHECK_SPENT, key_fingerprint(device.public_key) + struct.pack('<Q', identifier))
+
+    def cap_changed(self, device):
+        self.append(CAP_CHANGED, key_fingerprint(device.public_key) + struct.pack('<qI', device._cap, device.cap_epoch))
+
+    def balance_changed(self, account, delta):
+        self.append(BALANCE_CHANGED, struct.pack('<Iq', account.identifier, delta))
+
+    def note_added(self, device, draft):
+        self.append(NOTE_ADDED, key_fingerprint(device.public_key) + draft.to_bytes())
+
+    def note_removed(self, device, draft):
+        self.append(NOTE_REMOVED, key_fingerprint(device.public_key) + draft.to_bytes())
+
+    def month_advanced(self, epoch):
+        self.append(MONTH_ADVANCED, struct.pack('<I', epoch))
+
+    def obligation_recorded(self, counterparty_id, seller_fingerprint, amount):
+        self.append(OBLIGATION_RECORDED, struct.pack('<Iq', counterparty_id, amount) + seller_fingerprint)
+
+    def obligations_settled(self, counterparty_id):
+        self.append(OBLIGATIONS_SETTLED, struct.pack('<I', counterparty_id))
+
+    def interbank_position_changed(self, counterparty_id, delta):
+        self.append(INTERBANK_POSITION_CHANGED, struct.pack('<Iq', counterparty_id, delta))
+
+    def devices_revoked(self, fingerprints):
+        self.append(DEVICES_REVOKED, b''.join(fingerprints))
+
+    def remittance_sent(self, remittance):
+        self.append(REMITTANCE_SENT, remittance.to_bytes())
+
+    def remittance_acknowledged(self, recipient_id, identifier):
+        self.append(REMITTANCE_ACKNOWLEDGED, struct.pack('<IQ', recipient_id, identifier))
+
+    def remittance_received(self, sender_id, identifier, received_through):
+        self.append(REMITTANCE_RECEIVED, struct.pack('<IQ', sender_id, identifier))
+
+
+class JournalReplayer(object):
+    """Applies journal records to a bank."""
+
+    def __init__(self, bank):
+        self.bank = bank
+
+    def __device(self, fingerprint):
+        fingerprint = bytes(fingerprint)
+        return self.bank.ahd_to_account[fingerprint].devices[fingerprint]
+
+    def apply(self, record_type, payload):
+        """Applies a single record to the bank."""
+        # Imported here because bank.py depends on the modules this one depends on.
+        from bank import Account, AccountDeviceData
+
+        bank = self.bank
+        if record_type == ACCOUNT_ADDED:
+            identifier, max_credit, balance = struct.unpack_from('<Iqq', payload)
+            account = Account(AccountOwner(str(payload[20:], 'utf8')), max_credit)
+            account.balance = balance
+            bank.add_account(account)
+            assert account.identifier == identifier
+        elif record_type == DEVICE_ADDED:
+            account_id, cap, monthly_cap = struct.unpack_from('<Iqq', payload)
+            device = AccountDeviceData(import_public_key(bytes(payload[20:])), cap, monthly_cap, bank.month)
+            bank.register_device(bank.accounts[account_id], device)
+        elif record_type == CHECKS_ISSUED:
+            device = self.__device(payload[:32])
+            for identifier, value, expiration_day in struct.iter_unpack('<QII', payload[32:]):
+                expiration_date = date.fromordinal(expiration_day)
+                device.unspent_checks.add(identifier, value, expiration_date)
+                device.check_counter = max(device.check_counter, identifier + 1)
+                bank.check_expiry.add(date.fromordinal(expiration_day + DAYS_VALID + 1), (device, identifier))
+        elif record_type == CHECK_SPENT:
+            identifier, = struct.unpack_from('<Q', payload, 32)
+            self.__device(payload[:32]).unspent_checks.spend(identifier)
+        elif record_type == CAP_CHANGED:
+            device = self.__device(payload[:32])
+            device._cap, device.cap_epoch = struct.unpack_from('<qI', payload, 32)
+        elif record_type == BALANCE_CHANGED:
+            account_id, delta = struct.unpack_from('<Iq', payload)
+            bank.accounts[account_id].balance += delta
+        elif record_type == NOTE_ADDED:
+            device = self.__device(payload[:32])
+            draft = PromissoryNoteDraft.from_bytes(payload[32:])
+            device.add_awaiting_claim(draft)
+            bank.note_expiry.add(draft.transaction_date + timedelta(DAYS_VALID + 1), (device, draft))
+        elif record_type == NOTE_REMOVED:
+            self.__device(payload[:32]).discard_awaiting_claim(PromissoryNoteDraft.from_bytes(payload[32:]))
+        elif record_type == MONTH_ADVANCED:
+            bank.month.epoch, = struct.unpack_from('<I', payload)
+        elif record_type == OBLIGATION_RECORDED:
+            counterparty_id, amount = struct.unpack_from('<Iq', payload)
+            bank.settlement.record(counterparty_id, bytes(payload[12:]), amount)
+        elif record_type == OBLIGATIONS_SETTLED:
+            counterparty_id, = struct.unpack_from('<I', payload)
+            bank.settlement.take(counterparty_id)
+        elif record_type == INTERBANK_POSITION_CHANGED:
+            counterparty_id, delta = struct.unpack_from('<Iq', payload)
+            bank.interbank_position[counterparty_id] += delta
+        elif record_type == DEVICES_REVOKED:
+            bank.revocations.revoke([bytes(payload[offset:offset + 32]) for offset in range(0, len(payload), 32)])
+        elif record_type == REMITTANCE_SENT:
+            bank.remittances.add_pending(Remittance.from_bytes(payload)[0])
+        elif record_type == REMITTANCE_ACKNOWLEDGED:
+            bank.remittances.acknowledge(*struct.unpack_from('<IQ', payload))
+        elif record_type == REMITTANCE_RECEIVED:
+            bank.remittances.receive(*struct.unpack_from('<IQ', payload))
+        else:
+            raise ValueError('Unknown journal record type %d.' % record_type)
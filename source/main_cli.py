@@ -353,7 +353,9 @@ class MainPrompt(Cmd):
             self._get_choice_("ahd", self.ahds(), "Which account holder device is the buyer?")
 
         try:
-            if not seller_device.cert.validate(seller_device.public_key.export_key(format='PEM'), seller_device.get_bank_public_key(seller_device.cert.bankID)):
+            bank_id = seller_device.cert.bankID
+            if not seller_device.cert.validate(seller_device.public_key, seller_device.get_bank_verifier(bank_id),
+                                               seller_device.get_revocation_list(bank_id)):
                 raise ValueError("Invalid certificate")
             else:
                 print("Validated certificate\n\n")
@@ -371,10 +373,10 @@ class MainPrompt(Cmd):
             buyer_device.add_payment(draft)
             print("CHECKS SUCCESSFULLY ADDED:\n{}\n".format(draft))
             # Sign it
-            note = PromissoryNote(draft.to_bytes())
-            note = PromissoryNote.from_bytes(PromissoryNote.sign_seller(note.to_bytes(), seller_device.private_key))
+            note = PromissoryNote.from_draft(draft)
+            note.sign_as_seller(seller_device.signer)
             print("UNSIGNED PROMISSORY NOTE SUCCESSFULLY SIGNED BY SELLER:\n{}\n".format(note))
-            note = PromissoryNote.from_bytes(PromissoryNote.sign_buyer(note.to_bytes(), buyer_device.private_key))
+            note.sign_as_buyer(buyer_device.signer)
             print("PARTIALLY-SIGNED PROMISSORY NOTE SUCCESSFULLY SIGNED BY BUYER:\n{}\n".format(note))
             self.promissory_notes[note] = (seller_device, buyer_device)
             return note
@@ -0,0 +1,82 @@
+"""Merkle trees over the bodies of checks, which let a bank sign a whole
+   checkbook with a single signature."""
+
+from Crypto.Hash import SHA3_256
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(data):
+    """Hashes a leaf of a Merkle tree."""
+    return SHA3_256.new(LEAF_PREFIX + data).digest()
+
+
+def node_hash(left, right):
+    """Hashes an interior node of a Merkle tree from its children."""
+    return SHA3_256.new(NODE_PREFIX + left + right).digest()
+
+
+class MerkleProof(object):
+    """A proof that a leaf is included in a Merkle tree. A level with an odd
+       number of nodes promotes its last node unchanged, so the proof only
+       holds a sibling for the levels where the leaf's ancestor has one."""
+
+    def __init__(self, index, leaf_count, siblings):
+        """Creates a proof from the leaf's index, the number of leaves in
+           the tree and the siblings of the leaf's ancestors, bottom-up."""
+        self.index = index
+        self.leaf_count = leaf_count
+        self.siblings = siblings
+
+    def __eq__(self, other):
+        return isinstance(other, MerkleProof) and \
+            (self.index, self.leaf_count, self.siblings) == (other.index, other.leaf_count, other.siblings)
+
+    def __hash__(self):
+        return hash((self.index, self.leaf_count, tuple(self.siblings)))
+
+    def root(self, leaf):
+        """Computes the root of the tree from the hash of the leaf this proof
+           is for. Returns None if the proof is malformed."""
+        if not 0 <= self.index < self.leaf_count:
+            return None
+        node = leaf
+        index = self.index
+        level_size = self.leaf_count
+        siblings = iter(self.siblings)
+        while level_size > 1:
+            if index % 2 == 1:
+                node = node_hash(next(siblings, b''), node)
+            elif index + 1 < level_size:
+                node = node_hash(node, next(siblings, b''))
+            index //= 2
+            level_size = (level_size + 1) // 2
+        if next(siblings, None) is not None:
+            return None
+        return node
+
+
+def build_tree(leaves):
+    """Builds a Merkle tree over a nonempty list of leaf hashes. Returns
+       the root and a proof of inclusion for every leaf."""
+    assert leaves
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        levels.append(parents)
+
+    proofs = []
+    for leaf_index in range(len(leaves)):
+        siblings = []
+        index = leaf_index
+        for level in levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                siblings.append(level[sibling])
+            index //= 2
+        proofs.append(MerkleProof(leaf_index, len(leaves), siblings))
+    return levels[-1][0], proofs
@@ -1,32 +1,235 @@
 """Introduces the notions of a check, a promissory note draft and a promissory note."""
 
 import json
+import os
 import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from Crypto.Hash import SHA3_256
-from Crypto.Signature import DSS
 from Crypto.PublicKey import ECC
 from datetime import date, datetime, timedelta
 
+from cache import LRUCache, new_cache
+from merkle import MerkleProof, build_tree, leaf_hash
+from signature_suites import signature_scheme, suite_for_key, suite_for_point
+
 DAYS_VALID = 10
 CHECK_EXPIRATION = 100
+PUBLIC_KEY_CACHE_CAPACITY = 4096
+VERIFICATION_CACHE_CAPACITY = 65536
+
+# The versions of the wire format. Version 1 embeds PEM keys and date strings
+# in every check; version 2 uses compressed points, day numbers, a note-level
+# key table and 64-bit identifiers. New checks and drafts use WIRE_VERSION.
+WIRE_VERSION_1 = 1
+WIRE_VERSION_2 = 2
+WIRE_VERSION = WIRE_VERSION_2
+WIRE_MAGIC_V2 = b'ECB\x02'
+# A version 1 check starts with its bank id, so the bank id that is encoded as
+# the version 2 marker is reserved: no bank may use it.
+RESERVED_BANK_ID, = struct.unpack('<I', WIRE_MAGIC_V2)
+
+# The fixed-size fields of version 2 encodings:
+#   * a check's bank id, value, identifier and expiration day,
+#   * a draft's identifier, value and transaction day,
+#   * a check in a draft: its wire version, the index of its owner's key in
+#     the draft's key table, its bank id, value, identifier, expiration day
+#     and the amount assigned to it.
+V2_CHECK_FIELDS = struct.Struct('<IIQI')
+V2_DRAFT_FIELDS = struct.Struct('<QII')
+V2_DRAFT_CHECK_FIELDS = struct.Struct('<BHIIQII')
+# The number of keys in a version 2 draft's key table.
+KEY_COUNT = struct.Struct('<H')
+
+# Public keys that have been decoded recently, keyed by their encoding.
+public_key_cache = LRUCache(PUBLIC_KEY_CACHE_CAPACITY)
+
+# The outcomes of recent signature verifications, keyed by a digest of
+# the signer's key fingerprint, the message digest and the signature.
+verification_cache = new_cache(VERIFICATION_CACHE_CAPACITY)
+
+
+def configure_verification_cache(capacity=VERIFICATION_CACHE_CAPACITY, policy='lru'):
+    """Replaces the process-wide signature verification cache by an empty
+       cache with a particular capacity and eviction policy ('lru' or 'fifo').
+       A capacity of zero disables caching."""
+    global verification_cache
+    verification_cache = new_cache(capacity, policy)
+
+
+def import_public_key(encoded_key):
+    """Decodes a public key. Keys that were decoded recently are interned,
+       so decoding the same encoding twice returns the same key object."""
+    return public_key_cache.get_or_create(encoded_key, ECC.import_key)
+
+
+def import_key_point(point):
+    """Decodes a public key from its compact encoding. Like keys decoded by
+       `import_public_key`, the key is interned."""
+    point = bytes(point)
+    return public_key_cache.get_or_create(point, suite_for_point(point).import_point)
+
+
+def key_point(key):
+    """Gets the compact encoding of a public key, or of the public half of a
+       private key: the compressed point for ECDSA keys and the tagged raw
+       key for Ed25519 keys. The encoding is computed once per key object."""
+    point = getattr(key, '_compressed_point', None)
+    if point is None:
+        point = suite_for_key(key).encode_point(key)
+        key._compressed_point = point
+    return point
 
 
 def sign_DSS(message, private_key):
-    """Signs a particular message using a private key."""
-    h = SHA3_256.new(message)
-    signer = DSS.new(private_key, 'fips-186-3')
-    return signer.sign(h)
+    """Signs a particular message using a private key, with the signature
+       suite that the key belongs to."""
+    return as_signer(private_key).sign(message)
+
+
+def sign_DSS_with_encoded_key(message, encoded_private_key):
+    """Signs a particular message using an encoded private key."""
+    return sign_DSS(message, ECC.import_key(encoded_private_key))
+
+
+def sign_DSS_many(messages, private_key, workers=1):
+    """Signs a list of messages using a private key. The messages are
+       spread over a pool of `workers` processes (signed serially by default).
+       Returns the signatures in the same order as the messages."""
+    return as_signer(private_key).sign_many(messages, workers)
 
 
 def verify_DSS(message, signature, public_key):
-    """Verifies that a signature of a particular message is authentic."""
-    h = SHA3_256.new(message)
-    verifier = DSS.new(public_key, 'fips-186-3')
-    try:
-        verifier.verify(h, signature)
-        return True
-    except ValueError:
-        return False
+    """Verifies that a signature of a particular message is authentic.
+       Outcomes are remembered, so verifying the same signature of the
+       same message with the same key again does not redo the math."""
+    return as_verifier(public_key).verify(message, signature)
+
+
+class OperationTimings(object):
+    """Counts operations and the time spent on them, for profiling."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def record(self, count, seconds):
+        """Records that a number of operations took a number of seconds."""
+        self.count += count
+        self.seconds += seconds
+
+    @property
+    def seconds_per_operation(self):
+        """Gets the average time an operation took, or zero if none took place."""
+        return self.seconds / self.count if self.count else 0.0
+
+    def stats(self):
+        """Gets the timings as a dictionary."""
+        return {'count': self.count, 'seconds': self.seconds, 'seconds per operation': self.seconds_per_operation}
+
+
+class Signer(object):
+    """A long-lived signer that is bound to a private key. The signature
+       scheme is set up once, and the time spent signing is recorded."""
+
+    def __init__(self, private_key):
+        """Creates a signer for a private key."""
+        self.private_key = private_key
+        self.suite = suite_for_key(private_key)
+        self.scheme = signature_scheme(private_key)
+        self.timings = OperationTimings()
+
+    def sign(self, message):
+        """Signs a message."""
+        start = time.perf_counter()
+        signature = self.suite.sign(self.scheme, message)
+        self.timings.record(1, time.perf_counter() - start)
+        return signature
+
+    def sign_many(self, messages, workers=1):
+        """Signs a list of messages. The messages are signed serially by
+           default. If `workers` is greater than one (or None, for one per
+           core), they are spread over a pool of processes that is created
+           for this call and receives the private key. Returns the
+           signatures in the same order as the messages."""
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(messages) <= 1:
+            return [self.sign(message) for message in messages]
+
+        start = time.perf_counter()
+        sign = partial(sign_DSS_with_encoded_key, encoded_private_key=self.private_key.export_key(format='DER'))
+        chunk_size = max(1, len(messages) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            signatures = list(executor.map(sign, messages, chunksize=chunk_size))
+        self.timings.record(len(messages), time.perf_counter() - start)
+        return signatures
+
+    def stats(self):
+        """Gets the signer's timings."""
+        return self.timings.stats()
+
+
+class Verifier(object):
+    """A long-lived verifier that is bound to a public key. The signature
+       scheme is set up once, outcomes are looked up in the verification
+       cache first, and the time spent on verifications that missed the
+       cache is recorded."""
+
+    def __init__(self, public_key):
+        """Creates a verifier for a public key."""
+        self.public_key = public_key
+        self.suite = suite_for_key(public_key)
+        self.scheme = signature_scheme(public_key)
+        self.fingerprint = key_fingerprint(public_key)
+        self.timings = OperationTimings()
+        self.cache_hits = 0
+
+    def verify(self, message, signature):
+        """Verifies that a signature of a message is authentic."""
+        cache_key = SHA3_256.new(self.fingerprint + SHA3_256.new(message).digest() + signature).digest()
+        result = verification_cache.get(cache_key)
+        if result is None:
+            start = time.perf_counter()
+            result = self.suite.verify(self.scheme, message, signature)
+            self.timings.record(1, time.perf_counter() - start)
+            verification_cache.put(cache_key, result)
+        else:
+            self.cache_hits += 1
+        return result
+
+    def verify_many(self, messages, signatures):
+        """Verifies a list of signatures of a list of messages. Returns a
+           Boolean for every signature, in order."""
+        return [self.verify(message, signature) for message, signature in zip(messages, signatures)]
+
+    def stats(self):
+        """Gets the verifier's timings and its number of cache hits."""
+        stats = self.timings.stats()
+        stats['cache hits'] = self.cache_hits
+        return stats
+
+
+def as_signer(signer):
+    """Gets a signer for a private key. Signers are passed through."""
+    return signer if isinstance(signer, Signer) else Signer(signer)
+
+
+def as_verifier(verifier):
+    """Gets a verifier for a public key. Verifiers are passed through."""
+    return verifier if isinstance(verifier, Verifier) else Verifier(verifier)
+
+
+def key_fingerprint(key):
+    """Gets a 32-byte fingerprint that identifies a public key, or the
+       public half of a private key. The fingerprint is the SHA3-256 digest
+       of the key's compact encoding and is computed once per key object."""
+    fingerprint = getattr(key, '_fingerprint', None)
+    if fingerprint is None:
+        fingerprint = SHA3_256.new(key_point(key)).digest()
+        key._fingerprint = fingerprint
+    return fingerprint
 
 
 def uint32_to_bytes(value):
@@ -35,10 +238,17 @@ def uint32_to_bytes(value):
 
 
 def uint64_to_bytes(value):
-    """Encodes a 64-bit unsigned integer as a byte string."""
+    """Encodes a 64-bit unsigned integer as a byte string. Version 1 of the
+       wire format uses this encoding, which only holds 32 bits."""
     return struct.pack('<L', value)
 
 
+def short_bytestring_to_bytes(value):
+    """Encodes a byte string of at most 255 bytes as a sequence of bytes
+       that is prefixed by a single length byte."""
+    return struct.pack('<B', len(value)) + value
+
+
 def string_to_bytes(value):
     """Encodes a string as a length-prefixed UTF-8 encoded sequence of bytes."""
     return bytestring_to_bytes(value.encode('utf8'))
@@ -83,6 +293,74 @@ def string_from_bytes(value):
     return bytestr.decode('utf8'), remainder
 
 
+class ByteReader(object):
+    """A cursor over a byte string that decodes the same fields as the
+       `*_from_bytes` helpers, but advances an offset into a memoryview
+       instead of slicing off the remainder of the byte string. Decoding
+       a value hence never copies the bytes that follow it."""
+
+    def __init__(self, source):
+        """Creates a reader that starts at the beginning of a byte string,
+           a bytearray or a memoryview."""
+        self.view = memoryview(source)
+        self.offset = 0
+
+    @property
+    def remaining(self):
+        """Gets the number of bytes that have not been read yet."""
+        return len(self.view) - self.offset
+
+    def __bool__(self):
+        """Tests if there are bytes left to read."""
+        return self.offset < len(self.view)
+
+    def __unpack(self, fmt):
+        result, = struct.unpack_from(fmt, self.view, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return result
+
+    def read_uint32(self):
+        """Reads a 32-bit unsigned integer."""
+        return self.__unpack('<I')
+
+    def read_uint64(self):
+        """Reads an integer in the format produced by `uint64_to_bytes`."""
+        return self.__unpack('<L')
+
+    def read_struct(self, record):
+        """Reads the fields of a record described by a `struct.Struct`."""
+        result = record.unpack_from(self.view, self.offset)
+        self.offset += record.size
+        return result
+
+    def read_view(self):
+        """Reads a length-prefixed sequence of bytes and returns it as a
+           memoryview on the underlying buffer, that is, without copying it."""
+        return self.read_fixed_view(self.read_uint32())
+
+    def read_short_view(self):
+        """Reads a sequence of bytes that is prefixed by a single length byte."""
+        return self.read_fixed_view(self.__unpack('<B'))
+
+    def read_fixed_view(self, length):
+        """Reads a sequence of bytes of a known length and returns it as a
+           memoryview on the underlying buffer."""
+        end = self.offset + length
+        if end > len(self.view):
+            raise ValueError('Field runs past the end of the buffer.')
+        result = self.view[self.offset:end]
+        self.offset = end
+        return result
+
+    def read_bytestring(self):
+        """Reads a length-prefixed sequence of bytes."""
+        return bytes(self.read_view())
+
+    def read_string(self):
+        """Reads a length-prefixed UTF-8 encoded string."""
+        return str(self.read_view(), 'utf8')
+
+
 class Serializable(object):
     """A base class for objects that can be encoded and decoded again."""
 
@@ -94,8 +372,19 @@ class Serializable(object):
         raise NotImplementedError
 
 
+def checkbook_root_to_bytes(root, leaf_count):
+    """Encodes the root of a checkbook's Merkle tree as the message that
+       the bank signs for the checkbook."""
+    return b'checkbook' + uint32_to_bytes(leaf_count) + root
+
+
 class Check(Serializable):
-    """A check that is signed by the bank."""
+    """A check that is signed by the bank. The bank either signs the check
+       itself, or it signs the root of a Merkle tree over a batch of checks
+       (a checkbook), in which case the check carries the tree's root
+       signature and a proof that it is included in the tree. A check is
+       signed in the wire format of its version and keeps that version when
+       it is encoded again, so its signature stays valid."""
 
     def __init__(self,
                  bank_id,
@@ -103,27 +392,38 @@ class Check(Serializable):
                  value,
                  identifier,
                  signature=b'',
-                 expiration_date=None):
+                 expiration_date=None,
+                 proof=None,
+                 version=WIRE_VERSION):
         """Creates a check from a bank id, the public key of the account holder
            for which the check is issued, the max value of the check, an
-           identifier for the check and a signature."""
+           identifier for the check, a signature, for checks that belong to a
+           checkbook, a Merkle proof and the version of the wire format."""
+        if bank_id == RESERVED_BANK_ID:
+            raise ValueError('Bank id %d is reserved.' % bank_id)
+        self.version = version
         self.bank_id = bank_id
         self.owner_public_key = owner_public_key
         self.value = value
         self.identifier = identifier
         self.signature = signature
+        self.proof = proof
         if expiration_date is None:
             self.expiration_date = date.today() + timedelta(CHECK_EXPIRATION)
         else:
             self.expiration_date = expiration_date
 
+    def __identity(self):
+        return (self.version, self.bank_id, key_fingerprint(self.owner_public_key), self.value,
+                self.identifier, self.signature, self.expiration_date, self.proof)
+
     def __eq__(self, other):
         """Tests if this check equals another check."""
-        return self.__getstate__() == other.__getstate__()
+        return isinstance(other, Check) and self.__identity() == other.__identity()
 
     def __hash__(self):
         """Computes a hash value for this check."""
-        return hash(frozenset(self.__getstate__().items()))
+        return hash(self.__identity())
 
     def __getstate__(self):
         """Retrieves the state of this object for serialization."""
@@ -134,42 +434,105 @@ class Check(Serializable):
             'value': self.value,
             'identifier': self.identifier,
             'signature': self.signature,
-            'expiration_date': self.expiration_date.strftime('%d%m%Y')
+            'expiration_date': self.expiration_date.strftime('%d%m%Y'),
+            'proof': self.__get_proof_bytes(),
+            'version': self.version
         }
 
     def __setstate__(self, state):
         """Sets the state of this object for deserialization."""
         self.bank_id = state['bank_id']
-        self.owner_public_key = ECC.import_key(state['owner_public_key'])
+        self.owner_public_key = import_public_key(state['owner_public_key'])
         self.value = state['value']
         self.identifier = state['identifier']
         self.signature = state['signature']
         self.expiration_date = datetime.strptime(state['expiration_date'], '%d%m%Y').date()
+        proof = state.get('proof', b'')
+        self.proof = Check.__read_proof(ByteReader(proof)) if proof else None
+        self.version = state.get('version', WIRE_VERSION_1)
+
+    def __get_proof_bytes(self):
+        if self.proof is None:
+            return b''
+        return uint32_to_bytes(self.proof.index) + \
+            uint32_to_bytes(self.proof.leaf_count) + \
+            uint32_to_bytes(len(self.proof.siblings)) + \
+            b''.join(bytestring_to_bytes(sibling) for sibling in self.proof.siblings)
+
+    @staticmethod
+    def __read_proof(reader):
+        index = reader.read_uint32()
+        leaf_count = reader.read_uint32()
+        sibling_count = reader.read_uint32()
+        siblings = [reader.read_bytestring() for _ in range(sibling_count)]
+        return MerkleProof(index, leaf_count, siblings)
 
     def __get_unsigned_bytes(self):
-        return uint32_to_bytes(self.bank_id) + \
-               string_to_bytes(self.owner_public_key.export_key(format='PEM')) + \
-               uint32_to_bytes(self.value) + \
-               uint64_to_bytes(self.identifier) + \
-               string_to_bytes(self.expiration_date.strftime('%d%m%Y'))
+        if self.version == WIRE_VERSION_1:
+            return uint32_to_bytes(self.bank_id) + \
+                   string_to_bytes(self.owner_public_key.export_key(format='PEM')) + \
+                   uint32_to_bytes(self.value) + \
+                   uint64_to_bytes(self.identifier) + \
+                   string_to_bytes(self.expiration_date.strftime('%d%m%Y'))
+
+        return WIRE_MAGIC_V2 + \
+            short_bytestring_to_bytes(key_point(self.owner_public_key)) + \
+            V2_CHECK_FIELDS.pack(self.bank_id, self.value, self.identifier, self.expiration_date.toordinal())
 
     def to_bytes(self):
-        """Produces a byte string that represents this check."""
+        """Produces a byte string that represents this check. The Merkle proof
+           of a check that belongs to a checkbook trails the signature."""
         return self.__get_unsigned_bytes() + bytestring_to_bytes(
-            self.signature)
+            self.signature) + self.__get_proof_bytes()
+
+    def to_draft_entry_bytes(self, key_index, amount):
+        """Produces a byte string that represents this check, annotated with an
+           amount, in a version 2 draft. The owner's key is replaced by its
+           index in the draft's key table."""
+        return V2_DRAFT_CHECK_FIELDS.pack(self.version, key_index, self.bank_id, self.value, self.identifier,
+                                          self.expiration_date.toordinal(), amount) + \
+            bytestring_to_bytes(self.signature) + \
+            bytestring_to_bytes(self.__get_proof_bytes())
+
+    @staticmethod
+    def read_draft_entry(reader, keys):
+        """Reads a check and the amount assigned to it from a version 2 draft,
+           given the draft's key table."""
+        version, key_index, bank_id, value, identifier, expiration_day, amount = \
+            reader.read_struct(V2_DRAFT_CHECK_FIELDS)
+        if key_index >= len(keys):
+            raise ValueError('Check refers to a key that is not in the key table.')
+        signature = reader.read_bytestring()
+        proof = reader.read_view()
+        check = Check(bank_id, keys[key_index], value, identifier, signature, date.fromordinal(expiration_day),
+                      Check.__read_proof(ByteReader(proof)) if proof else None, version)
+        return check, amount
 
     @staticmethod
     def from_bytes(check_bytes):
-        """Reads a check from a byte string."""
-        bank_id, check_bytes = uint32_from_bytes(check_bytes)
-        owner_public_key, check_bytes = string_from_bytes(check_bytes)
-        value, check_bytes = uint32_from_bytes(check_bytes)
-        identifier, check_bytes = uint64_from_bytes(check_bytes)
-        expiration_date, check_bytes = string_from_bytes(check_bytes)
-        signature, check_bytes = bytestring_from_bytes(check_bytes)
+        """Reads a check from a byte string or a memoryview, in either
+           version of the wire format."""
+        reader = ByteReader(check_bytes)
+        if reader.view[:len(WIRE_MAGIC_V2)] == WIRE_MAGIC_V2:
+            reader.offset = len(WIRE_MAGIC_V2)
+            owner_public_key = import_key_point(reader.read_short_view())
+            bank_id, value, identifier, expiration_day = reader.read_struct(V2_CHECK_FIELDS)
+            signature = reader.read_bytestring()
+            proof = Check.__read_proof(reader) if reader else None
+            return Check(bank_id, owner_public_key, value, identifier, signature,
+                         date.fromordinal(expiration_day), proof, WIRE_VERSION_2)
+
+        bank_id = reader.read_uint32()
+        owner_public_key = reader.read_bytestring()
+        value = reader.read_uint32()
+        identifier = reader.read_uint64()
+        expiration_date = reader.read_string()
+        signature = reader.read_bytestring()
+        proof = Check.__read_proof(reader) if reader else None
         return Check(bank_id,
-                     ECC.import_key(owner_public_key), value, identifier,
-                     signature, datetime.strptime(expiration_date, '%d%m%Y').date())
+                     import_public_key(owner_public_key), value, identifier,
+                     signature, datetime.strptime(expiration_date, '%d%m%Y').date(),
+                     proof, WIRE_VERSION_1)
 
     @property
     def expired(self):
@@ -179,19 +542,55 @@ class Check(Serializable):
     @property
     def unredeemable(self):
         """Indicates if the check can no longer be redeemed by sellers."""
-        return date.today() > self.expiration_date + timedelta(DAYS_VALID)
+        return self.is_unredeemable_on(date.today())
+
+    def is_unredeemable_on(self, today):
+        """Indicates if the check can no longer be redeemed by sellers as of a particular date."""
+        return today > self.expiration_date + timedelta(DAYS_VALID)
 
     def is_signature_authentic(self, bank_public_key):
-        """Verifies the bank's signature. Returns a Boolean
-           that tells if the signature is authentic."""
-        return verify_DSS(self.__get_unsigned_bytes(), self.signature,
-                          bank_public_key)
+        """Verifies the bank's signature, given the bank's public key or a
+           verifier for it. Returns a Boolean
+           that tells if the signature is authentic. For a check that
+           belongs to a checkbook, the signature of the checkbook's root is
+           verified once and remembered by the verification cache, so only
+           the Merkle proof needs checking for the other checks."""
+        if self.proof is None:
+            return verify_DSS(self.__get_unsigned_bytes(), self.signature,
+                              bank_public_key)
+
+        root = self.proof.root(leaf_hash(self.__get_unsigned_bytes()))
+        if root is None:
+            return False
+        return verify_DSS(checkbook_root_to_bytes(root, self.proof.leaf_count),
+                          self.signature, bank_public_key)
 
     def sign(self, bank_private_key):
-        """Signs this check using the bank's private key."""
+        """Signs this check using the bank's private key or a signer for it."""
         self.signature = sign_DSS(self.__get_unsigned_bytes(),
                                   bank_private_key)
 
+    @staticmethod
+    def sign_many(checks, bank_private_key, workers=1):
+        """Signs a list of checks using the bank's private key or a signer for
+           it. The signatures are computed serially, or in parallel by
+           `workers` processes."""
+        signatures = as_signer(bank_private_key).sign_many([check.__get_unsigned_bytes() for check in checks],
+                                                           workers)
+        for check, signature in zip(checks, signatures):
+            check.signature = signature
+
+    @staticmethod
+    def sign_checkbook(checks, bank_private_key):
+        """Signs a nonempty list of checks as a single checkbook: the bank
+           signs the root of a Merkle tree over the checks' bodies and every
+           check receives that signature and its proof of inclusion."""
+        root, proofs = build_tree([leaf_hash(check.__get_unsigned_bytes()) for check in checks])
+        signature = sign_DSS(checkbook_root_to_bytes(root, len(checks)), bank_private_key)
+        for check, proof in zip(checks, proofs):
+            check.signature = signature
+            check.proof = proof
+
     def to_json(self):
         return {
             'Identifier': self.identifier,
@@ -207,10 +606,12 @@ class Check(Serializable):
 class PromissoryNoteDraft(Serializable):
     """A draft promissory note, that is the unsigned part of a promissory note."""
 
-    def __init__(self, seller_public_key, identifier, value, transaction_date=None):
+    def __init__(self, seller_public_key, identifier, value, transaction_date=None, version=WIRE_VERSION):
         """Creates a promissory note draft from a seller's public key,
            an identifier for the note and the total amount of money
-           transferred by the note."""
+           transferred by the note. The draft is encoded in a particular
+           version of the wire format."""
+        self.version = version
         self.seller_public_key = seller_public_key
         self.identifier = identifier
         self.value = value
@@ -220,7 +621,23 @@ class PromissoryNoteDraft(Serializable):
         else:
             self.transaction_date = transaction_date
 
+    def __identity(self):
+        return (key_fingerprint(self.seller_public_key), self.identifier, self.value, self.transaction_date)
+
+    def __eq__(self, other):
+        """Tests if this draft equals another draft. A seller numbers its drafts,
+           so two drafts are equal if they have the same seller and number and
+           agree on the value and transaction date."""
+        return isinstance(other, PromissoryNoteDraft) and self.__identity() == other.__identity()
+
+    def __hash__(self):
+        """Computes a hash value for this draft."""
+        return hash(self.__identity())
+
     def __get_unsigned_bytes(self):
+        if self.version != WIRE_VERSION_1:
+            return self.__get_unsigned_bytes_v2()
+
         unsigned = string_to_bytes(self.seller_public_key.export_key(format='PEM')) + \
                    uint64_to_bytes(self.identifier) + \
                    uint32_to_bytes(self.value) + \
@@ -231,22 +648,54 @@ class PromissoryNoteDraft(Serializable):
 
         return unsigned
 
+    def __get_unsigned_bytes_v2(self):
+        # Every distinct check owner key is encoded once, in a key table.
+        key_indices = {}
+        keys = []
+        entries = []
+        for check, amount in self.checks:
+            fingerprint = key_fingerprint(check.owner_public_key)
+            key_index = key_indices.get(fingerprint)
+            if key_index is None:
+                key_index = key_indices[fingerprint] = len(keys)
+                keys.append(short_bytestring_to_bytes(key_point(check.owner_public_key)))
+            entries.append(check.to_draft_entry_bytes(key_index, amount))
+
+        return WIRE_MAGIC_V2 + \
+            short_bytestring_to_bytes(key_point(self.seller_public_key)) + \
+            V2_DRAFT_FIELDS.pack(self.identifier, self.value, self.transaction_date.toordinal()) + \
+            KEY_COUNT.pack(len(keys)) + b''.join(keys) + b''.join(entries)
+
     def to_bytes(self):
         """Produces a byte string that represents this draft."""
         return self.__get_unsigned_bytes()
 
     @staticmethod
     def from_bytes(draft_bytes):
-        """Reads a draft from a byte string."""
-        seller_public_key, draft_bytes = string_from_bytes(draft_bytes)
-        identifier, draft_bytes = uint64_from_bytes(draft_bytes)
-        value, draft_bytes = uint32_from_bytes(draft_bytes)
-        transaction_date, draft_bytes = string_from_bytes(draft_bytes)
-        draft = PromissoryNoteDraft(ECC.import_key(seller_public_key), identifier, value, datetime.strptime(transaction_date, '%d%m%Y').date())
-        while draft_bytes:
-            check, draft_bytes = bytestring_from_bytes(draft_bytes)
-            amount, draft_bytes = uint32_from_bytes(draft_bytes)
-            draft.checks.append((Check.from_bytes(check), amount))
+        """Reads a draft from a byte string or a memoryview, in either
+           version of the wire format."""
+        reader = ByteReader(draft_bytes)
+        if reader.view[:len(WIRE_MAGIC_V2)] == WIRE_MAGIC_V2:
+            reader.offset = len(WIRE_MAGIC_V2)
+            seller_public_key = import_key_point(reader.read_short_view())
+            identifier, value, transaction_day = reader.read_struct(V2_DRAFT_FIELDS)
+            draft = PromissoryNoteDraft(seller_public_key, identifier, value, date.fromordinal(transaction_day),
+                                        WIRE_VERSION_2)
+            key_count, = reader.read_struct(KEY_COUNT)
+            keys = [import_key_point(reader.read_short_view()) for _ in range(key_count)]
+            while reader:
+                draft.checks.append(Check.read_draft_entry(reader, keys))
+            return draft
+
+        seller_public_key = reader.read_bytestring()
+        identifier = reader.read_uint64()
+        value = reader.read_uint32()
+        transaction_date = reader.read_string()
+        draft = PromissoryNoteDraft(import_public_key(seller_public_key), identifier, value, datetime.strptime(transaction_date, '%d%m%Y').date(), WIRE_VERSION_1)
+        while reader:
+            check = Check.from_bytes(reader.read_view())
+            amount = reader.read_uint32()
+            draft.checks.append((check, amount))
 
         return draft
 
@@ -260,12 +709,20 @@ class PromissoryNoteDraft(Serializable):
     def is_claimable(self):
         """Indicates if the note is still claimable (if its transaction date falls within
         a set amount of days of the current date)"""
-        return (date.today() - self.transaction_date).days <= DAYS_VALID
+        return self.is_claimable_on(date.today())
+
+    def is_claimable_on(self, today):
+        """Indicates if the note is still claimable as of a particular date."""
+        return (today - self.transaction_date).days <= DAYS_VALID
 
     @property
     def affects_monthly_cap(self):
         """Indicates whether the note's transaction date falls in the current month, and thus affects this month's running spending cap"""
-        return self.transaction_date.year == date.today().year and self.transaction_date.month == date.today().month
+        return self.affects_monthly_cap_on(date.today())
+
+    def affects_monthly_cap_on(self, today):
+        """Indicates whether the note's transaction date falls in the month of a particular date."""
+        return self.transaction_date.year == today.year and self.transaction_date.month == today.month
 
     def append_check(self, check, amount):
         """Adds a check to this promissory note draft and annotates it with
@@ -295,6 +752,26 @@ class PromissoryNote(Serializable):
         self.seller_signature = seller_signature
         self.buyer_signature = buyer_signature
 
+    @staticmethod
+    def from_draft(draft):
+        """Creates an unsigned promissory note from a draft. The draft is
+           encoded once and kept as the note's decoded draft, so it should not
+           be changed afterwards."""
+        note = PromissoryNote(draft.to_bytes())
+        note._draft = draft
+        return note
+
+    @property
+    def draft_bytes(self):
+        """Gets the encoded draft promissory note that is signed by this note."""
+        return self._draft_bytes
+
+    @draft_bytes.setter
+    def draft_bytes(self, value):
+        """Sets the encoded draft promissory note and invalidates the decoded draft."""
+        self._draft_bytes = value
+        self._draft = None
+
     def __get_unsigned_bytes(self):
         return bytestring_to_bytes(self.draft_bytes)
 
@@ -306,16 +783,20 @@ class PromissoryNote(Serializable):
     @staticmethod
     def from_bytes(note_bytes):
         """Reads a promissory note from a byte string."""
-        draft_bytes, note_bytes = bytestring_from_bytes(note_bytes)
-        seller_signature, note_bytes = bytestring_from_bytes(note_bytes)
-        buyer_signature, note_bytes = bytestring_from_bytes(note_bytes)
+        reader = ByteReader(note_bytes)
+        draft_bytes = reader.read_bytestring()
+        seller_signature = reader.read_bytestring()
+        buyer_signature = reader.read_bytestring()
         return PromissoryNote(draft_bytes, seller_signature, buyer_signature)
 
     @property
     def draft(self):
         """Gets the decoded draft promissory note at the heart of this
-           fully-signed promissory note."""
-        return PromissoryNoteDraft.from_bytes(self.draft_bytes)
+           fully-signed promissory note. The draft is decoded the first time
+           it is requested and reused until the draft bytes change."""
+        if self._draft is None:
+            self._draft = PromissoryNoteDraft.from_bytes(self.draft_bytes)
+        return self._draft
 
     @property
     def is_seller_signature_authentic(self):
@@ -327,7 +808,11 @@ class PromissoryNote(Serializable):
     @property
     def is_buyer_signature_authentic(self):
         """Verifies the buyer's signature. Returns a Boolean
-           that tells if the signature is authentic."""
+           that tells if the signature is authentic. The buyer is the owner
+           of the note's checks, so a note without checks has no authentic
+           buyer signature."""
+        if not self.draft.checks:
+            return False
         return verify_DSS(self.draft_bytes + self.seller_signature,
                           self.buyer_signature,
                           self.draft.checks[0][0].owner_public_key)
@@ -354,10 +839,10 @@ class PromissoryNote(Serializable):
     @staticmethod
     def sign_seller(note_bytes, private_key):
         """Signs a promissory note using the seller's private key
-        and returns the byte representation of the note."""
+        and returns the byte representation of the note. The draft is
+        signed as encoded, without decoding it."""
         note = PromissoryNote.from_bytes(note_bytes)
-        seller_signature = sign_DSS(note.draft.to_bytes(), private_key)
-        note.sign_with_seller_signature(seller_signature)
+        note.sign_as_seller(private_key)
         return note.to_bytes()
 
     @staticmethod
@@ -365,11 +850,19 @@ class PromissoryNote(Serializable):
         """Signs a promissory note using the buyer's private key
         and returns the byte representation of the note."""
         note = PromissoryNote.from_bytes(note_bytes)
-        buyer_signature = sign_DSS(
-            note.draft.to_bytes() + note.seller_signature, private_key)
-        note.sign_with_buyer_signature(buyer_signature)
+        note.sign_as_buyer(private_key)
         return note.to_bytes()
 
+    def sign_as_seller(self, private_key):
+        """Signs this promissory note's encoded draft using the seller's
+           private key or a signer for it."""
+        self.seller_signature = sign_DSS(self.draft_bytes, private_key)
+
+    def sign_as_buyer(self, private_key):
+        """Signs this promissory note's encoded draft and the seller's
+           signature using the buyer's private key or a signer for it."""
+        self.buyer_signature = sign_DSS(self.draft_bytes + self.seller_signature, private_key)
+
     def sign_with_seller_signature(self, seller_signature):
         """Sets the seller signature of this promissory note."""
         self.seller_signature = seller_signature
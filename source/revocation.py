@@ -0,0 +1,135 @@
+"""Lists of the device certificates that banks have revoked."""
+
+import struct
+
+from promissory_note import ByteReader, as_signer, as_verifier, bytestring_to_bytes, key_fingerprint
+
+REVOCATION_MAGIC = b'ECB\xd1'
+# A delta's bank id, the version it applies to and the version it produces.
+REVOCATION_DELTA_FIELDS = struct.Struct('<III')
+FINGERPRINT_SIZE = 32
+
+
+class RevocationDelta(object):
+    """The devices that a bank revoked between two versions of its revocation
+       list. A delta from version zero holds the complete list. Devices only
+       apply deltas that carry a valid signature of the bank."""
+
+    def __init__(self, bank_id, from_version, to_version, fingerprints, signature=b''):
+        """Creates a delta from a bank id, the version the delta applies to,
+           the version it produces and the key fingerprints of the devices
+           that were revoked in between. The delta is unsigned unless a
+           signature is given."""
+        self.bank_id = bank_id
+        self.from_version = from_version
+        self.to_version = to_version
+        self.fingerprints = fingerprints
+        self.signature = signature
+
+    def __get_unsigned_bytes(self):
+        return REVOCATION_MAGIC + \
+            REVOCATION_DELTA_FIELDS.pack(self.bank_id, self.from_version, self.to_version) + \
+            struct.pack('<I', len(self.fingerprints)) + b''.join(self.fingerprints)
+
+    def sign(self, signer):
+        """Signs this delta with a bank's private key or a signer for it.
+           Returns the delta."""
+        self.signature = as_signer(signer).sign(self.__get_unsigned_bytes())
+        return self
+
+    def is_signature_authentic(self, verifier):
+        """Tests if this delta was signed by a bank key (a key or a verifier)."""
+        return bool(self.signature) and as_verifier(verifier).verify(self.__get_unsigned_bytes(), self.signature)
+
+    def to_bytes(self):
+        """Produces a byte string that represents this delta."""
+        return self.__get_unsigned_bytes() + bytestring_to_bytes(self.signature)
+
+    @staticmethod
+    def from_bytes(delta_bytes):
+        """Reads a delta from a byte string or a memoryview."""
+        reader = ByteReader(delta_bytes)
+        if reader.read_fixed_view(len(REVOCATION_MAGIC)) != REVOCATION_MAGIC:
+            raise ValueError('Not a revocation list delta.')
+        bank_id, from_version, to_version = reader.read_struct(REVOCATION_DELTA_FIELDS)
+        count = reader.read_uint32()
+        fingerprints = reader.read_fixed_view(count * FINGERPRINT_SIZE)
+        return RevocationDelta(bank_id, from_version, to_version,
+                               [bytes(fingerprints[offset:offset + FINGERPRINT_SIZE])
+                                for offset in range(0, len(fingerprints), FINGERPRINT_SIZE)],
+                               reader.read_bytestring())
+
+
+class RevocationList(object):
+    """A versioned set of the key fingerprints of the devices whose
+       certificates a bank has revoked. Every revocation produces a new
+       version. Looking up a device is a single hash set lookup, regardless
+       of the size of the list, and devices keep their copy up to date by
+       applying deltas rather than downloading the whole list again."""
+
+    def __init__(self, bank_id):
+        """Creates an empty revocation list for a bank."""
+        self.bank_id = bank_id
+        self.version = 0
+        self.revoked = set()
+        # The revoked fingerprints in the order in which they were revoked,
+        # and for every version, the number of them that it includes.
+        self.history = []
+        self.version_offsets = [0]
+
+    def __len__(self):
+        """Gets the number of revoked devices."""
+        return len(self.revoked)
+
+    def __contains__(self, fingerprint):
+        """Tests if the device with a particular key fingerprint is revoked."""
+        return fingerprint in self.revoked
+
+    def is_revoked(self, public_key):
+        """Tests if the device with a particular public key is revoked."""
+        return key_fingerprint(public_key) in self.revoked
+
+    def __add(self, fingerprints):
+        for fingerprint in fingerprints:
+            if fingerprint not in self.revoked:
+                self.revoked.add(fingerprint)
+                self.history.append(fingerprint)
+
+    def revoke(self, fingerprints):
+        """Revokes the devices with particular key fingerprints. Returns the
+           new version of the list."""
+        self.__add(fingerprints)
+        self.version += 1
+        self.version_offsets.append(len(self.history))
+        return self.version
+
+    def delta_since(self, version):
+        """Gets the (unsigned) delta that brings a copy of this list at a
+           particular version up to date."""
+        if not 0 <= version <= self.version:
+            raise ValueError('Unknown revocation list version %d.' % version)
+        return RevocationDelta(self.bank_id, version, self.version, self.history[self.version_offsets[version]:])
+
+    def apply(self, delta, verifier):
+        """Brings this list up to date with a delta that was signed by the
+           bank's key (a key or a verifier). Deltas that this list has already
+           caught up with are ignored. Raises a ValueError if the delta
+           belongs to another bank, is not signed by the bank or if versions
+           are missing between this list and the delta."""
+        if delta.bank_id != self.bank_id:
+            raise ValueError('Revocation list delta belongs to another bank.')
+        if not delta.is_signature_authentic(verifier):
+            raise ValueError('Revocation list delta is not signed by the bank.')
+        if delta.to_version <= self.version:
+            return
+        if delta.from_version > self.version:
+            raise ValueError('Revocation list delta skips versions %d to %d.' % (self.version, delta.from_version))
+        # The delta does not tell in which version each device was revoked, so
+        # the intermediate versions are assumed to include none of them. The
+        # deltas this list hands out for those versions may hence repeat some
+        # revocations, but never miss one.
+        offset = len(self.history)
+        self.__add(delta.fingerprints)
+        self.version_offsets.extend(offset for _ in range(delta.to_version - self.version - 1))
+        self.version_offsets.append(len(self.history))
+        self.version = delta.to_version
@@ -0,0 +1,92 @@
+"""Runs a bank's housekeeping (expiry sweeps, month rollovers, settlement
+   and snapshots) off the request path, on a configurable cadence and
+   against a pluggable clock."""
+
+import threading
+
+from clock import SystemClock
+from snapshot import write_snapshot
+
+
+class BankScheduler(object):
+    """Periodically sweeps a bank's expired checks and notes, delivers the
+       remittances that other banks have not acknowledged yet, resets its
+       monthly spending caps when the clock enters a new month and, for banks
+       that net their interbank payments, runs a settlement cycle. It can
+       also write a snapshot of the bank every so many runs. Once a
+       scheduler is attached, the bank no longer sweeps on issuance and
+       takes the date from the scheduler's clock."""
+
+    def __init__(self, bank, clock=None, interval=60.0, snapshot_path=None, snapshot_every=60):
+        """Creates a scheduler for a bank that runs its housekeeping every
+           `interval` seconds, using a particular clock (the system clock by
+           default). If `snapshot_path` is set, a snapshot of the bank is
+           written there every `snapshot_every` runs."""
+        self.bank = bank
+        self.clock = SystemClock() if clock is None else clock
+        bank.clock = self.clock
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.run_count = 0
+        self.snapshot_count = 0
+        self.current_month = self.__month_of(self.clock.today())
+        self.sweep_count = 0
+        self.rollover_count = 0
+        self.settlement_count = 0
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        bank.inline_housekeeping = False
+
+    @staticmethod
+    def __month_of(day):
+        return day.year, day.month
+
+    @property
+    def running(self):
+        """Tells if the scheduler's background thread is running."""
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def run_pending(self):
+        """Performs the housekeeping that is due according to the clock: an
+           expiry sweep, a new attempt to deliver the remittances that were
+           not acknowledged, a settlement cycle if the bank nets its
+           interbank payments, a month rollover if the clock has entered a new month
+           since the last run and, if one is due, a snapshot."""
+        today = self.clock.today()
+        month = self.__month_of(today)
+        if month != self.current_month:
+            self.current_month = month
+            self.bank.reset_monthly_spending_caps()
+            self.rollover_count += 1
+        self.bank.sweep_expired(today)
+        self.sweep_count += 1
+        self.bank.deliver_pending_remittances()
+        if self.bank.net_settlement:
+            self.bank.settle()
+            self.settlement_count += 1
+        self.run_count += 1
+        if self.snapshot_path is not None and self.run_count % self.snapshot_every == 0:
+            write_snapshot(self.bank, self.snapshot_path)
+            self.snapshot_count += 1
+
+    def __run(self):
+        while not self.__stop_event.wait(self.interval):
+            self.run_pending()
+
+    def start(self):
+        """Starts running housekeeping on a background thread."""
+        if self.running:
+            return
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, name='bank-%s-housekeeping' % self.bank.identifier,
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the background thread and waits for it to finish."""
+        if self.__thread is None:
+            return
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
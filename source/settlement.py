@@ -0,0 +1,170 @@
+"""Netting of the payments that banks owe each other's account holders, and
+   the remittances that carry those payments from one bank to another."""
+
+import struct
+from collections import defaultdict
+
+# A remittance's sender, recipient, identifier, whether it settles
+# obligations and the number of credits in it.
+REMITTANCE_FIELDS = struct.Struct('<IIQBI')
+# A seller's key fingerprint and the amount credited to them.
+REMITTANCE_CREDIT = struct.Struct('<32sq')
+
+
+class SettlementLedger(object):
+    """Accumulates what a bank owes the account holders of other banks until
+       the next settlement cycle. Obligations are kept per counterparty bank
+       (identified by its bank id) and per seller device (identified by its
+       key fingerprint)."""
+
+    def __init__(self):
+        """Creates an empty settlement ledger."""
+        self.obligations = defaultdict(lambda: defaultdict(int))
+
+    def record(self, counterparty_id, seller_fingerprint, amount):
+        """Records that a seller served by a counterparty bank is owed an amount."""
+        self.obligations[counterparty_id][seller_fingerprint] += amount
+
+    def counterparties(self):
+        """Gets the ids of the banks towards which there are unsettled obligations."""
+        return list(self.obligations.keys())
+
+    def total_owed_to(self, counterparty_id):
+        """Gets the total amount owed to the sellers of a counterparty bank."""
+        return sum(self.obligations.get(counterparty_id, {}).values())
+
+    def take(self, counterparty_id):
+        """Removes the obligations towards a counterparty bank and returns
+           them as a dictionary that maps seller fingerprints to amounts."""
+        return dict(self.obligations.pop(counterparty_id, {}))
+
+
+class SettlementBatch(object):
+    """The result of settling the obligations between two banks."""
+
+    def __init__(self, bank, counterparty, outgoing, incoming):
+        """Creates a settlement batch from the credits that `bank` pays to the
+           sellers of `counterparty` and the credits that flow the other way."""
+        self.bank = bank
+        self.counterparty = counterparty
+        self.outgoing = outgoing
+        self.incoming = incoming
+
+    @property
+    def net_amount(self):
+        """Gets the net amount that `bank` pays `counterparty`. A negative
+           amount means that `counterparty` pays `bank`."""
+        return sum(self.outgoing.values()) - sum(self.incoming.values())
+
+    def to_json(self):
+        return {
+            'Bank': self.bank.identifier,
+            'Counterparty': self.counterparty.identifier,
+            'Outgoing': sum(self.outgoing.values()),
+            'Incoming': sum(self.incoming.values()),
+            'Net amount': self.net_amount
+        }
+
+
+class Remittance(object):
+    """Credits that one bank sends to the sellers served by another bank.
+       The sender records a remittance in the same operation that takes the
+       money from its own books and keeps it until the recipient has
+       acknowledged it. The recipient applies a remittance only once, so a
+       remittance can be delivered again after a crash without paying
+       anyone twice."""
+
+    def __init__(self, sender_id, recipient_id, identifier, credits, settles=False):
+        """Creates a remittance from the ids of the sending and receiving
+           banks, an identifier that counts the remittances from the sender
+           to the recipient, a dictionary that maps seller fingerprints to
+           amounts and whether it settles obligations between the banks,
+           which moves their interbank positions."""
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.identifier = identifier
+        self.credits = credits
+        self.settles = settles
+
+    @property
+    def total(self):
+        """Gets the total amount of this remittance."""
+        return sum(self.credits.values())
+
+    def to_bytes(self):
+        """Produces a byte string that represents this remittance."""
+        return REMITTANCE_FIELDS.pack(self.sender_id, self.recipient_id, self.identifier, self.settles,
+                                      len(self.credits)) + \
+            b''.join(REMITTANCE_CREDIT.pack(fingerprint, amount) for fingerprint, amount in self.credits.items())
+
+    @staticmethod
+    def from_bytes(buffer, offset=0):
+        """Reads a remittance that starts at a particular offset in a buffer.
+           Returns the remittance and the offset just past it."""
+        sender_id, recipient_id, identifier, settles, count = REMITTANCE_FIELDS.unpack_from(buffer, offset)
+        offset += REMITTANCE_FIELDS.size
+        credits = {}
+        for _ in range(count):
+            fingerprint, amount = REMITTANCE_CREDIT.unpack_from(buffer, offset)
+            credits[fingerprint] = amount
+            offset += REMITTANCE_CREDIT.size
+        return Remittance(sender_id, recipient_id, identifier, credits, bool(settles)), offset
+
+
+class RemittanceLedger(object):
+    """Tracks a bank's remittances: those it has sent that are still waiting
+       for their recipient to acknowledge them, and which of the remittances
+       sent to it it has applied. The remittances from a sender are numbered
+       consecutively, so the ledger only remembers the number up to which it
+       has applied all of them, plus those it has applied out of order."""
+
+    def __init__(self):
+        """Creates an empty remittance ledger."""
+        self.counters = defaultdict(int)
+        self.pending = {}
+        self.received_through = defaultdict(int)
+        self.received_ahead = defaultdict(set)
+
+    def create(self, sender_id, recipient_id, credits, settles=False):
+        """Creates the next remittance to a recipient bank and keeps it until
+           it is acknowledged."""
+        remittance = Remittance(sender_id, recipient_id, self.counters[recipient_id] + 1, credits, settles)
+        self.add_pending(remittance)
+        return remittance
+
+    def add_pending(self, remittance):
+        """Keeps a sent remittance until it is acknowledged."""
+        self.pending[remittance.recipient_id, remittance.identifier] = remittance
+        self.counters[remittance.recipient_id] = max(self.counters[remittance.recipient_id], remittance.identifier)
+
+    def acknowledge(self, recipient_id, identifier):
+        """Forgets a sent remittance that its recipient has applied. Returns
+           False if the remittance was not pending."""
+        return self.pending.pop((recipient_id, identifier), None) is not None
+
+    def pending_remittances(self):
+        """Gets the sent remittances that have not been acknowledged, in the
+           order in which they were sent to each recipient."""
+        return [self.pending[key] for key in sorted(self.pending)]
+
+    def is_received(self, sender_id, identifier):
+        """Tests if the remittance with a particular identifier from a sender
+           bank has been applied."""
+        return identifier <= self.received_through[sender_id] or identifier in self.received_ahead[sender_id]
+
+    def receive(self, sender_id, identifier):
+        """Records that the remittance with a particular identifier from a
+           sender bank has been applied. Returns the number up to which all
+           remittances from the sender have been applied."""
+        through = self.received_through[sender_id]
+        if identifier <= through:
+            return through
+        ahead = self.received_ahead[sender_id]
+        ahead.add(identifier)
+        while through + 1 in ahead:
+            through += 1
+            ahead.remove(through)
+        self.received_through[sender_id] = through
+        if not ahead:
+            del self.received_ahead[sender_id]
+        return through
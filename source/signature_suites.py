@@ -0,0 +1,150 @@
+"""The signature schemes that banks and account holder devices can sign with."""
+
+from Crypto.Hash import SHA3_256
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS, eddsa
+
+
+class SignatureSuite(object):
+    """A signature scheme together with the way its public keys are encoded
+       in the compact wire format. A key's suite follows from its curve, so
+       signing and verifying dispatch on the key."""
+
+    # The name of the suite.
+    name = None
+    # The curve of the suite's keys, as reported by `key.curve`.
+    curve = None
+
+    def generate_key(self):
+        """Generates a new private key."""
+        return ECC.generate(curve=self.curve)
+
+    def new_scheme(self, key):
+        """Creates a signature scheme object that signs or verifies with a key."""
+        raise NotImplementedError
+
+    def sign(self, scheme, message):
+        """Signs a message using a scheme object created by `new_scheme`."""
+        raise NotImplementedError
+
+    def verify(self, scheme, message, signature):
+        """Verifies a signature using a scheme object created by `new_scheme`.
+           Returns a Boolean that tells if the signature is authentic."""
+        raise NotImplementedError
+
+    def encode_point(self, key):
+        """Encodes the public half of a key compactly. The first byte of the
+           encoding identifies the suite."""
+        raise NotImplementedError
+
+    def import_point(self, point):
+        """Decodes a public key that was encoded by `encode_point`."""
+        raise NotImplementedError
+
+
+class ECDSASuite(SignatureSuite):
+    """ECDSA over NIST P-256 with SHA3-256 digests. Public keys are encoded
+       as compressed points, which start with 0x02 or 0x03."""
+
+    name = 'ecdsa-p256-sha3'
+    curve = 'NIST P-256'
+    point_prefixes = (0x02, 0x03)
+
+    def generate_key(self):
+        return ECC.generate(curve='P-256')
+
+    def new_scheme(self, key):
+        return DSS.new(key, 'fips-186-3')
+
+    def sign(self, scheme, message):
+        return scheme.sign(SHA3_256.new(message))
+
+    def verify(self, scheme, message, signature):
+        try:
+            scheme.verify(SHA3_256.new(message), signature)
+            return True
+        except ValueError:
+            return False
+
+    def encode_point(self, key):
+        return key.public_key().export_key(format='SEC1', compress=True)
+
+    def import_point(self, point):
+        return ECC.import_key(point, curve_name='P-256')
+
+
+class Ed25519Suite(SignatureSuite):
+    """Pure Ed25519 (RFC 8032). Signing and verifying are considerably
+       faster than with ECDSA over P-256. Public keys are encoded as 0xED
+       followed by the 32-byte key."""
+
+    name = 'ed25519'
+    curve = 'Ed25519'
+    point_prefixes = (0xED,)
+
+    def new_scheme(self, key):
+        return eddsa.new(key, 'rfc8032')
+
+    def sign(self, scheme, message):
+        return scheme.sign(message)
+
+    def verify(self, scheme, message, signature):
+        try:
+            scheme.verify(message, signature)
+            return True
+        except ValueError:
+            return False
+
+    def encode_point(self, key):
+        return bytes(self.point_prefixes) + key.public_key().export_key(format='raw')
+
+    def import_point(self, point):
+        return eddsa.import_public_key(bytes(point[1:]))
+
+
+ECDSA_P256 = ECDSASuite()
+ED25519 = Ed25519Suite()
+DEFAULT_SUITE = ECDSA_P256
+
+SUITES = {suite.name: suite for suite in (ECDSA_P256, ED25519)}
+SUITES_BY_CURVE = {suite.curve: suite for suite in SUITES.values()}
+SUITES_BY_POINT_PREFIX = {prefix: suite for suite in SUITES.values() for prefix in suite.point_prefixes}
+
+
+def get_suite(suite):
+    """Gets a signature suite by name. Suites themselves are passed through,
+       and None stands for the default suite."""
+    if suite is None:
+        return DEFAULT_SUITE
+    if isinstance(suite, SignatureSuite):
+        return suite
+    try:
+        return SUITES[suite]
+    except KeyError:
+        raise ValueError('Unknown signature suite %r.' % suite)
+
+
+def suite_for_key(key):
+    """Gets the signature suite that a key belongs to."""
+    try:
+        return SUITES_BY_CURVE[key.curve]
+    except KeyError:
+        raise ValueError('No signature suite for keys on curve %r.' % key.curve)
+
+
+def suite_for_point(point):
+    """Gets the signature suite of a compactly encoded public key."""
+    try:
+        return SUITES_BY_POINT_PREFIX[point[0]]
+    except (KeyError, IndexError):
+        raise ValueError('Unknown public key encoding.')
+
+
+def signature_scheme(key):
+    """Gets a signature scheme object for a key. The object is created once
+       per key object and reused for every signature."""
+    scheme = getattr(key, '_signature_scheme', None)
+    if scheme is None:
+        scheme = suite_for_key(key).new_scheme(key)
+        key._signature_scheme = scheme
+    return scheme
@@ -1,8 +1,15 @@
 """An implementation of the protocol for creating a fully signed promissory note."""
 
-from promissory_note import PromissoryNote
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-bank_repository = []
+from promissory_note import PromissoryNote, import_public_key, key_fingerprint
+
+# The errors that decoding or verifying a single promissory note can raise.
+# A batch reports them per note instead of giving up on the whole batch.
+NOTE_ERRORS = (ValueError, IndexError, struct.error)
 
 
 class OfflineException(Exception):
@@ -10,14 +17,78 @@ class OfflineException(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
+class BankDirectory(object):
+    """The registry of known banks. Banks can be looked up by identifier, by
+       public key and by the key of an account holder device they serve."""
+
+    def __init__(self):
+        """Creates an empty directory."""
+        self.banks = []
+        self.by_identifier = {}
+        self.by_public_key = {}
+        self.by_account_holder = {}
+
+    def is_registered(self, bank):
+        """Tests if a bank is registered with this directory."""
+        return self.by_public_key.get(key_fingerprint(bank.public_key)) is bank
+
+    def register(self, bank):
+        """Registers a bank, along with the account holder devices it already
+           serves. Raises a ValueError if another bank with the same
+           identifier is registered already."""
+        if bank.identifier in self.by_identifier:
+            raise ValueError('A bank with identifier %d is already registered.' % bank.identifier)
+        self.banks.append(bank)
+        self.by_identifier[bank.identifier] = bank
+        self.by_public_key[key_fingerprint(bank.public_key)] = bank
+        for fingerprint in bank.ahd_to_account:
+            self.by_account_holder.setdefault(fingerprint, bank)
+
+    def add_account_holder(self, bank, public_key):
+        """Records that a registered bank serves the account holder device with
+           a particular public key. The first bank that serves a device remains
+           its home bank."""
+        self.by_account_holder.setdefault(key_fingerprint(public_key), bank)
+
+    def clear(self):
+        """Forgets all registered banks."""
+        del self.banks[:]
+        self.by_identifier.clear()
+        self.by_public_key.clear()
+        self.by_account_holder.clear()
+
+    def get_by_identifier(self, identifier):
+        """Gets the bank with a particular identifier, or None if there is no such bank."""
+        return self.by_identifier.get(identifier)
+
+    def get_by_public_key(self, public_key):
+        """Gets the bank with a particular public key, or None if there is no such bank."""
+        return self.by_public_key.get(key_fingerprint(public_key))
+
+    def get_home_bank(self, account_holder_public_key):
+        """Gets the bank that serves the account holder device with a particular
+           public key, or None if no registered bank serves it."""
+        return self.by_account_holder.get(key_fingerprint(account_holder_public_key))
+
+
+bank_directory = BankDirectory()
+bank_repository = bank_directory.banks
+
+
 def register_bank(bank):
-    bank_repository.append(bank)
+    bank_directory.register(bank)
 
 
 def known_banks():
     return bank_repository
 
 
+def banks_for_keys(bank_keys):
+    """Gets the registered banks that have particular public keys."""
+    banks = (bank_directory.get_by_public_key(key) for key in bank_keys)
+    return [bank for bank in banks if bank is not None]
+
+
 def create_promissory_note(buyer_device, seller_device, amount):
     """Creates a fully signed promissory note for the transferral of
        a particular amount of money from one account holder (the "buyer")
@@ -28,16 +99,19 @@ def create_promissory_note(buyer_device, seller_device, amount):
     # Have the buyer attach checks to it.
     buyer_device.add_payment(draft)
 
-    # Sign the damn thing already.
-    note = PromissoryNote(draft.to_bytes())
-    note = PromissoryNote.from_bytes(PromissoryNote.sign_seller(note.to_bytes(), seller_device.private_key))
-    note = PromissoryNote.from_bytes(PromissoryNote.sign_buyer(note.to_bytes(), buyer_device.private_key))
+    # Sign the damn thing already. The draft is encoded once and both
+    # parties sign those exact bytes.
+    note = PromissoryNote.from_draft(draft)
+    note.sign_as_seller(seller_device.signer)
+    note.sign_as_buyer(buyer_device.signer)
 
     return note
 
 
-def verify_promissory_note(promissory_note):
-    """Verify the promissory note."""
+def verify_promissory_note(promissory_note, bank_keys=None):
+    """Verify the promissory note. If a dictionary that maps bank identifiers
+       to bank public keys is given, then the bank signature of every check
+       in the note is verified as well."""
     # Verify the signatures
     if not promissory_note.is_seller_signature_authentic:
         raise ValueError("The signature of the the seller is not authentic.")
@@ -55,6 +129,57 @@ def verify_promissory_note(promissory_note):
         raise ValueError("Some of the checks contained within the promissory note "
                          "list values exceeding their respective maximum values.")
 
+    # Verify the bank signatures on the checks
+    if bank_keys is not None:
+        for check, _ in promissory_note.draft.checks:
+            if check.bank_id not in bank_keys:
+                raise ValueError("Check %d was issued by unknown bank %d." % (check.identifier, check.bank_id))
+            if not check.is_signature_authentic(bank_keys[check.bank_id]):
+                raise ValueError("The signature of the bank on check %d is not authentic." % check.identifier)
+
+
+def verify_promissory_note_bytes(note_bytes, encoded_bank_keys=None):
+    """Decodes and verifies an encoded promissory note. Bank keys, if any,
+       are given in encoded form. Returns None if the note is valid and the
+       error that describes the problem otherwise."""
+    bank_keys = None
+    if encoded_bank_keys is not None:
+        bank_keys = {bank_id: import_public_key(key) for bank_id, key in encoded_bank_keys.items()}
+    try:
+        verify_promissory_note(PromissoryNote.from_bytes(note_bytes), bank_keys)
+        return None
+    except NOTE_ERRORS as e:
+        return e
+
+
+def verify_promissory_notes(promissory_notes, workers=None, bank_keys=None):
+    """Verifies a batch of promissory notes by spreading them over a pool of
+       `workers` processes (one per core by default). Returns a list that
+       holds, for every note in order, None if the note is valid and the
+       error that describes the problem otherwise. A note that cannot be
+       decoded or verified never affects the results for the others."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    encoded_bank_keys = None
+    if bank_keys is not None:
+        encoded_bank_keys = {bank_id: key.export_key(format='PEM') for bank_id, key in bank_keys.items()}
+
+    if workers <= 1 or len(promissory_notes) <= 1:
+        results = []
+        for note in promissory_notes:
+            try:
+                verify_promissory_note(note, bank_keys)
+                results.append(None)
+            except NOTE_ERRORS as e:
+                results.append(e)
+        return results
+
+    verify = partial(verify_promissory_note_bytes, encoded_bank_keys=encoded_bank_keys)
+    chunk_size = max(1, len(promissory_notes) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(verify, [note.to_bytes() for note in promissory_notes], chunksize=chunk_size))
+
 
 def transfer(promissory_note, buyer_device, seller_device):
     """Transfer a promissory note from a buyer device to the banks."""
@@ -64,7 +189,7 @@ def transfer(promissory_note, buyer_device, seller_device):
         raise OfflineException("Seller device is offline.")
 
     # Send it to the bank; well, all the banks...
-    for bank in filter(lambda b: b.public_key in buyer_device.bank_keys.values(), known_banks()):
+    for bank in banks_for_keys(buyer_device.bank_keys.values()):
         bank.redeem_promissory_note(promissory_note)
 
 
@@ -76,7 +201,7 @@ def hand_in(promissory_note, buyer_device):
         raise OfflineException("buyer device is offline.")
 
     # Send it to the bank; well, all the banks...
-    for bank in filter(lambda b: b.public_key in buyer_device.bank_keys.values(), known_banks()):
+    for bank in banks_for_keys(buyer_device.bank_keys.values()):
         bank.hand_in_promissory_note(promissory_note)
 
 
@@ -0,0 +1,195 @@
+"""Compact binary snapshots of a bank's state. A snapshot records the journal
+   position at which it was taken, so restoring a bank only needs to load the
+   snapshot and replay the tail of the journal."""
+
+import mmap
+import os
+import struct
+from datetime import date, timedelta
+
+from promissory_note import PromissoryNoteDraft, ByteReader, bytestring_to_bytes, import_public_key, DAYS_VALID
+from check_ledger import CheckLedger
+from journal import Journal
+from settlement import Remittance
+from storage import AccountOwner
+
+SNAPSHOT_MAGIC = b'ECBSNAP\x01'
+
+# The journal offset, the month epoch and the number of accounts.
+SNAPSHOT_HEADER = struct.Struct('<QII')
+# The maximum credit, the balance and the number of devices.
+ACCOUNT_HEADER = struct.Struct('<qqI')
+# The check counter, the cap, the cap's epoch, the monthly cap and the number
+# of notes awaiting claim.
+DEVICE_HEADER = struct.Struct('<QqIqI')
+# A counterparty bank id and a count or an amount.
+COUNTERPARTY_COUNT = struct.Struct('<II')
+COUNTERPARTY_AMOUNT = struct.Struct('<Iq')
+OBLIGATION = struct.Struct('<32sq')
+# A recipient bank id and the number of remittances sent to it.
+REMITTANCE_COUNTER = struct.Struct('<IQ')
+# A sender bank id, the number up to which all of its remittances were
+# applied and the number of remittances applied past that number.
+REMITTANCE_WINDOW = struct.Struct('<IQI')
+
+
+def snapshot_to_bytes(bank, journal_offset=0):
+    """Encodes the full state of a bank. The caller should hold the bank's lock."""
+    parts = [SNAPSHOT_MAGIC, SNAPSHOT_HEADER.pack(journal_offset, bank.month.epoch, len(bank.accounts))]
+    for account in bank.accounts:
+        parts.append(ACCOUNT_HEADER.pack(account.max_credit, account.balance, len(account.devices)))
+        parts.append(bytestring_to_bytes(account.owner.name.encode('utf8')))
+        for device in account.devices.values():
+            parts.append(bytestring_to_bytes(device.public_key.export_key(format='DER')))
+            parts.append(DEVICE_HEADER.pack(device.check_counter, device._cap, device.cap_epoch, device.monthly_cap,
+                                            len(device.awaiting_claim)))
+            parts.append(device.unspent_checks.to_bytes())
+            parts.extend(bytestring_to_bytes(draft.to_bytes()) for draft in device.awaiting_claim)
+
+    counterparties = bank.settlement.counterparties()
+    parts.append(struct.pack('<I', len(counterparties)))
+    for counterparty_id in counterparties:
+        obligations = bank.settlement.obligations[counterparty_id]
+        parts.append(COUNTERPARTY_COUNT.pack(counterparty_id, len(obligations)))
+        parts.extend(OBLIGATION.pack(fingerprint, amount) for fingerprint, amount in obligations.items())
+
+    parts.append(struct.pack('<I', len(bank.interbank_position)))
+    parts.extend(COUNTERPARTY_AMOUNT.pack(counterparty_id, position)
+                 for counterparty_id, position in bank.interbank_position.items())
+
+    # The revocation list, as the fingerprints revoked in every version.
+    revocations = bank.revocations
+    parts.append(struct.pack('<I', revocations.version))
+    for version in range(revocations.version):
+        revoked = revocations.history[revocations.version_offsets[version]:revocations.version_offsets[version + 1]]
+        parts.append(struct.pack('<I', len(revoked)))
+        parts.extend(revoked)
+
+    # The remittances that wait to be acknowledged, the number of remittances
+    # sent to every recipient and, for every sender, the remittances applied.
+    remittances = bank.remittances
+    pending = remittances.pending_remittances()
+    parts.append(struct.pack('<I', len(pending)))
+    parts.extend(remittance.to_bytes() for remittance in pending)
+    parts.append(struct.pack('<I', len(remittances.counters)))
+    parts.extend(REMITTANCE_COUNTER.pack(recipient_id, counter)
+                 for recipient_id, counter in remittances.counters.items())
+    senders = set(remittances.received_through) | set(remittances.received_ahead)
+    parts.append(struct.pack('<I', len(senders)))
+    for sender_id in senders:
+        ahead = sorted(remittances.received_ahead.get(sender_id, ()))
+        parts.append(REMITTANCE_WINDOW.pack(sender_id, remittances.received_through[sender_id], len(ahead)))
+        parts.extend(struct.pack('<Q', identifier) for identifier in ahead)
+    return b''.join(parts)
+
+
+def write_snapshot(bank, path):
+    """Writes a snapshot of a bank to a file. If the bank's storage backend is
+       a journal, the journal is flushed first and the snapshot records its
+       position. The snapshot is written to a temporary file that replaces
+       `path` once it is safely on disk, so a crash never leaves a partial
+       snapshot behind."""
+    with bank.lock:
+        journal_offset = 0
+        if isinstance(bank.storage, Journal):
+            bank.storage.commit()
+            bank.storage.flush()
+            journal_offset = bank.storage.position
+        data = snapshot_to_bytes(bank, journal_offset)
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+    return journal_offset
+
+
+def load_snapshot_bytes(bank, data):
+    """Loads the state encoded in a snapshot into a freshly created bank.
+       Returns the journal offset at which the snapshot was taken."""
+    # Imported here because bank.py depends on the modules this one depends on.
+    from bank import Account, AccountDeviceData
+
+    reader = ByteReader(data)
+    if bytes(reader.view[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise ValueError('Not a bank snapshot.')
+    reader.offset = len(SNAPSHOT_MAGIC)
+
+    journal_offset, bank.month.epoch, account_count = reader.read_struct(SNAPSHOT_HEADER)
+    for _ in range(account_count):
+        max_credit, balance, device_count = reader.read_struct(ACCOUNT_HEADER)
+        account = Account(AccountOwner(reader.read_string()), max_credit)
+        account.balance = balance
+        bank.add_account(account)
+        for _ in range(device_count):
+            public_key = import_public_key(reader.read_bytestring())
+            check_counter, cap, cap_epoch, monthly_cap, note_count = reader.read_struct(DEVICE_HEADER)
+            device = AccountDeviceData(public_key, cap, monthly_cap, bank.month)
+            device.check_counter = check_counter
+            device.cap_epoch = cap_epoch
+            device.unspent_checks, reader.offset = CheckLedger.from_buffer(reader.view, reader.offset)
+            for _ in range(note_count):
+                draft = PromissoryNoteDraft.from_bytes(reader.read_bytestring())
+                device.add_awaiting_claim(draft)
+                bank.note_expiry.add(draft.transaction_date + timedelta(DAYS_VALID + 1), (device, draft))
+            # Rather than indexing every check, index one sweep of the device's
+            # ledger per distinct expiration date.
+            for expiration_day in device.unspent_checks.unspent_expiration_days():
+                bank.check_expiry.add(date.fromordinal(expiration_day + DAYS_VALID + 1), (device, None))
+            bank.register_device(account, device)
+
+    counterparty_count, = reader.read_struct(struct.Struct('<I'))
+    for _ in range(counterparty_count):
+        counterparty_id, obligation_count = reader.read_struct(COUNTERPARTY_COUNT)
+        for _ in range(obligation_count):
+            fingerprint, amount = reader.read_struct(OBLIGATION)
+            bank.settlement.record(counterparty_id, fingerprint, amount)
+
+    position_count, = reader.read_struct(struct.Struct('<I'))
+    for _ in range(position_count):
+        counterparty_id, position = reader.read_struct(COUNTERPARTY_AMOUNT)
+        bank.interbank_position[counterparty_id] = position
+
+    version_count = reader.read_uint32()
+    for _ in range(version_count):
+        revoked = reader.read_fixed_view(32 * reader.read_uint32())
+        bank.revocations.revoke([bytes(revoked[offset:offset + 32]) for offset in range(0, len(revoked), 32)])
+
+    remittances = bank.remittances
+    for _ in range(reader.read_uint32()):
+        remittance, reader.offset = Remittance.from_bytes(reader.view, reader.offset)
+        remittances.add_pending(remittance)
+    for _ in range(reader.read_uint32()):
+        recipient_id, counter = reader.read_struct(REMITTANCE_COUNTER)
+        remittances.counters[recipient_id] = counter
+    for _ in range(reader.read_uint32()):
+        sender_id, received_through, ahead_count = reader.read_struct(REMITTANCE_WINDOW)
+        remittances.received_through[sender_id] = received_through
+        for _ in range(ahead_count):
+            remittances.receive(sender_id, reader.read_uint64())
+
+    reader.view.release()
+    return journal_offset
+
+
+def load_snapshot(bank, path):
+    """Loads a snapshot file into a freshly created bank. The file is
+       memory-mapped, so the large tables of the check ledgers are copied
+       straight from the page cache. Returns the journal offset at which the
+       snapshot was taken."""
+    with open(path, 'rb') as snapshot_file:
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return load_snapshot_bytes(bank, data)
+
+
+def restore_bank(bank, journal, snapshot_path=None):
+    """Restores a freshly created bank from a snapshot, if the snapshot file
+       exists, and the tail of its journal that was written after the
+       snapshot was taken. Attaches the journal to the bank."""
+    journal_offset = 0
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+        journal_offset = load_snapshot(bank, snapshot_path)
+    journal.replay(bank, journal_offset)
+    return bank
@@ -0,0 +1,430 @@
+"""A storage backend that keeps a bank's state in an SQLite database."""
+
+import sqlite3
+import threading
+from datetime import date, timedelta
+
+from check_ledger import CheckLedger
+from promissory_note import PromissoryNoteDraft, import_public_key, key_fingerprint, DAYS_VALID
+from settlement import Remittance
+from storage import BankStorage, AccountOwner
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bank_state (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    max_credit INTEGER NOT NULL,
+    balance INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    fingerprint BLOB PRIMARY KEY,
+    account_id INTEGER NOT NULL REFERENCES accounts (id),
+    public_key BLOB NOT NULL,
+    check_counter INTEGER NOT NULL,
+    cap INTEGER NOT NULL,
+    cap_epoch INTEGER NOT NULL,
+    monthly_cap INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_by_account ON devices (account_id);
+CREATE TABLE IF NOT EXISTS checks (
+    fingerprint BLOB NOT NULL REFERENCES devices (fingerprint),
+    identifier INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    expiration_day INTEGER NOT NULL,
+    spent INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fingerprint, identifier)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS notes (
+    fingerprint BLOB NOT NULL REFERENCES devices (fingerprint),
+    draft BLOB NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (fingerprint, draft)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS obligations (
+    counterparty_id INTEGER NOT NULL,
+    seller_fingerprint BLOB NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (counterparty_id, seller_fingerprint)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS interbank_positions (
+    counterparty_id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revocation_versions (
+    version INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS revoked_devices (
+    fingerprint BLOB PRIMARY KEY,
+    version INTEGER NOT NULL REFERENCES revocation_versions (version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS revoked_devices_by_version ON revoked_devices (version);
+CREATE TABLE IF NOT EXISTS remittances_pending (
+    recipient_id INTEGER NOT NULL,
+    identifier INTEGER NOT NULL,
+    remittance BLOB NOT NULL,
+    PRIMARY KEY (recipient_id, identifier)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS remittance_counters (
+    recipient_id INTEGER PRIMARY KEY,
+    counter INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remittances_received (
+    sender_id INTEGER PRIMARY KEY,
+    received_through INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remittances_received_ahead (
+    sender_id INTEGER NOT NULL,
+    identifier INTEGER NOT NULL,
+    PRIMARY KEY (sender_id, identifier)
+) WITHOUT ROWID;
+'''
+
+# The statements are kept as constants so the connection's statement cache
+# hands out the same prepared statement every time.
+INSERT_ACCOUNT = 'INSERT INTO accounts (id, owner, max_credit, balance) VALUES (?, ?, ?, ?)'
+INSERT_DEVICE = 'INSERT INTO devices (fingerprint, account_id, public_key, check_counter, cap, cap_epoch, ' \
+                'monthly_cap, position) VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM devices))'
+INSERT_CHECK = 'INSERT INTO checks (fingerprint, identifier, value, expiration_day) VALUES (?, ?, ?, ?)'
+UPDATE_CHECK_COUNTER = 'UPDATE devices SET check_counter = ? WHERE fingerprint = ?'
+SPEND_CHECK = 'UPDATE checks SET spent = 1 WHERE fingerprint = ? AND identifier = ?'
+UPDATE_CAP = 'UPDATE devices SET cap = ?, cap_epoch = ? WHERE fingerprint = ?'
+UPDATE_BALANCE = 'UPDATE accounts SET balance = balance + ? WHERE id = ?'
+INSERT_NOTE = 'INSERT OR IGNORE INTO notes (fingerprint, draft, value) VALUES (?, ?, ?)'
+DELETE_NOTE = 'DELETE FROM notes WHERE fingerprint = ? AND draft = ?'
+UPDATE_STATE = 'INSERT INTO bank_state (name, value) VALUES (?, ?) ' \
+               'ON CONFLICT (name) DO UPDATE SET value = excluded.value'
+ADD_OBLIGATION = 'INSERT INTO obligations (counterparty_id, seller_fingerprint, amount) VALUES (?, ?, ?) ' \
+                 'ON CONFLICT (counterparty_id, seller_fingerprint) DO UPDATE SET amount = amount + excluded.amount'
+DELETE_OBLIGATIONS = 'DELETE FROM obligations WHERE counterparty_id = ?'
+ADD_POSITION = 'INSERT INTO interbank_positions (counterparty_id, position) VALUES (?, ?) ' \
+               'ON CONFLICT (counterparty_id) DO UPDATE SET position = position + excluded.position'
+INSERT_REVOCATION_VERSION = 'INSERT INTO revocation_versions (version) VALUES (?)'
+INSERT_REVOKED_DEVICE = 'INSERT OR IGNORE INTO revoked_devices (fingerprint, version) VALUES (?, ?)'
+INSERT_REMITTANCE = 'INSERT INTO remittances_pending (recipient_id, identifier, remittance) VALUES (?, ?, ?)'
+UPDATE_REMITTANCE_COUNTER = 'INSERT INTO remittance_counters (recipient_id, counter) VALUES (?, ?) ' \
+                            'ON CONFLICT (recipient_id) DO UPDATE SET counter = MAX(counter, excluded.counter)'
+DELETE_REMITTANCE = 'DELETE FROM remittances_pending WHERE recipient_id = ? AND identifier = ?'
+UPDATE_RECEIVED_THROUGH = 'INSERT INTO remittances_received (sender_id, received_through) VALUES (?, ?) ' \
+                          'ON CONFLICT (sender_id) DO UPDATE SET received_through = excluded.received_through'
+DELETE_RECEIVED_AHEAD = 'DELETE FROM remittances_received_ahead WHERE sender_id = ? AND identifier <= ?'
+INSERT_RECEIVED_AHEAD = 'INSERT OR IGNORE INTO remittances_received_ahead (sender_id, identifier) VALUES (?, ?)'
+
+
+class SQLiteStorage(BankStorage):
+    """Keeps a bank's accounts, devices, checks, notes and interbank
+       obligations in an SQLite database that runs in WAL mode. The changes
+       made by a single bank operation, such as redeeming a promissory note,
+       are committed as one transaction. Spent checks are marked rather than
+       deleted, so the database doubles as a record of the bank's history
+       that can be inspected with ordinary SQL.
+
+       The connection is shared by every thread that works on the bank, so
+       all access to it happens under the bank's lock once the backend is
+       attached to a bank."""
+
+    def __init__(self, path, synchronous='NORMAL'):
+        """Opens (or creates) the database at a particular path. `synchronous`
+           is passed to SQLite's `synchronous` pragma; in WAL mode, NORMAL
+           only risks losing the last transactions on a power failure."""
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                          cached_statements=64)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = %s' % synchronous)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+        # Replaced by the bank's lock in `load`.
+        self.lock = threading.RLock()
+        self.in_memory = True
+
+    def __execute(self, statement, parameters):
+        with self.lock:
+            if not self.connection.in_transaction:
+                self.connection.execute('BEGIN')
+            self.connection.execute(statement, parameters)
+
+    def __execute_many(self, statement, parameters):
+        with self.lock:
+            if not self.connection.in_transaction:
+                self.connection.execute('BEGIN')
+            self.connection.executemany(statement, parameters)
+
+    def fetch(self, statement, parameters=()):
+        """Runs a query and returns all of its rows. Sees the changes of the
+           current transaction, even if they are not committed yet."""
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    def load(self, bank, in_memory=True):
+        """Loads the state stored in the database into a freshly created bank
+           and attaches this backend to the bank. Unless `in_memory` is set,
+           the devices' check ledgers stay in the database and are queried
+           as needed, so only accounts, devices and unclaimed notes are held
+           in memory."""
+        with bank.lock:
+            self.lock = bank.lock
+            self.in_memory = in_memory
+            self.__load(bank, in_memory)
+            bank.attach_storage(self)
+        return bank
+
+    def __load(self, bank, in_memory):
+        # Imported here because bank.py depends on the modules this one depends on.
+        from bank import Account, AccountDeviceData
+
+        connection = self.connection
+        for value, in connection.execute("SELECT value FROM bank_state WHERE name = 'month_epoch'"):
+            bank.month.epoch = value
+
+        for identifier, owner, max_credit, balance in connection.execute(
+                'SELECT id, owner, max_credit, balance FROM accounts ORDER BY id'):
+            account = Account(AccountOwner(owner), max_credit)
+            account.balance = balance
+            bank.add_account(account)
+            assert account.identifier == identifier
+
+        for fingerprint, account_id, public_key, check_counter, cap, cap_epoch, monthly_cap in connection.execute(
+                'SELECT fingerprint, account_id, public_key, check_counter, cap, cap_epoch, monthly_cap '
+                'FROM devices ORDER BY position').fetchall():
+            device = AccountDeviceData(import_public_key(public_key), cap, monthly_cap, bank.month)
+            device.check_counter = check_counter
+            device.cap_epoch = cap_epoch
+            if in_memory:
+                for identifier, value, expiration_day in connection.execute(
+                        'SELECT identifier, value, expiration_day FROM checks '
+                        'WHERE fingerprint = ? AND spent = 0 ORDER BY identifier', (fingerprint,)):
+                    device.unspent_checks.add(identifier, value, date.fromordinal(expiration_day))
+            else:
+                device.unspent_checks = SQLiteCheckLedger(self, fingerprint)
+            # Index one sweep of the device's ledger per distinct expiration date.
+            for expiration_day, in connection.execute(
+                    'SELECT DISTINCT expiration_day FROM checks WHERE fingerprint = ? AND spent = 0', (fingerprint,)):
+                bank.check_expiry.add(date.fromordinal(expiration_day + DAYS_VALID + 1), (device, None))
+            for draft_bytes, in connection.execute('SELECT draft FROM notes WHERE fingerprint = ?', (fingerprint,)):
+                draft = PromissoryNoteDraft.from_bytes(draft_bytes)
+                device.add_awaiting_claim(draft)
+                bank.note_expiry.add(draft.transaction_date + timedelta(DAYS_VALID + 1), (device, draft))
+            bank.register_device(bank.accounts[account_id], device)
+
+        for counterparty_id, seller_fingerprint, amount in connection.execute(
+                'SELECT counterparty_id, seller_fingerprint, amount FROM obligations'):
+            bank.settlement.record(counterparty_id, seller_fingerprint, amount)
+        for counterparty_id, position in connection.execute(
+                'SELECT counterparty_id, position FROM interbank_positions'):
+            bank.interbank_position[counterparty_id] = position
+
+        for version, in connection.execute('SELECT version FROM revocation_versions ORDER BY version').fetchall():
+            bank.revocations.revoke([fingerprint for fingerprint, in connection.execute(
+                'SELECT fingerprint FROM revoked_devices WHERE version = ?', (version,))])
+
+        remittances = bank.remittances
+        for remittance_bytes, in connection.execute('SELECT remittance FROM remittances_pending'):
+            remittances.add_pending(Remittance.from_bytes(remittance_bytes)[0])
+        for recipient_id, counter in connection.execute('SELECT recipient_id, counter FROM remittance_counters'):
+            remittances.counters[recipient_id] = counter
+        for sender_id, received_through in connection.execute(
+                'SELECT sender_id, received_through FROM remittances_received'):
+            remittances.received_through[sender_id] = received_through
+        for sender_id, identifier in connection.execute(
+                'SELECT sender_id, identifier FROM remittances_received_ahead ORDER BY sender_id, identifier'):
+            remittances.receive(sender_id, identifier)
+
+    def account_added(self, account):
+        self.__execute(INSERT_ACCOUNT, (account.identifier, account.owner.name, account.max_credit, account.balance))
+
+    def device_added(self, account, device):
+        self.__execute(INSERT_DEVICE, (key_fingerprint(device.public_key), account.identifier,
+                                       device.public_key.export_key(format='DER'), device.check_counter,
+                                       device.cap, device.cap_epoch, device.monthly_cap))
+        if not self.in_memory:
+            # A new device has no checks yet, so its ledger can move to the database right away.
+            assert not device.unspent_checks
+            device.unspent_checks = SQLiteCheckLedger(self, key_fingerprint(device.public_key))
+
+    def checks_issued(self, device, checks):
+        fingerprint = key_fingerprint(device.public_key)
+        self.__execute_many(INSERT_CHECK, [(fingerprint, check.identifier, check.value,
+                                            check.expiration_date.toordinal()) for check in checks])
+        self.__execute(UPDATE_CHECK_COUNTER, (device.check_counter, fingerprint))
+
+    def check_spent(self, device, identifier):
+        self.__execute(SPEND_CHECK, (key_fingerprint(device.public_key), identifier))
+
+    def cap_changed(self, device):
+        self.__execute(UPDATE_CAP, (device._cap, device.cap_epoch, key_fingerprint(device.public_key)))
+
+    def balance_changed(self, account, delta):
+        self.__execute(UPDATE_BALANCE, (delta, account.identifier))
+
+    def note_added(self, device, draft):
+        self.__execute(INSERT_NOTE, (key_fingerprint(device.public_key), draft.to_bytes(), draft.total_check_value))
+
+    def note_removed(self, device, draft):
+        self.__execute(DELETE_NOTE, (key_fingerprint(device.public_key), draft.to_bytes()))
+
+    def month_advanced(self, epoch):
+        self.__execute(UPDATE_STATE, ('month_epoch', epoch))
+
+    def obligation_recorded(self, counterparty_id, seller_fingerprint, amount):
+        self.__execute(ADD_OBLIGATION, (counterparty_id, seller_fingerprint, amount))
+
+    def obligations_settled(self, counterparty_id):
+        self.__execute(DELETE_OBLIGATIONS, (counterparty_id,))
+
+    def interbank_position_changed(self, counterparty_id, delta):
+        self.__execute(ADD_POSITION, (counterparty_id, delta))
+
+    def devices_revoked(self, fingerprints):
+        with self.lock:
+            # The bank has already applied the revocation, so its list is at the new version.
+            version, = self.connection.execute('SELECT COUNT(*) + 1 FROM revocation_versions').fetchone()
+            self.__execute(INSERT_REVOCATION_VERSION, (version,))
+            self.__execute_many(INSERT_REVOKED_DEVICE, [(fingerprint, version) for fingerprint in fingerprints])
+
+    def remittance_sent(self, remittance):
+        self.__execute(INSERT_REMITTANCE, (remittance.recipient_id, remittance.identifier, remittance.to_bytes()))
+        self.__execute(UPDATE_REMITTANCE_COUNTER, (remittance.recipient_id, remittance.identifier))
+
+    def remittance_acknowledged(self, recipient_id, identifier):
+        self.__execute(DELETE_REMITTANCE, (recipient_id, identifier))
+
+    def remittance_received(self, sender_id, identifier, received_through):
+        self.__execute(UPDATE_RECEIVED_THROUGH, (sender_id, received_through))
+        self.__execute(DELETE_RECEIVED_AHEAD, (sender_id, received_through))
+        if identifier > received_through:
+            self.__execute(INSERT_RECEIVED_AHEAD, (sender_id, identifier))
+
+    def commit(self):
+        """Commits the current transaction, if any."""
+        with self.lock:
+            if self.connection.in_transaction:
+                self.connection.execute('COMMIT')
+
+    def close(self):
+        """Commits the current transaction and closes the database."""
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+
+class SQLiteCheckLedger(object):
+    """The unspent checks of a device, as stored in the `checks` table of an
+       SQLite backend. Offers the same operations as a CheckLedger, but
+       answers them with queries, so a bank whose ledgers do not fit in
+       memory only keeps each ledger's running totals.
+
+       The rows are written by the backend's `checks_issued` and
+       `check_spent` hooks, which the device calls right after changing its
+       ledger; the ledger itself only keeps its totals up to date."""
+
+    in_memory = False
+
+    def __init__(self, storage, fingerprint):
+        """Creates the ledger of the device with a particular key fingerprint."""
+        self.storage = storage
+        self.fingerprint = fingerprint
+        (self.unspent_count, self.unspent_value), = storage.fetch(
+            'SELECT COUNT(*), COALESCE(SUM(value), 0) FROM checks WHERE fingerprint = ? AND spent = 0',
+            (fingerprint,))
+
+    def __find(self, identifier):
+        rows = self.storage.fetch('SELECT value, expiration_day FROM checks '
+                                  'WHERE fingerprint = ? AND identifier = ? AND spent = 0',
+                                  (self.fingerprint, identifier))
+        return rows[0] if rows else None
+
+    def __len__(self):
+        """Gets the number of unspent checks."""
+        return self.unspent_count
+
+    def __contains__(self, identifier):
+        """Tests if the check with a particular identifier is unspent."""
+        return self.__find(identifier) is not None
+
+    def __iter__(self):
+        """Iterates over the identifiers of all unspent checks."""
+        return iter([identifier for identifier, in self.storage.fetch(
+            'SELECT identifier FROM checks WHERE fingerprint = ? AND spent = 0 ORDER BY identifier',
+            (self.fingerprint,))])
+
+    def add(self, identifier, value, expiration_date):
+        """Records a newly issued, unspent check."""
+        self.unspent_count += 1
+        self.unspent_value += value
+
+    def is_unspent(self, identifier, value, expiration_date):
+        """Tests if a check is unspent and matches the value and expiration
+           date with which it was issued."""
+        return self.__find(identifier) == (value, expiration_date.toordinal())
+
+    def spend(self, identifier):
+        """Marks an unspent check as spent. Raises a KeyError if the check
+           is not unspent."""
+        row = self.__find(identifier)
+        if row is None:
+            raise KeyError(identifier)
+        self.unspent_count -= 1
+        self.unspent_value -= row[0]
+
+    def value(self, identifier):
+        """Gets the value of the check with a particular identifier."""
+        value, = self.storage.fetch('SELECT value FROM checks WHERE fingerprint = ? AND identifier = ?',
+                                    (self.fingerprint, identifier))[0]
+        return value
+
+    def expiration_date(self, identifier):
+        """Gets the expiration date of the check with a particular identifier."""
+        expiration_day, = self.storage.fetch(
+            'SELECT expiration_day FROM checks WHERE fingerprint = ? AND identifier = ?',
+            (self.fingerprint, identifier))[0]
+        return date.fromordinal(expiration_day)
+
+    def unspent_expiration_days(self):
+        """Gets the set of expiration dates (as day numbers) of the unspent checks."""
+        return {expiration_day for expiration_day, in self.storage.fetch(
+            'SELECT DISTINCT expiration_day FROM checks WHERE fingerprint = ? AND spent = 0', (self.fingerprint,))}
+
+    def total_value(self):
+        """Gets the total value of all unspent checks. The total is kept up
+           to date as checks are added and spent."""
+        return self.unspent_value
+
+    def recompute_total_value(self):
+        """Computes the total value of all unspent checks from scratch."""
+        total, = self.storage.fetch('SELECT COALESCE(SUM(value), 0) FROM checks WHERE fingerprint = ? AND spent = 0',
+                                    (self.fingerprint,))[0]
+        return total
+
+    def remove_unredeemable(self, today=None):
+        """Drops all unspent checks that can no longer be redeemed by sellers.
+           Returns the identifiers of the dropped checks."""
+        if today is None:
+            today = date.today()
+        rows = self.storage.fetch('SELECT identifier, value FROM checks '
+                                  'WHERE fingerprint = ? AND spent = 0 AND expiration_day < ?',
+                                  (self.fingerprint, (today - timedelta(DAYS_VALID)).toordinal()))
+        for identifier, value in rows:
+            self.unspent_count -= 1
+            self.unspent_value -= value
+        return [identifier for identifier, value in rows]
+
+    def to_check_ledger(self):
+        """Copies the unspent checks into an in-memory CheckLedger."""
+        ledger = CheckLedger()
+        for identifier, value, expiration_day in self.storage.fetch(
+                'SELECT identifier, value, expiration_day FROM checks '
+                'WHERE fingerprint = ? AND spent = 0 ORDER BY identifier', (self.fingerprint,)):
+            ledger.add(identifier, value, date.fromordinal(expiration_day))
+        return ledger
+
+    def to_bytes(self):
+        """Encodes this ledger in the format of a CheckLedger."""
+        return self.to_check_ledger().to_bytes()
+
+    def to_json(self):
+        return self.to_check_ledger().to_json()
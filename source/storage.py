@@ -0,0 +1,77 @@
+"""The interface through which a bank writes its state changes to durable
+   storage."""
+
+
+class BankStorage(object):
+    """A storage backend for a bank. A bank that has a storage backend reports
+       every change to its state through the methods below, and calls
+       `commit` once a bank operation has made all of its changes. The
+       default implementations do nothing."""
+
+    def account_added(self, account):
+        """Records that an account was added to the bank."""
+
+    def device_added(self, account, device):
+        """Records that a device was associated with an account."""
+
+    def checks_issued(self, device, checks):
+        """Records that a batch of checks was issued to a device."""
+
+    def check_spent(self, device, identifier):
+        """Records that a check was spent or dropped because it expired."""
+
+    def cap_changed(self, device):
+        """Records that the spending cap of a device has changed."""
+
+    def balance_changed(self, account, delta):
+        """Records that the balance of an account has changed by an amount."""
+
+    def note_added(self, device, draft):
+        """Records that a note is awaiting claim by its seller."""
+
+    def note_removed(self, device, draft):
+        """Records that a note is no longer awaiting claim."""
+
+    def month_advanced(self, epoch):
+        """Records that the bank has started a new month."""
+
+    def obligation_recorded(self, counterparty_id, seller_fingerprint, amount):
+        """Records that a seller served by a counterparty bank is owed an amount."""
+
+    def obligations_settled(self, counterparty_id):
+        """Records that the obligations towards a counterparty bank were settled."""
+
+    def interbank_position_changed(self, counterparty_id, delta):
+        """Records that the interbank position towards a counterparty bank has changed."""
+
+    def devices_revoked(self, fingerprints):
+        """Records that the certificates of devices with particular key
+           fingerprints were revoked, as a new version of the revocation list."""
+
+    def remittance_sent(self, remittance):
+        """Records credits for the sellers of another bank that are yet to be delivered."""
+
+    def remittance_acknowledged(self, recipient_id, identifier):
+        """Records that the recipient of a remittance has applied it."""
+
+    def remittance_received(self, sender_id, identifier, received_through):
+        """Records that a remittance from another bank was applied, along with
+           the number up to which all remittances from that bank are applied."""
+
+    def commit(self):
+        """Makes the changes that were recorded since the last commit durable,
+           as a single unit."""
+
+    def close(self):
+        """Commits all pending changes and releases the backend's resources."""
+        self.commit()
+
+
+class AccountOwner(object):
+    """The owner of an account that was restored from storage."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_json(self):
+        return {'Name': self.name}
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
 """A collection of unit tests for our electronic checkbook system"""
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import random
+import time
 from Crypto.PublicKey import ECC
 
-from bank import Bank, Account, AccountDeviceData, FraudException
-from account_holder_device import AccountHolderDevice
-from promissory_note import Check, PromissoryNote, PromissoryNoteDraft
-from signing_protocol import create_promissory_note, perform_transaction, register_bank
+from bank import Bank, Account, AccountDeviceData, FraudException, REDEEMED, EXPIRED, FRAUD, INVALID
+from account_holder_device import AccountHolderDevice, DeviceCertificate, certificate_cache
+import account_holder_device
+import promissory_note
+from promissory_note import Check, PromissoryNote, PromissoryNoteDraft, ByteReader, uint32_to_bytes, \
+    string_to_bytes, bytestring_to_bytes, key_fingerprint, public_key_cache, configure_verification_cache, \
+    sign_DSS, verify_DSS, Signer, Verifier, CHECK_EXPIRATION, DAYS_VALID, WIRE_VERSION_1, WIRE_VERSION_2, \
+    RESERVED_BANK_ID
+from cache import LRUCache, new_cache
+from check_ledger import CheckLedger
+from journal import Journal, SYNC_BATCH
+from snapshot import write_snapshot, restore_bank
+from revocation import RevocationDelta, RevocationList
+from sqlite_storage import SQLiteStorage
+from signature_suites import ED25519, ECDSA_P256
+from scheduler import BankScheduler
+from clock import ManualClock
+from datetime import date, datetime, timedelta
+from signing_protocol import create_promissory_note, perform_transaction, register_bank, hand_in, transfer, \
+    verify_promissory_note, verify_promissory_notes, BankDirectory, bank_directory
 from main_cli import Person
 
 class TestAccountHolderDevice(unittest.TestCase):
@@ -28,7 +49,81 @@ class TestAccountHolderDevice(unittest.TestCase):
         assert device.get_bank_public_key(bank_id) == bank_key
 
 
+class TestDeviceCertificate(unittest.TestCase):
+    def test_certificate_validation_cache(self):
+        """Tests that a decoded certificate validates, that validating it again
+           skips the signature check and that expired certificates are rejected."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        _, cert = bank.add_device(Account(Person("Bill")), device.public_key)
+        decoded = DeviceCertificate.from_bytes(cert.to_bytes())
+        assert decoded.to_bytes() == cert.to_bytes()
+        assert decoded.valid_until == cert.valid_until and decoded.bankID == 42
+
+        verifier = Verifier(bank.public_key)
+        assert decoded.validate(device.public_key, verifier)
+        hits = certificate_cache.hits
+        assert cert.validate(device.public_key.export_key(format='PEM'), verifier)
+        assert certificate_cache.hits == hits + 1
+        assert verifier.stats()['count'] + verifier.stats()['cache hits'] == 1
+        assert not cert.validate(AccountHolderDevice().public_key, verifier)
+        assert not cert.validate(device.public_key, Bank(43).public_key)
+
+        expired = DeviceCertificate("Bill", device.public_key.export_key(format='PEM'), bank.signer,
+                                    datetime.now() - timedelta(days=1), 42)
+        assert not expired.validate(device.public_key, verifier)
+
+        # Changing a certificate that was validated before forces a new signature check.
+        cert.expiry_day += 365
+        assert not cert.validate(device.public_key, verifier)
+
+    def test_revocation(self):
+        """Tests that revoked devices cannot obtain checks and that their
+           certificates are rejected once a device applies the bank's
+           revocation list delta, even if they were validated before."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        other_device = AccountHolderDevice()
+        device.register_bank(bank.identifier, bank.public_key)
+        account = Account(Person("Bill"))
+        account.deposit(100)
+        _, cert = bank.add_device(account, device.public_key, 100, 100)
+        bank.add_device(account, other_device.public_key, 100, 100)
+
+        revocations = device.get_revocation_list(42)
+        verifier = device.get_bank_verifier(42)
+        assert cert.validate(device.public_key, verifier, revocations)
+        assert bank.revoke_device(device.public_key) == 1
+        assert bank.revoke_devices([other_device.public_key]) == 2
+        self.assertRaises(ValueError, bank.issue_check, device.public_key, 10)
+
+        # A device that has caught up with version 1 only receives the newer revocation.
+        delta = RevocationDelta.from_bytes(bank.revocation_delta(1).to_bytes())
+        assert (delta.from_version, delta.to_version) == (1, 2)
+        assert delta.fingerprints == [key_fingerprint(other_device.public_key)]
+        self.assertRaises(ValueError, device.apply_revocation_delta, delta)
+
+        # Deltas that the bank did not sign are rejected.
+        full_delta = bank.revocation_delta()
+        unsigned = RevocationDelta(42, 0, 2, full_delta.fingerprints)
+        self.assertRaises(ValueError, device.apply_revocation_delta, unsigned)
+        forged = RevocationDelta(42, 0, 2, full_delta.fingerprints[:1]).sign(Bank(43).signer)
+        self.assertRaises(ValueError, device.apply_revocation_delta, forged)
+        tampered = RevocationDelta(42, 0, 2, full_delta.fingerprints[:1], full_delta.signature)
+        self.assertRaises(ValueError, device.apply_revocation_delta, tampered)
+        assert revocations.version == 0
+
+        device.apply_revocation_delta(RevocationDelta.from_bytes(bank.revocation_delta().to_bytes()))
+        device.apply_revocation_delta(bank.revocation_delta(1))
+        assert revocations.version == 2 and len(revocations) == 2
+        assert not cert.validate(device.public_key, verifier, revocations)
+        assert cert.validate(device.public_key, verifier, RevocationList(42))
+
+
 class TestBank(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+
     def test_create(self):
         """Tests that a bank can be created."""
         Bank(42)
@@ -43,6 +138,842 @@ class TestBank(unittest.TestCase):
         assert bank.get_account(device.public_key) == account
         assert bank.get_device(device.public_key) == device_data
 
+    def test_lookup_by_fingerprint(self):
+        """Tests that a bank finds a device's account through a different
+           object that holds the same public key."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        account = Account(Person("Bill"))
+        bank.add_device(account, device.public_key)
+        same_key = ECC.import_key(device.public_key.export_key(format='PEM'))
+        assert key_fingerprint(same_key) == key_fingerprint(device.public_key)
+        assert len(key_fingerprint(same_key)) == 32
+        assert key_fingerprint(device.private_key) == key_fingerprint(device.public_key)
+        assert bank.has_account(same_key)
+        assert bank.get_account(same_key) is account
+        assert not bank.has_account(AccountHolderDevice().public_key)
+
+    def test_issue_checks(self):
+        """Tests that a bank issues a batch of checks with consecutive
+           identifiers and rejects batches that exceed the account's credit."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        account = Account(Person("Bill"))
+        account.deposit(100)
+        bank.add_device(account, device.public_key, 1000, 1000)
+        bank.issue_check(device.public_key, 10)
+
+        checks = bank.issue_checks(device.public_key, [5, 10, 20, 50], workers=2)
+        assert [check.identifier for check in checks] == [1, 2, 3, 4]
+        assert [check.value for check in checks] == [5, 10, 20, 50]
+        assert all(check.is_signature_authentic(bank.public_key) for check in checks)
+        assert bank.get_device(device.public_key).total_unspent_check_value == 95
+
+        with self.assertRaises(ValueError):
+            bank.issue_checks(device.public_key, [1, 5])
+        assert bank.get_device(device.public_key).check_counter == 5
+
+    def test_issue_checkbook(self):
+        """Tests that the checks of a checkbook share one signature and that
+           each of them verifies through its own Merkle proof."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        account = Account(Person("Bill"))
+        account.deposit(1000)
+        bank.add_device(account, device.public_key, 1000, 1000)
+
+        for count in range(1, 8):
+            checks = bank.issue_checks(device.public_key, [1] * count, checkbook=True)
+            assert len({check.signature for check in checks}) == 1
+            for check in checks:
+                assert check.is_signature_authentic(bank.public_key)
+                deserialized = Check.from_bytes(check.to_bytes())
+                assert deserialized == check
+                assert deserialized.is_signature_authentic(bank.public_key)
+
+        forged = Check.from_bytes(checks[3].to_bytes())
+        forged.value = 100
+        assert not forged.is_signature_authentic(bank.public_key)
+        forged = Check.from_bytes(checks[3].to_bytes())
+        forged.proof = checks[4].proof
+        assert not forged.is_signature_authentic(bank.public_key)
+        assert not checks[0].is_signature_authentic(Bank(43).public_key)
+
+    def test_running_totals(self):
+        """Tests that running totals agree with totals recomputed from scratch."""
+        account_holder_device.DEBUG_TOTALS = True
+        try:
+            bank = Bank(42)
+            register_bank(bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+
+            buyer_device.register_bank(bank.identifier, bank.public_key)
+            seller_device.register_bank(bank.identifier, bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            seller_account = Account(Person("seller"))
+
+            buyer_account.deposit(1000)
+
+            bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            bank.add_device(seller_account, seller_device.public_key)
+
+            for check in bank.issue_checks(buyer_device.public_key, [5, 10, 20, 50]):
+                buyer_device.add_unspent_check(check)
+            assert buyer_device.total_check_value == 85
+            assert buyer_account.total_unspent_check_value == 85
+
+            note = create_promissory_note(buyer_device, seller_device, 25)
+            hand_in(note, buyer_device)
+            assert buyer_device.total_check_value == 60
+            assert buyer_account.total_unspent_check_value == 60
+            assert buyer_account.total_unclaimed_note_value == 25
+
+            transfer(note, buyer_device, seller_device)
+            assert buyer_account.total_unclaimed_note_value == 0
+            buyer_account.check_totals()
+        finally:
+            account_holder_device.DEBUG_TOTALS = False
+
+    def test_sweep_expired(self):
+        """Tests that a bank's expiry sweep only drops checks and notes that have expired."""
+        bank = Bank(42)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+
+        buyer_account.deposit(1000)
+
+        buyer_data, _ = bank.add_device(buyer_account, buyer_device.public_key, 100, 100)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        for check in bank.issue_checks(buyer_device.public_key, [10, 20]):
+            buyer_device.add_unspent_check(check)
+        hand_in(create_promissory_note(buyer_device, seller_device, 10), buyer_device)
+        assert buyer_data.cap == 90
+        assert len(bank.check_expiry) == 2 and len(bank.note_expiry) == 1
+
+        bank.sweep_expired(date.today() + timedelta(10))
+        assert buyer_data.total_unclaimed_note_value == 10
+
+        bank.sweep_expired(date.today() + timedelta(11))
+        assert buyer_data.total_unclaimed_note_value == 0
+        assert buyer_data.cap == 100
+        assert buyer_data.total_unspent_check_value == 20
+        assert len(bank.note_expiry) == 0
+
+        bank.sweep_expired(date.today() + timedelta(CHECK_EXPIRATION + DAYS_VALID + 1))
+        assert buyer_data.total_unspent_check_value == 0
+        assert len(bank.check_expiry) == 0
+
+    def test_lazy_cap_reset(self):
+        """Tests that a month rollover restores every device's cap exactly once,
+           the first time the device is used."""
+        bank = Bank(42)
+        account = Account(Person("Bill"))
+        first, _ = bank.add_device(account, AccountHolderDevice().public_key, 50, 100)
+        second, _ = bank.add_device(account, AccountHolderDevice().public_key, 50, 100)
+        first.cap -= 30
+        assert first.cap == 20
+
+        bank.reset_monthly_spending_caps()
+        assert first.cap_epoch == 0
+        assert first.cap == 100 and first.cap_epoch == 1
+        first.cap -= 10
+        assert first.cap == 90
+        assert second.cap == 100
+
+
+class TestCheckLedger(unittest.TestCase):
+    def test_spend(self):
+        """Tests that a check ledger tracks unspent checks by identifier."""
+        ledger = CheckLedger()
+        expiration_date = date.today() + timedelta(100)
+        for identifier in range(20):
+            ledger.add(identifier, identifier + 1, expiration_date)
+        assert len(ledger) == 20
+        assert ledger.is_unspent(9, 10, expiration_date)
+        assert not ledger.is_unspent(9, 11, expiration_date)
+        assert not ledger.is_unspent(9, 10, expiration_date + timedelta(1))
+        assert not ledger.is_unspent(20, 21, expiration_date)
+
+        ledger.spend(9)
+        assert not ledger.is_unspent(9, 10, expiration_date)
+        with self.assertRaises(KeyError):
+            ledger.spend(9)
+        assert len(ledger) == 19
+        assert 9 not in list(ledger)
+        assert ledger.total_value() == sum(range(1, 21)) - 10
+
+    def test_window(self):
+        """Tests that a check ledger drops the spent checks at the front of its
+           tables, so its size follows the outstanding checks."""
+        ledger = CheckLedger()
+        expiration_date = date.today() + timedelta(100)
+        for identifier in range(10000):
+            ledger.add(identifier, 1, expiration_date)
+            if identifier >= 100:
+                ledger.spend(identifier - 100)
+        assert len(ledger) == 100 and ledger.total_value() == 100
+        assert list(ledger) == list(range(9900, 10000))
+        assert len(ledger.values) <= 400
+        assert ledger.is_unspent(9950, 1, expiration_date) and 9850 not in ledger
+
+        restored, _ = CheckLedger.from_buffer(ledger.to_bytes())
+        assert list(restored) == list(ledger) and restored.total_value() == 100
+        restored.add(10000, 5, expiration_date)
+        for identifier in range(9900, 10001):
+            restored.spend(identifier)
+        assert len(restored) == 0 and len(restored.values) < 8
+        restored.add(10001, 5, expiration_date)
+        assert list(restored) == [10001] and restored.value(10001) == 5
+
+    def test_remove_unredeemable(self):
+        """Tests that a check ledger drops checks that can no longer be redeemed."""
+        ledger = CheckLedger()
+        ledger.add(0, 5, date.today() - timedelta(30))
+        ledger.add(3, 7, date.today())
+        assert list(ledger) == [0, 3]
+        ledger.remove_unredeemable()
+        assert list(ledger) == [3]
+        assert ledger.expiration_date(3) == date.today()
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+
+    def test_run_pending(self):
+        """Tests that a scheduler sweeps expired checks and rolls over months
+           according to its clock."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        account = Account(Person("Bill"))
+        account.deposit(1000)
+        data, _ = bank.add_device(account, device.public_key, 100, 100)
+        clock = ManualClock(date(2018, 1, 1))
+        scheduler = BankScheduler(bank, clock)
+        assert not bank.inline_housekeeping
+
+        bank.issue_checks(device.public_key, [10, 20])
+        data.spend_check(bank.issue_check(device.public_key, 30), 30)
+        assert data.cap == 70
+
+        scheduler.run_pending()
+        assert scheduler.rollover_count == 0
+        assert data.total_unspent_check_value == 30
+
+        clock.advance(31)
+        scheduler.run_pending()
+        assert scheduler.rollover_count == 1
+        assert data.cap == 100
+
+        clock.current_date = date.today() + timedelta(CHECK_EXPIRATION + DAYS_VALID + 1)
+        scheduler.run_pending()
+        assert data.total_unspent_check_value == 0
+
+    def test_clock_decides_expiry(self):
+        """Tests that a bank with a scheduler decides if checks and notes have
+           expired by the scheduler's clock."""
+        bank = Bank(42)
+        register_bank(bank)
+        clock = ManualClock(date.today())
+        BankScheduler(bank, clock)
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+        buyer_account.deposit(100)
+        data, _ = bank.add_device(buyer_account, buyer_device.public_key, 100, 100)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        check = bank.issue_check(buyer_device.public_key, 10)
+        assert check.expiration_date == clock.today() + timedelta(CHECK_EXPIRATION)
+        buyer_device.add_unspent_check(check)
+        note = create_promissory_note(buyer_device, seller_device, 10)
+        hand_in(note, buyer_device)
+        assert data.cap == 90
+
+        # The note expires in a later month by the bank's clock, so its value
+        # does not return to the cap and the seller cannot claim it.
+        clock.advance(DAYS_VALID + 31)
+        bank.sweep_expired()
+        assert data.total_unclaimed_note_value == 0 and data.cap == 90
+        assert bank.redeem_promissory_notes([note]) == [EXPIRED]
+        assert seller_account.balance == 0 and buyer_account.balance == 100
+
+    def test_background_thread(self):
+        """Tests that a scheduler runs housekeeping on a background thread."""
+        scheduler = BankScheduler(Bank(42), ManualClock(), interval=0.01)
+        scheduler.start()
+        try:
+            for _ in range(500):
+                if scheduler.sweep_count:
+                    break
+                time.sleep(0.01)
+        finally:
+            scheduler.stop()
+        assert not scheduler.running
+        assert scheduler.sweep_count > 0
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_replay(self):
+        """Tests that a bank restored from its journal matches the original."""
+        bank = Bank(42)
+        Journal(self.path).replay(bank)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+        buyer_account.deposit(1000)
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        for check in bank.issue_checks(buyer_device.public_key, [10, 20, 30, 40]):
+            buyer_device.add_unspent_check(check)
+        perform_transaction(buyer_device, seller_device, 10)
+        hand_in(create_promissory_note(buyer_device, seller_device, 20), buyer_device)
+        bank.reset_monthly_spending_caps()
+        bank.storage.close()
+
+        restored = Bank(42, bank.private_key)
+        Journal(self.path).replay(restored)
+
+        assert [account.balance for account in restored.accounts] == [990, 10]
+        restored_device = restored.get_device(buyer_device.public_key)
+        original_device = bank.get_device(buyer_device.public_key)
+        assert list(restored_device.unspent_checks) == list(original_device.unspent_checks)
+        assert restored_device.awaiting_claim == original_device.awaiting_claim
+        assert restored_device.total_unclaimed_note_value == 20
+        assert restored_device.check_counter == 4
+        assert restored_device.cap == original_device.cap == 1000
+        assert len(restored.check_expiry) == 4
+        restored.storage.close()
+
+    def test_torn_tail(self):
+        """Tests that replay ignores a partially written group at the end of the journal."""
+        bank = Bank(42)
+        journal = Journal(self.path)
+        journal.replay(bank)
+        account = Account(Person("Bill"))
+        bank.add_device(account, AccountHolderDevice().public_key)
+        complete_size = journal.position
+        account.deposit(100)
+        journal.close()
+        with open(self.path, 'r+b') as journal_file:
+            journal_file.truncate(os.path.getsize(self.path) - 3)
+
+        restored = Bank(42, bank.private_key)
+        journal = Journal(self.path)
+        assert journal.replay(restored) == 1
+        assert restored.accounts[0].balance == 0
+        assert os.path.getsize(self.path) == complete_size
+        assert journal.position == complete_size
+
+        # A snapshot taken now must record the position past the last complete group.
+        snapshot_path = self.path + '.snapshot'
+        try:
+            assert write_snapshot(restored, snapshot_path) == complete_size
+            restored.add_account(Account(Person("Ted")))
+            journal.close()
+            restored = restore_bank(Bank(42, bank.private_key), Journal(self.path), snapshot_path)
+        finally:
+            os.remove(snapshot_path)
+        assert [account.owner.name for account in restored.accounts] == ["Bill", "Ted"]
+        restored.storage.close()
+
+    def test_batch_flush_when_idle(self):
+        """Tests that a batched group reaches the journal file once it has
+           waited long enough, even if no further operation follows."""
+        bank = Bank(42)
+        journal = Journal(self.path, SYNC_BATCH, group_delay=0.05)
+        journal.replay(bank)
+        bank.add_account(Account(Person("Bill")))
+        assert os.path.getsize(self.path) == 0
+        time.sleep(0.5)
+        assert os.path.getsize(self.path) > 0
+
+        restored = Bank(42, bank.private_key)
+        Journal(self.path).replay(restored)
+        assert [account.owner.name for account in restored.accounts] == ["Bill"]
+        journal.close()
+        restored.storage.close()
+
+    def test_cross_bank_credit(self):
+        """Tests that a seller credited by another bank's redemption, and a
+           deposit made outside any bank operation, are committed to the
+           seller bank's journal."""
+        seller_path = self.path + '.seller'
+        try:
+            buyer_bank = Bank(42)
+            seller_bank = Bank(43)
+            Journal(self.path).replay(buyer_bank)
+            Journal(seller_path).replay(seller_bank)
+            register_bank(buyer_bank)
+            register_bank(seller_bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+            buyer_device.register_bank(buyer_bank.identifier, buyer_bank.public_key)
+            seller_device.register_bank(seller_bank.identifier, seller_bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            seller_account = Account(Person("seller"))
+            buyer_bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            seller_bank.add_device(seller_account, seller_device.public_key)
+            buyer_account.deposit(1000)
+            seller_account.deposit(5)
+
+            buyer_device.add_unspent_check(buyer_bank.issue_check(buyer_device.public_key, 10))
+            perform_transaction(buyer_device, seller_device, 10)
+            assert seller_account.balance == 15
+
+            # Nothing is closed, so only what the banks committed is in the journals.
+            restored_buyer = Bank(42, buyer_bank.private_key)
+            restored_seller = Bank(43, seller_bank.private_key)
+            Journal(self.path).replay(restored_buyer)
+            Journal(seller_path).replay(restored_seller)
+            assert restored_buyer.accounts[0].balance == 990
+            assert restored_seller.accounts[0].balance == 15
+            for bank in (buyer_bank, seller_bank, restored_buyer, restored_seller):
+                bank.storage.close()
+        finally:
+            os.remove(seller_path)
+
+    def test_interrupted_remittance(self):
+        """Tests that a seller at another bank is paid exactly once if the
+           banks go down between the redemption and the seller's credit, or
+           between the credit and its acknowledgement."""
+        def fail(remittance):
+            raise ConnectionError('The other bank went down.')
+
+        seller_path = self.path + '.seller'
+        snapshot_path = self.path + '.snapshot'
+        try:
+            buyer_bank = Bank(42)
+            seller_bank = Bank(43)
+            Journal(self.path).replay(buyer_bank)
+            Journal(seller_path).replay(seller_bank)
+            register_bank(buyer_bank)
+            register_bank(seller_bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+            buyer_device.register_bank(buyer_bank.identifier, buyer_bank.public_key)
+            seller_device.register_bank(seller_bank.identifier, seller_bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            buyer_bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            seller_bank.add_device(Account(Person("seller")), seller_device.public_key)
+            buyer_account.deposit(1000)
+            for check in buyer_bank.issue_checks(buyer_device.public_key, [10, 10]):
+                buyer_device.add_unspent_check(check)
+
+            seller_bank._Bank__receive_remittance = fail
+            self.assertRaises(ConnectionError, perform_transaction, buyer_device, seller_device, 10)
+            assert len(buyer_bank.remittances.pending) == 1
+            buyer_bank.storage.close()
+            seller_bank.storage.close()
+
+            # Restart both banks, the buyer's bank from a snapshot.
+            restored_buyer = Bank(42, buyer_bank.private_key)
+            Journal(self.path).replay(restored_buyer)
+            write_snapshot(restored_buyer, snapshot_path)
+            restored_buyer.storage.close()
+            buyer_bank = restore_bank(Bank(42, buyer_bank.private_key), Journal(self.path), snapshot_path)
+            seller_bank = Bank(43, seller_bank.private_key)
+            Journal(seller_path).replay(seller_bank)
+            bank_directory.clear()
+            register_bank(buyer_bank)
+            register_bank(seller_bank)
+            assert [account.balance for account in buyer_bank.accounts] == [990]
+            assert [account.balance for account in seller_bank.accounts] == [0]
+
+            buyer_bank.deliver_pending_remittances()
+            buyer_bank.deliver_pending_remittances()
+            assert [account.balance for account in seller_bank.accounts] == [10]
+            assert not buyer_bank.remittances.pending
+
+            # The seller's bank applies the second remittance, but the buyer's bank never learns about it.
+            buyer_bank._Bank__acknowledge_remittance = fail
+            self.assertRaises(ConnectionError, perform_transaction, buyer_device, seller_device, 10)
+            del buyer_bank._Bank__acknowledge_remittance
+            buyer_bank.deliver_pending_remittances()
+            assert [account.balance for account in seller_bank.accounts] == [20]
+            assert not buyer_bank.remittances.pending
+            buyer_bank.storage.close()
+            seller_bank.storage.close()
+
+            restored_buyer = Bank(42, buyer_bank.private_key)
+            restored_seller = Bank(43, seller_bank.private_key)
+            Journal(self.path).replay(restored_buyer)
+            Journal(seller_path).replay(restored_seller)
+            assert [account.balance for account in restored_buyer.accounts] == [980]
+            assert [account.balance for account in restored_seller.accounts] == [20]
+            assert not restored_buyer.remittances.pending and restored_buyer.remittances.counters[43] == 2
+            assert restored_seller.remittances.is_received(42, 2) and not restored_seller.remittances.is_received(42, 3)
+            restored_buyer.storage.close()
+            restored_seller.storage.close()
+        finally:
+            for path in (seller_path, snapshot_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_snapshot_restore(self):
+        """Tests that a bank restored from a snapshot and the tail of its
+           journal matches the original."""
+        bank = Bank(42)
+        Journal(self.path).replay(bank)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+        buyer_account.deposit(1000)
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        for check in bank.issue_checks(buyer_device.public_key, [10, 20, 30, 40]):
+            buyer_device.add_unspent_check(check)
+        hand_in(create_promissory_note(buyer_device, seller_device, 20), buyer_device)
+
+        snapshot_path = self.path + '.snapshot'
+        try:
+            write_snapshot(bank, snapshot_path)
+            perform_transaction(buyer_device, seller_device, 10)
+            bank.storage.close()
+
+            restored = restore_bank(Bank(42, bank.private_key), Journal(self.path), snapshot_path)
+        finally:
+            os.remove(snapshot_path)
+
+        assert [account.balance for account in restored.accounts] == [990, 10]
+        restored_device = restored.get_device(buyer_device.public_key)
+        original_device = bank.get_device(buyer_device.public_key)
+        assert list(restored_device.unspent_checks) == list(original_device.unspent_checks)
+        assert restored_device.total_unspent_check_value == original_device.total_unspent_check_value
+        assert restored_device.awaiting_claim == original_device.awaiting_claim
+        assert restored_device.check_counter == 4
+        assert restored_device.cap == original_device.cap
+        restored.storage.close()
+
+    def test_revocations_persist(self):
+        """Tests that revocations survive a journal replay, a snapshot and an
+           SQLite database."""
+        bank = Bank(42)
+        Journal(self.path).replay(bank)
+        devices = [AccountHolderDevice() for _ in range(3)]
+        bank.revoke_device(devices[0].public_key)
+        snapshot_path = self.path + '.snapshot'
+        database_path = self.path + '.db'
+        try:
+            write_snapshot(bank, snapshot_path)
+            bank.revoke_devices([devices[1].public_key, devices[2].public_key])
+            bank.storage.close()
+
+            replayed = Bank(42, bank.private_key)
+            Journal(self.path).replay(replayed)
+            replayed.storage.close()
+            restored = restore_bank(Bank(42, bank.private_key), Journal(self.path), snapshot_path)
+            restored.storage.close()
+
+            stored = Bank(42, bank.private_key)
+            SQLiteStorage(database_path).load(stored)
+            stored.revoke_device(devices[0].public_key)
+            stored.revoke_devices([devices[1].public_key, devices[2].public_key])
+            stored.storage.close()
+            loaded = Bank(42, bank.private_key)
+            SQLiteStorage(database_path).load(loaded)
+            loaded.storage.close()
+        finally:
+            os.remove(snapshot_path)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(database_path + suffix):
+                    os.remove(database_path + suffix)
+
+        for copy in (replayed, restored, loaded):
+            assert copy.revocations.version == 2
+            assert copy.revocations.revoked == bank.revocations.revoked
+            assert copy.revocations.version_offsets == [0, 1, 3]
+            assert all(copy.revocations.is_revoked(device.public_key) for device in devices)
+
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+
+    def test_reload(self):
+        """Tests that a bank loaded from an SQLite database matches the bank
+           that wrote it."""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'bank.db')
+        try:
+            bank = SQLiteStorage(path).load(Bank(42))
+            register_bank(bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+            buyer_device.register_bank(bank.identifier, bank.public_key)
+            seller_device.register_bank(bank.identifier, bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            seller_account = Account(Person("seller"))
+            buyer_account.deposit(1000)
+            bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            bank.add_device(seller_account, seller_device.public_key)
+
+            for check in bank.issue_checks(buyer_device.public_key, [10, 20, 30, 40]):
+                buyer_device.add_unspent_check(check)
+            perform_transaction(buyer_device, seller_device, 10)
+            hand_in(create_promissory_note(buyer_device, seller_device, 20), buyer_device)
+            bank.storage.close()
+
+            storage = SQLiteStorage(path)
+            assert storage.connection.execute('SELECT COUNT(*) FROM checks WHERE spent = 0').fetchone() == (2,)
+            restored = storage.load(Bank(42, bank.private_key))
+
+            assert [account.balance for account in restored.accounts] == [990, 10]
+            restored_device = restored.get_device(buyer_device.public_key)
+            original_device = bank.get_device(buyer_device.public_key)
+            assert list(restored_device.unspent_checks) == list(original_device.unspent_checks)
+            assert restored_device.awaiting_claim == original_device.awaiting_claim
+            assert restored_device.check_counter == 4
+            assert restored_device.cap == original_device.cap
+            restored.storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_two_banks(self):
+        """Tests that two banks with their own databases each store their side
+           of a transaction between their customers, including when the
+           seller's account is used from several threads."""
+        directory = tempfile.mkdtemp()
+        try:
+            buyer_bank = SQLiteStorage(os.path.join(directory, 'buyer.db')).load(Bank(42))
+            seller_bank = SQLiteStorage(os.path.join(directory, 'seller.db')).load(Bank(43))
+            register_bank(buyer_bank)
+            register_bank(seller_bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+            buyer_device.register_bank(buyer_bank.identifier, buyer_bank.public_key)
+            seller_device.register_bank(seller_bank.identifier, seller_bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            seller_account = Account(Person("seller"))
+            buyer_bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            seller_bank.add_device(seller_account, seller_device.public_key)
+            buyer_account.deposit(1000)
+
+            for check in buyer_bank.issue_checks(buyer_device.public_key, [10, 20]):
+                buyer_device.add_unspent_check(check)
+            depositors = [threading.Thread(target=lambda: [seller_account.deposit(1) for _ in range(50)])
+                          for _ in range(4)]
+            for depositor in depositors:
+                depositor.start()
+            perform_transaction(buyer_device, seller_device, 30)
+            for depositor in depositors:
+                depositor.join()
+            buyer_bank.storage.close()
+            seller_bank.storage.close()
+
+            restored_buyer = SQLiteStorage(os.path.join(directory, 'buyer.db')).load(Bank(42, buyer_bank.private_key))
+            restored_seller = SQLiteStorage(os.path.join(directory, 'seller.db')).load(
+                Bank(43, seller_bank.private_key))
+            assert [account.balance for account in restored_buyer.accounts] == [970]
+            assert [account.balance for account in restored_seller.accounts] == [230]
+            restored_buyer.storage.close()
+            restored_seller.storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_interrupted_settlement(self):
+        """Tests that a settlement that is interrupted after one bank has
+           credited its sellers is completed, and not repeated, once both
+           banks are loaded from their databases again."""
+        def fail(remittance):
+            raise ConnectionError('The other bank went down.')
+
+        directory = tempfile.mkdtemp()
+        first_path = os.path.join(directory, 'first.db')
+        second_path = os.path.join(directory, 'second.db')
+        try:
+            first_bank = SQLiteStorage(first_path).load(Bank(42, net_settlement=True))
+            second_bank = SQLiteStorage(second_path).load(Bank(43, net_settlement=True))
+            register_bank(first_bank)
+            register_bank(second_bank)
+
+            first_device = AccountHolderDevice()
+            second_device = AccountHolderDevice()
+            first_device.register_bank(first_bank.identifier, first_bank.public_key)
+            second_device.register_bank(second_bank.identifier, second_bank.public_key)
+            first_bank.add_device(Account(Person("first")), first_device.public_key, 1000, 1000)
+            second_bank.add_device(Account(Person("second")), second_device.public_key, 1000, 1000)
+            first_bank.accounts[0].deposit(1000)
+            second_bank.accounts[0].deposit(1000)
+
+            first_device.add_unspent_check(first_bank.issue_check(first_device.public_key, 30))
+            perform_transaction(first_device, second_device, 30)
+            second_device.add_unspent_check(second_bank.issue_check(second_device.public_key, 5))
+            perform_transaction(second_device, first_device, 5)
+
+            # The second bank's sellers are credited, but the first bank goes down before its sellers are.
+            first_bank._Bank__receive_remittance = fail
+            self.assertRaises(ConnectionError, first_bank.settle_with, second_bank)
+            first_bank.storage.close()
+            second_bank.storage.close()
+
+            first_bank = SQLiteStorage(first_path).load(Bank(42, first_bank.private_key, net_settlement=True))
+            second_bank = SQLiteStorage(second_path).load(Bank(43, second_bank.private_key, net_settlement=True))
+            bank_directory.clear()
+            register_bank(first_bank)
+            register_bank(second_bank)
+            assert [account.balance for account in first_bank.accounts] == [970]
+            assert [account.balance for account in second_bank.accounts] == [1025]
+            assert first_bank.settle() == [] and second_bank.settle() == []
+
+            for _ in range(2):
+                first_bank.deliver_pending_remittances()
+                second_bank.deliver_pending_remittances()
+            assert [account.balance for account in first_bank.accounts] == [975]
+            assert [account.balance for account in second_bank.accounts] == [1025]
+            assert first_bank.interbank_position[43] == -25 and second_bank.interbank_position[42] == 25
+            first_bank.storage.close()
+            second_bank.storage.close()
+
+            first_bank = SQLiteStorage(first_path).load(Bank(42, first_bank.private_key, net_settlement=True))
+            second_bank = SQLiteStorage(second_path).load(Bank(43, second_bank.private_key, net_settlement=True))
+            assert not first_bank.remittances.pending and not second_bank.remittances.pending
+            assert second_bank.remittances.counters[42] == 1 and first_bank.remittances.is_received(43, 1)
+            assert first_bank.interbank_position[43] == -25 and second_bank.interbank_position[42] == 25
+            first_bank.storage.close()
+            second_bank.storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ledgers_in_database(self):
+        """Tests that a bank that leaves its check ledgers in the database
+           issues, redeems and expires checks like one that holds them in
+           memory."""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'bank.db')
+        try:
+            bank = SQLiteStorage(path).load(Bank(42), in_memory=False)
+            bank.clock = ManualClock(date.today())
+            register_bank(bank)
+
+            buyer_device = AccountHolderDevice()
+            seller_device = AccountHolderDevice()
+            buyer_device.register_bank(bank.identifier, bank.public_key)
+            seller_device.register_bank(bank.identifier, bank.public_key)
+
+            buyer_account = Account(Person("buyer"))
+            seller_account = Account(Person("seller"))
+            data, _ = bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+            bank.add_device(seller_account, seller_device.public_key)
+            buyer_account.deposit(1000)
+
+            for check in bank.issue_checks(buyer_device.public_key, [10, 20, 30]):
+                buyer_device.add_unspent_check(check)
+            assert len(bank.check_expiry) == 1
+            perform_transaction(buyer_device, seller_device, 10)
+            assert [account.balance for account in bank.accounts] == [990, 10]
+            assert list(data.unspent_checks) == [1, 2]
+            assert data.total_unspent_check_value == 50 == data.unspent_checks.recompute_total_value()
+            snapshot_ledger = CheckLedger.from_buffer(data.unspent_checks.to_bytes())[0]
+            assert list(snapshot_ledger) == [1, 2] and snapshot_ledger.total_value() == 50
+
+            bank.clock.advance(CHECK_EXPIRATION + DAYS_VALID + 1)
+            bank.sweep_expired()
+            assert len(data.unspent_checks) == 0 and data.total_unspent_check_value == 0
+            bank.storage.close()
+
+            restored = SQLiteStorage(path).load(Bank(42, bank.private_key), in_memory=False)
+            restored_data = restored.get_device(buyer_device.public_key)
+            assert list(restored_data.unspent_checks) == [] and restored_data.total_unspent_check_value == 0
+            assert restored_data.check_counter == 3
+            restored.storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+class TestBankDirectory(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+
+    def test_lookups(self):
+        """Tests that a bank directory finds banks by identifier, by public key
+           and by the account holders they serve."""
+        directory = BankDirectory()
+        bank = Bank(4242)
+        early_device = AccountHolderDevice()
+        bank.add_device(Account(Person("early")), early_device.public_key)
+        directory.register(bank)
+        late_device = AccountHolderDevice()
+        directory.add_account_holder(bank, late_device.public_key)
+
+        assert directory.is_registered(bank)
+        assert not directory.is_registered(Bank(4243))
+        assert directory.get_by_identifier(4242) is bank
+        assert directory.get_by_public_key(bank.public_key) is bank
+        assert directory.get_home_bank(early_device.public_key) is bank
+        assert directory.get_home_bank(late_device.public_key) is bank
+        assert directory.get_home_bank(AccountHolderDevice().public_key) is None
+
+    def test_registered_bank_indexes_new_devices(self):
+        """Tests that adding a device to a registered bank makes the bank the device's home bank."""
+        bank = Bank(4244)
+        register_bank(bank)
+        device = AccountHolderDevice()
+        bank.add_device(Account(Person("Bill")), device.public_key)
+        assert bank_directory.get_home_bank(device.public_key) is bank
+
+    def test_duplicate_identifier(self):
+        """Tests that a bank cannot be registered under the identifier of
+           another registered bank and that a device served by two banks keeps
+           the first as its home bank."""
+        directory = BankDirectory()
+        first_bank = Bank(4245)
+        second_bank = Bank(4246)
+        device = AccountHolderDevice()
+        first_bank.add_device(Account(Person("Bill")), device.public_key)
+        second_bank.add_device(Account(Person("Bill")), device.public_key)
+        directory.register(first_bank)
+        self.assertRaises(ValueError, directory.register, Bank(4245))
+        assert directory.get_by_identifier(4245) is first_bank and directory.banks == [first_bank]
+
+        directory.register(second_bank)
+        directory.add_account_holder(second_bank, device.public_key)
+        assert directory.get_home_bank(device.public_key) is first_bank
+
 
 class TestSerializable(unittest.TestCase):
     def test_serialize_check(self):
@@ -59,6 +990,18 @@ class TestSerializable(unittest.TestCase):
         assert deserialized.bank_id == 42
         assert deserialized.value == val
 
+    def test_decoding_interns_public_keys(self):
+        """Tests that decoding the same check twice reuses the decoded owner key."""
+        bank = Bank(42)
+        device = AccountHolderDevice()
+        data = AccountDeviceData(device.public_key, 1000)
+        serialized = data.generate_check(10, bank).to_bytes()
+        first = Check.from_bytes(serialized)
+        hits = public_key_cache.hits
+        second = Check.from_bytes(serialized)
+        assert second.owner_public_key is first.owner_public_key
+        assert public_key_cache.hits == hits + 1
+
     def test_serialize_promissory_note_draft(self):
         """Tests that a promissory note draft can be serialized."""
         device = AccountHolderDevice()
@@ -68,6 +1011,80 @@ class TestSerializable(unittest.TestCase):
         deserialized = PromissoryNoteDraft.from_bytes(serialized)
         assert deserialized.to_bytes() == serialized
 
+    def test_wire_format_v2(self):
+        """Tests that a version 2 draft stores each check owner's key once, keeps
+           64-bit identifiers and carries checks whose signatures still verify."""
+        bank = Bank(42)
+        buyer = AccountHolderDevice()
+        seller = AccountHolderDevice()
+        draft = seller.draft_promissory_note(30)
+        draft.identifier = 2 ** 40
+        for identifier, value in ((2 ** 33, 10), (2 ** 33 + 1, 20)):
+            check = Check(bank.identifier, buyer.public_key, value, identifier)
+            check.sign(bank.private_key)
+            draft.append_check(check, value)
+        serialized = draft.to_bytes()
+        assert serialized.count(buyer.public_key.export_key(format='SEC1', compress=True)) == 1
+
+        deserialized = PromissoryNoteDraft.from_bytes(serialized)
+        assert deserialized.version == WIRE_VERSION_2
+        assert deserialized.to_bytes() == serialized
+        assert deserialized.identifier == 2 ** 40
+        assert [check.identifier for check, _ in deserialized.checks] == [2 ** 33, 2 ** 33 + 1]
+        assert all(check.is_signature_authentic(bank.public_key) for check, _ in deserialized.checks)
+
+    def test_wire_format_v1(self):
+        """Tests that version 1 checks and drafts still decode, and that a
+           version 1 check keeps a valid signature inside a version 2 draft."""
+        bank = Bank(42)
+        buyer = AccountHolderDevice()
+        seller = AccountHolderDevice()
+        check = Check(bank.identifier, buyer.public_key, 10, 7, version=WIRE_VERSION_1)
+        check.sign(bank.private_key)
+        draft = PromissoryNoteDraft(seller.public_key, 3, 10, version=WIRE_VERSION_1)
+        draft.append_check(check, 10)
+
+        v1_draft = PromissoryNoteDraft.from_bytes(draft.to_bytes())
+        assert v1_draft.version == WIRE_VERSION_1
+        assert v1_draft.to_bytes() == draft.to_bytes()
+        assert Check.from_bytes(check.to_bytes()) == check
+
+        v1_draft.version = WIRE_VERSION_2
+        v2_draft = PromissoryNoteDraft.from_bytes(v1_draft.to_bytes())
+        v2_check, _ = v2_draft.checks[0]
+        assert v2_check.version == WIRE_VERSION_1
+        assert v2_check.is_signature_authentic(bank.public_key)
+
+        # A version 1 check of this bank would start with the version 2 marker.
+        self.assertRaises(ValueError, Bank, RESERVED_BANK_ID)
+        self.assertRaises(ValueError, Check, RESERVED_BANK_ID, buyer.public_key, 10, 7, version=WIRE_VERSION_1)
+
+    def test_byte_reader(self):
+        """Tests that a byte reader decodes fields without consuming more than it should."""
+        reader = ByteReader(uint32_to_bytes(7) + string_to_bytes('check') + bytestring_to_bytes(b'\x01\x02'))
+        assert reader.read_uint32() == 7
+        assert reader.read_string() == 'check'
+        view = reader.read_view()
+        assert isinstance(view, memoryview) and bytes(view) == b'\x01\x02'
+        assert not reader
+        with self.assertRaises(ValueError):
+            ByteReader(uint32_to_bytes(10) + b'short').read_bytestring()
+
+    def test_serialize_promissory_note_draft_with_checks(self):
+        """Tests that a promissory note draft with checks can be serialized."""
+        bank = Bank(42)
+        buyer = AccountHolderDevice()
+        seller = AccountHolderDevice()
+        data = AccountDeviceData(buyer.public_key, 1000)
+        draft = seller.draft_promissory_note(30)
+        for value in (10, 20):
+            draft.append_check(data.generate_check(value, bank), value)
+        serialized = draft.to_bytes()
+        deserialized = PromissoryNoteDraft.from_bytes(serialized)
+        assert deserialized.to_bytes() == serialized
+        assert [amount for _, amount in deserialized.checks] == [10, 20]
+        assert all(check.is_signature_authentic(bank.public_key) for check, _ in deserialized.checks)
+
     def test_serialize_promisory_note(self):
         """Tests that a promisory note can be serialized."""
         device = AccountHolderDevice()
@@ -78,8 +1095,92 @@ class TestSerializable(unittest.TestCase):
         deserialized = PromissoryNote.from_bytes(serialized)
         assert deserialized.to_bytes() == serialized
 
+    def test_promissory_note_from_draft(self):
+        """Tests that a note created from a draft reuses the draft and that
+           its signatures cover the encoded draft."""
+        buyer = AccountHolderDevice()
+        seller = AccountHolderDevice()
+        draft = seller.draft_promissory_note(0)
+        note = PromissoryNote.from_draft(draft)
+        note.sign_as_seller(seller.private_key)
+        note.sign_as_buyer(buyer.private_key)
+        assert note.draft is draft
+        assert note.draft_bytes == draft.to_bytes()
+        assert verify_DSS(note.draft_bytes, note.seller_signature, seller.public_key)
+        assert verify_DSS(note.draft_bytes + note.seller_signature, note.buyer_signature, buyer.public_key)
+
+    def test_promissory_note_caches_draft(self):
+        """Tests that a promissory note decodes its draft once and
+           decodes it again when the draft bytes change."""
+        device = AccountHolderDevice()
+        note = PromissoryNote(device.draft_promissory_note(5).to_bytes())
+        draft = note.draft
+        assert note.draft is draft
+        note.draft_bytes = device.draft_promissory_note(7).to_bytes()
+        assert note.draft is not draft
+        assert note.draft.value == 7
+
+
+class TestCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        """Tests that an LRU cache evicts its least recently used entry."""
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        assert cache.get('b') is None
+        assert cache.stats() == {'size': 2, 'capacity': 2, 'policy': 'lru', 'hits': 1, 'misses': 1}
+
+    def test_fifo_eviction(self):
+        """Tests that a FIFO cache evicts its oldest entry, even if it was used recently."""
+        cache = new_cache(2, 'fifo')
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert 'a' not in cache and 'b' in cache and 'c' in cache
+        with self.assertRaises(ValueError):
+            new_cache(2, 'random')
+
+    def test_verification_cache(self):
+        """Tests that verifying the same signature twice hits the verification cache."""
+        configure_verification_cache(16)
+        try:
+            key = ECC.generate(curve='P-256')
+            signature = sign_DSS(b'note', key)
+            assert verify_DSS(b'note', signature, key.public_key())
+            assert verify_DSS(b'note', signature, key.public_key())
+            assert not verify_DSS(b'other note', signature, key.public_key())
+            assert not verify_DSS(b'other note', signature, key.public_key())
+            stats = promissory_note.verification_cache.stats()
+            assert stats['hits'] == 2 and stats['misses'] == 2
+        finally:
+            configure_verification_cache()
+
+    def test_signer_and_verifier(self):
+        """Tests that signers and verifiers sign and verify batches and record
+           their timings."""
+        configure_verification_cache(16)
+        try:
+            signer = Signer(ECC.generate(curve='P-256'))
+            verifier = Verifier(signer.private_key.public_key())
+            messages = [b'first', b'second', b'third']
+            signatures = signer.sign_many(messages, workers=1)
+            assert verifier.verify_many(messages, signatures) == [True, True, True]
+            assert verifier.verify_many(messages[:1], signatures[1:2]) == [False]
+            assert verifier.verify(messages[0], signatures[0])
+            assert signer.stats()['count'] == 3 and signer.stats()['seconds'] > 0
+            assert verifier.stats()['count'] == 4 and verifier.stats()['cache hits'] == 1
+        finally:
+            configure_verification_cache()
+
 
 class TestSigningProtocol(unittest.TestCase):
+    def setUp(self):
+        bank_directory.clear()
+
     def test_create_promissory_note(self):
         """Tests that a Promissory Note can be created."""
         buyer_device = AccountHolderDevice()
@@ -87,6 +1188,37 @@ class TestSigningProtocol(unittest.TestCase):
 
         create_promissory_note(buyer_device, seller_device, 0)
 
+    def test_verify_promissory_notes(self):
+        """Tests that a batch of notes is verified in parallel and that
+           the results are reported in order."""
+        bank = Bank(42)
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+        buyer_account = Account(Person("buyer"))
+        buyer_account.deposit(1000)
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+
+        notes = []
+        for _ in range(4):
+            buyer_device.add_unspent_check(bank.issue_check(buyer_device.public_key, 10))
+            notes.append(create_promissory_note(buyer_device, seller_device, 10))
+        notes[2].buyer_signature = notes[1].buyer_signature
+
+        results = verify_promissory_notes(notes, workers=2, bank_keys={bank.identifier: bank.public_key})
+        assert [result is None for result in results] == [True, True, False, True]
+        assert isinstance(results[2], ValueError)
+
+        results = verify_promissory_notes(notes, workers=2, bank_keys={})
+        assert all(isinstance(result, ValueError) for result in results)
+
+        # Notes without checks and notes that cannot be decoded only fail themselves.
+        empty = create_promissory_note(buyer_device, seller_device, 0)
+        truncated = PromissoryNote(notes[0].draft_bytes[:-10], notes[0].seller_signature, notes[0].buyer_signature)
+        for workers in (1, 2):
+            results = verify_promissory_notes([notes[0], empty, truncated], workers=workers)
+            assert results[0] is None
+            assert results[1] is not None and results[2] is not None
+
     def test_transfer(self):
         """Tests that a transfer can be made between a buyer and a seller."""
         buyer_bank = Bank(42)
@@ -123,6 +1255,108 @@ class TestSigningProtocol(unittest.TestCase):
         assert buyer_account.balance == 990
         assert seller_account.balance == 10
 
+    def test_transfer_checkbook(self):
+        """Tests that checks from a checkbook can be spent."""
+        bank = Bank(42)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+
+        buyer_account.deposit(1000)
+
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        for check in bank.issue_checks(buyer_device.public_key, [10, 10, 20], checkbook=True):
+            buyer_device.add_unspent_check(check)
+
+        perform_transaction(buyer_device, seller_device, 30)
+
+        assert buyer_account.balance == 970
+        assert seller_account.balance == 30
+
+    def test_transfer_ed25519(self):
+        """Tests that banks and devices that use the Ed25519 signature suite
+           can transact with each other and with ECDSA devices."""
+        bank = Bank(42, signature_suite='ed25519')
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice(signature_suite=ED25519)
+        seller_device = AccountHolderDevice()
+        assert bank.signature_suite is ED25519 and seller_device.signature_suite is ECDSA_P256
+
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+        buyer_account.deposit(1000)
+
+        _, cert = bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+        assert cert.validate(buyer_device.public_key.export_key(format='PEM'), bank.public_key)
+
+        for check in bank.issue_checks(buyer_device.public_key, [10, 20], checkbook=True):
+            buyer_device.add_unspent_check(check)
+        note = create_promissory_note(buyer_device, seller_device, 30)
+        decoded = PromissoryNote.from_bytes(note.to_bytes())
+        assert decoded.draft.checks[0][0].owner_public_key == buyer_device.public_key
+        verify_promissory_note(decoded, {bank.identifier: bank.public_key})
+        transfer(decoded, buyer_device, seller_device)
+
+        assert buyer_account.balance == 970
+        assert seller_account.balance == 30
+
+    def test_net_settlement(self):
+        """Tests that a bank that nets its interbank payments only credits
+           sellers at other banks when it settles."""
+        first_bank = Bank(42, net_settlement=True)
+        second_bank = Bank(43, net_settlement=True)
+
+        register_bank(first_bank)
+        register_bank(second_bank)
+
+        first_device = AccountHolderDevice()
+        second_device = AccountHolderDevice()
+
+        first_device.register_bank(first_bank.identifier, first_bank.public_key)
+        second_device.register_bank(second_bank.identifier, second_bank.public_key)
+
+        first_account = Account(Person("first"))
+        second_account = Account(Person("second"))
+
+        first_account.deposit(1000)
+        second_account.deposit(1000)
+
+        first_bank.add_device(first_account, first_device.public_key, 1000, 1000)
+        second_bank.add_device(second_account, second_device.public_key, 1000, 1000)
+
+        for value in (10, 20):
+            first_device.add_unspent_check(first_bank.issue_check(first_device.public_key, value))
+            perform_transaction(first_device, second_device, value)
+        second_device.add_unspent_check(second_bank.issue_check(second_device.public_key, 5))
+        perform_transaction(second_device, first_device, 5)
+
+        assert first_account.balance == 970
+        assert second_account.balance == 995
+        assert first_bank.settlement.total_owed_to(43) == 30
+
+        batches = first_bank.settle()
+        assert len(batches) == 1
+        assert batches[0].net_amount == 25
+        assert first_account.balance == 975
+        assert second_account.balance == 1025
+        assert first_bank.interbank_position[43] == -25
+        assert second_bank.interbank_position[42] == 25
+        assert first_bank.settle() == [] and second_bank.settle() == []
+
     def test_catch_double_spender(self):
         """Tests that people who try to double-spend checks are caught."""
         bank = Bank(42)
@@ -153,6 +1387,114 @@ class TestSigningProtocol(unittest.TestCase):
         with self.assertRaises(FraudException):
             perform_transaction(buyer_device, seller_device, 10)
 
+    def test_reject_forged_checks(self):
+        """Tests that a note cannot spend another account holder's checks
+           through checks that carry a forged bank signature."""
+        bank = Bank(42)
+        register_bank(bank)
+        attacker_device = AccountHolderDevice()
+        victim_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+        attacker_account = Account(Person("Mallory"))
+        victim_account = Account(Person("Alice"))
+        seller_account = Account(Person("Shop"))
+        attacker_account.deposit(100)
+        victim_account.deposit(100)
+        bank.add_device(attacker_account, attacker_device.public_key, 100, 100)
+        bank.add_device(victim_account, victim_device.public_key, 100, 100)
+        bank.add_device(seller_account, seller_device.public_key)
+        own_check = bank.issue_check(attacker_device.public_key, 10)
+        victim_check = bank.issue_check(victim_device.public_key, 100)
+
+        for owner_public_key in (victim_device.public_key, attacker_device.public_key):
+            draft = seller_device.draft_promissory_note(110)
+            draft.append_check(own_check, 10)
+            draft.append_check(Check(42, owner_public_key, 100, victim_check.identifier, b'\0' * 64,
+                                     victim_check.expiration_date), 100)
+            note = PromissoryNote.from_draft(draft)
+            note.sign_as_seller(seller_device.signer)
+            note.sign_as_buyer(attacker_device.signer)
+            with self.assertRaises(FraudException):
+                bank.redeem_promissory_note(note)
+
+        assert bank.get_device(victim_device.public_key).is_unspent(victim_check)
+        assert [victim_account.balance, attacker_account.balance, seller_account.balance] == [100, 100, 0]
+
+    def test_hand_in_then_transfer(self):
+        """Tests that a note handed in by the buyer can still be redeemed by the seller."""
+        bank = Bank(42)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+
+        buyer_account.deposit(1000)
+
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        buyer_device.add_unspent_check(bank.issue_check(buyer_device.public_key, 10))
+        note = create_promissory_note(buyer_device, seller_device, 10)
+        verify_promissory_note(note)
+        hand_in(note, buyer_device)
+        assert bank.get_device(buyer_device.public_key).awaiting_claim
+
+        transfer(note, buyer_device, seller_device)
+        assert not bank.get_device(buyer_device.public_key).awaiting_claim
+        assert buyer_account.balance == 990
+        assert seller_account.balance == 10
+
+    def test_redeem_promissory_notes(self):
+        """Tests that a batch of notes is redeemed in one call and that failing
+           notes do not prevent the others from being redeemed."""
+        bank = Bank(42)
+        register_bank(bank)
+
+        buyer_device = AccountHolderDevice()
+        seller_device = AccountHolderDevice()
+
+        buyer_device.register_bank(bank.identifier, bank.public_key)
+        seller_device.register_bank(bank.identifier, bank.public_key)
+
+        buyer_account = Account(Person("buyer"))
+        seller_account = Account(Person("seller"))
+
+        buyer_account.deposit(1000)
+
+        bank.add_device(buyer_account, buyer_device.public_key, 1000, 1000)
+        bank.add_device(seller_account, seller_device.public_key)
+
+        checks = bank.issue_checks(buyer_device.public_key, [10, 20, 30, 40])
+        notes = []
+        for check in checks:
+            buyer_device.add_unspent_check(check)
+            notes.append(create_promissory_note(buyer_device, seller_device, check.value))
+        # Double-spend the first check and tamper with the third note.
+        buyer_device.add_unspent_check(checks[0])
+        notes.insert(1, create_promissory_note(buyer_device, seller_device, 10))
+        notes[3].seller_signature = notes[2].seller_signature
+        # Add a note without checks and one whose check carries a forged bank signature.
+        notes.insert(0, create_promissory_note(buyer_device, seller_device, 0))
+        draft = seller_device.draft_promissory_note(40)
+        draft.append_check(Check(42, buyer_device.public_key, 40, checks[3].identifier, b'\0' * 64,
+                                 checks[3].expiration_date), 40)
+        forged = PromissoryNote.from_draft(draft)
+        forged.sign_as_seller(seller_device.signer)
+        forged.sign_as_buyer(buyer_device.signer)
+        notes.insert(5, forged)
+
+        outcomes = bank.redeem_promissory_notes(notes)
+        assert outcomes == [INVALID, REDEEMED, FRAUD, REDEEMED, INVALID, INVALID, REDEEMED]
+        assert buyer_account.balance == 930
+        assert seller_account.balance == 70
+        assert bank.get_device(buyer_device.public_key).total_unspent_check_value == 30
+
     def test_cap_enforcement(self):
         """Tests that the bank enforces the cap on an account holder device."""
         bank = Bank(42)